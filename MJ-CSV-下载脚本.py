@@ -7,6 +7,16 @@
 # 标准库(os, csv, urllib.parse, argparse, concurrent.futures等)无需额外安装
 # 可选依赖:
 # 1. curl - 作为下载方式之一 (用户可选)
+# 2. aiohttp - async下载方式所需 (用户可选)
+#    安装命令: pip install aiohttp
+# 3. pyarrow - 分片输出时生成Parquet格式的元数据索引 (用户可选)
+#    安装命令: pip install pyarrow
+# 4. watchdog - 监视模式下通过文件系统事件（Linux下为inotify）发现新的CSV，未安装时改为轮询 (用户可选)
+#    安装命令: pip install watchdog
+# 5. httpx[http2] - h2下载方式所需 (用户可选)
+#    安装命令: pip install "httpx[http2]"
+# 6. Pillow - 下载后处理（--verify、--resize、--reencode、--thumbnail）所需 (用户可选)
+#    安装命令: pip install Pillow
 #
 # ========================================================================
 # MJ-CSV-DL.py - Midjourney CSV下载工具
@@ -20,10 +30,77 @@
 #   2. 下载CSV中的图片链接指向的图片，图片文件名与文本文件对应（例如 任务ID_0.png）
 #   3. 支持单个CSV文件或整个目录的批量处理
 #   4. 支持多线程并行下载，提高处理速度
-#   5. 提供四种下载方式供用户选择（默认使用curl方式），用户可通过参数或交互提示选择方式
+#   5. 提供六种下载方式供用户选择（curl、browser、requests、urllib、async、h2，默认使用curl方式），用户可通过参数或交互提示选择方式
 #   6. 【扩展模式】：在扩展模式下，每个任务构造0_0至0_3四个下载任务（命名如 taskID_0、taskID_1...），
 #      如果某个图片下载失败，则对应的txt文件不生成；扩展模式下最多重试1次，普通模式下重试2次。
 #   7. 【优化】：如果保存的目录中已存在要下载的图片和文本文件，则自动略过不处理。
+#   8. 【连接复用】：所有下载线程共享一个带连接池的HTTP客户端，每个主机每次运行最多预热一次，
+#      运行结束时输出连接复用统计。
+#   9. 【async方式】：--method async 在单个事件循环中保持大量图片请求同时在途（需安装aiohttp），
+#      并发数由 --concurrency 控制，跳过与txt生成规则与其它方式一致。
+#  10. 【批量curl】：curl方式默认把多张图片交给同一个curl进程（配置文件 + --parallel）下载并复用连接，
+#      每张图片的成功/失败仍单独映射回对应任务；同时进行的传输数与逐张调用时一样不超过 --threads，
+#      批大小只决定每个curl进程处理多少张图片；需要curl 7.67+，否则自动退回逐张调用。
+#      --max-bandwidth 按进行中的curl传输平分后交给curl的 --limit-rate，在传输过程中限速。
+#  11. 【流式处理】：CSV逐行解析，任务经有界队列送入下载线程，读取的同时即开始下载，内存占用与CSV大小无关。
+#  12. 【下载清单】：输出目录中的 .mj_manifest.sqlite3 记录每个任务的状态、字节数、SHA-256和最后一次错误，
+#      再次运行时已完成的任务只需一次索引查询即可跳过，被中断或失败的任务会重新下载。
+#  13. 【跨CSV去重】：同一次运行中，多个CSV里 任务ID 与图片链接相同的任务只下载一次；
+#      启用 --content-store 后图片按SHA-256存放在输出目录的 .blobs 中，<任务ID>_N.png 以硬链接
+#      （不支持时用符号链接或复制）指向同一份数据，已下载过的图片链接不会再次下载。
+#  14. 【目录统一调度】：处理目录时所有CSV合并为一个下载队列，共用一个线程池和一个总进度条（含剩余时间估计），
+#      不再逐个文件启动和收尾；--recursive 可递归查找子目录中的CSV。
+#  15. 【自适应并发与限速】：失败的下载放回调度队列按 Retry-After 或随机退避重新提交，不再占用线程睡眠；
+#      --host-rate 按主机令牌桶限速，收到429/503时暂停该主机；--adaptive 根据延迟与错误率自动增减并发数。
+#      批量curl模式同样由调度器安排：一批中失败的图片各自按 Retry-After 退避重试，收到429时暂停该主机。
+#  16. 【下载指标】：记录每个任务的DNS、建立连接、TLS、首字节、传输耗时与字节数、状态码和重试次数，
+#      运行结束时打印耗时分布、最慢的主机和常见失败原因；--metrics-log 逐任务写入JSON Lines，
+#      --metrics-report 写出汇总JSON；--quiet 不再逐张打印，进度条上显示成功/失败数。
+#      DNS、建立连接与TLS耗时只在新建连接时记录；h2方式不单独记录DNS，其建立连接耗时包含DNS解析。
+#  17. 【任务页面缓存】：browser方式访问任务页面得到的cookie按任务链接和图片主机缓存（--task-page-ttl），
+#      同一任务的各张图片与重试只访问一次任务页面；下载图片收到401/403时缓存失效并重新获取。
+#  18. 【不存在的变体】：返回404/410的图片不再重试，并记入下载清单，--missing-ttl 天内再次运行时不发请求直接跳过；
+#      扩展模式下加 --probe 先用HEAD（不支持时用1字节Range）请求探测变体是否存在，不存在的变体不再下载。
+#  19. 【完整性校验与断点续传】：所有下载方式都先写入 <文件名>.tmp，校验 Content-Length 与图片文件头
+#      （PNG/JPEG/GIF/WebP/AVIF）后再原子重命名，中断不会留下残缺的图片；
+#      留下的 .tmp 在下次下载时用 Range 请求续传，并以保存在 .tmp.validator 中的ETag/Last-Modified
+#      作为 If-Range，服务器上的图片已变化时返回完整内容，不会拼接出混合的文件。
+#  20. 【首选格式】：--prefer-format webp 先下载WebP原图（体积通常只有PNG的几分之一），不存在时退回PNG链接；
+#      文件扩展名按下载内容的文件头确定（如 任务ID_0.webp），已存在任意扩展名的图片都视为已下载。
+#  21. 【分片输出】：--output-format shards 把图片、Prompt和元数据按WebDataset格式（<key>.png/.txt/.json）
+#      打包进 shards/shard-NNNNNN.tar，每个分片不超过 --shard-size MB；metadata.jsonl 汇总每个样本所在的分片
+#      以及CSV中的其它列（Prompt 参数、用户ID等），--index-format parquet 另外生成 metadata.parquet。
+#  22. 【多机分工】：--partition i/N（或 --shard i/N）按任务ID的稳定哈希只处理第i份任务，各台机器互不重叠；
+#      --lease-db 让多个工作进程共享一个SQLite任务队列，按租约领取任务并定期续约，
+#      崩溃进程的租约过期后其任务由其它进程自动回收，下载失败的任务放回队列重试（每个任务最多领取3次）；
+#      队列只保存图片URL、任务ID与元数据，各进程按自己的输出目录保存图片。
+#  23. 【多进程下载】：--processes N 由主进程解析CSV并分发任务，N个子进程各自运行线程池或async事件循环，
+#      摆脱单个解释器的GIL限制；每个任务的结果发回主进程，统一更新进度条、成功数与下载指标。
+#  24. 【监视模式】：--watch 持续监视输入目录或文件，发现新导出的CSV或已有CSV新增的行时自动下载；
+#      每个CSV记录已解析到的字节偏移和文件开头的校验和（保存在输出目录的 .mj_watch_state.json），
+#      只解析新增的完整行，文件被替换或截断时从头重新解析；各批任务共用同一个线程池与连接池
+#      （async方式保持同一个事件循环与会话，--processes 的子进程在各批之间保持运行）。
+#      失败的任务在之后的轮询中按指数退避重新下载（60秒起，最长1小时），保存的偏移不越过尚未完成的行，重启后不会遗漏。
+#  25. 【实时接收】：--serve [HOST:]PORT 启动本地接收服务，插件设置中填写服务地址后，抓取过程中每20条记录
+#      POST一次到 /records（列名与CSV导出相同，也接受CSV文本），收到即开始下载，抓取与下载同时进行；
+#      收到的记录同时追加到输出目录的 ingest-日期.csv 留档，GET /status 可查看接收数量；
+#      只接受来自 https://www.midjourney.com 的跨域请求，--serve-token 可另外要求插件带上令牌，
+#      插件在服务确认收到后从页面中移除已发送的记录，长时间抓取时内存不随记录数增长。
+#  26. 【优先级与带宽】：扩展模式下先下载所有任务的 _0 图片，再读取第二遍下载 _1～_3 变体，中途停止或被限速时
+#      每个任务至少已有主图（--interleave-variants 恢复按行顺序）；--priority "MJ-top*=10" 按CSV文件名设置优先级，
+#      优先级高的CSV先下载；--max-bandwidth 10M 限制全局下载带宽（多进程时各进程平分），便于与其它流量共用线路。
+#  27. 【HTTP/2方式】：--method h2 所有线程共用少量HTTP/2连接（--h2-connections），每张图片占用一个流，
+#      每个主机同时在途的流数由 --h2-streams 限制，流量控制由h2协议栈完成，线程数不再受CDN允许的连接数限制；
+#      需安装 httpx[http2]，http:// 地址使用h2c（用于基准测试脚本中的HTTP/2模拟CDN）。
+#  28. 【可导入的包】：实现位于 mj_csv_dl 包中，本脚本与 python -m mj_csv_dl 只是命令行入口；其它程序可使用
+#      mj_csv_dl.Downloader 长期复用同一个线程池、连接池、下载清单与缓存，多次提交CSV文件、文本流或记录，
+#      结果通过回调或 iter_results() 逐个返回；requests、tqdm、asyncio 等在首次使用时才导入，启动更快。
+#      配置是进程级的，同一进程中同时创建第二个未关闭的 Downloader 会抛出 RuntimeError。
+#  29. 【下载后处理】：--verify 在图片下载完成时就完整解码校验，损坏的图片删除后由调度器重新下载；
+#      --resize/--reencode 另存缩放或转码后的副本到 derived，--thumbnail 生成缩略图到 thumbnails（扩展模式下
+#      另拼出每个任务4张变体的2x2总览图）。下载时内容留在内存中直接交给独立的进程池（curl方式读取一次文件），
+#      SHA-256也一并算出；下载线程不等待处理完成，解码与缩放与网络下载同时进行（--postprocess-workers），
+#      无需事后再扫描一遍输出目录；需安装Pillow。
 #
 # 命令行参数说明:
 #   python MJ-CSV-DL.py [input_path] [output_dir] [选项]
@@ -41,7 +118,44 @@
 #     --check-curl          检查curl是否已安装
 #     --threads N, -t N     并行下载的线程数 (默认: 4)
 #     --extended            启用扩展模式下载多个图片（构造0_0至0_3）
-#     --method METHOD       选择下载方式，可选值：curl, browser, requests, urllib (默认: curl)
+#     --recursive, -r       处理目录时递归查找子目录中的CSV文件
+#     --watch               持续监视输入目录或文件，只下载新出现的CSV文件和新增的行，按 Ctrl+C 退出
+#     --watch-interval SEC  监视模式下轮询检查的间隔，安装watchdog后由文件系统事件触发 (默认: 10)
+#     --serve [HOST:]PORT   启动本地接收服务接收插件实时发送的记录，只需提供输出目录 (默认HOST: 127.0.0.1)
+#     --serve-token TOKEN   接收服务要求请求带上的令牌（X-MJ-Token），与插件设置中填写的令牌一致
+#     --method METHOD       选择下载方式，可选值：curl, browser, requests, urllib, async, h2 (默认: curl)
+#     --pool-size N         共享连接池中每个主机的最大连接数 (默认: 16)
+#     --task-page-ttl SEC   browser方式下任务页面cookie的缓存时间（秒），0表示不缓存 (默认: 600)
+#     --concurrency N       async方式下同时进行的最大请求数 (默认: 100)
+#     --h2-connections N   h2方式下HTTP/2连接数的上限 (默认: 2)
+#     --h2-streams N       h2方式下每个主机同时在途的流数上限 (默认: 100)
+#     --curl-batch N        curl方式下每次curl调用批量下载的图片数，0表示逐张调用 (默认: 32)
+#     --no-manifest         不使用输出目录中的下载清单，仅按文件是否存在判断是否跳过
+#     --content-store       启用内容寻址存储，相同内容的图片只下载和保存一次
+#     --output-format FMT   files: 每张图片保存为单独的图片和txt文件；shards: 打包为tar分片 (默认: files)
+#     --shard-size MB       分片输出时每个tar分片的大小上限 (默认: 1024)
+#     --index-format FMT    分片输出时元数据索引的格式，可选值：jsonl, parquet（需要pyarrow） (默认: jsonl)
+#     --processes N, -p N   下载使用的进程数，每个进程运行 --threads 个线程或async事件循环 (默认: 1)
+#     --partition i/N       只处理按任务ID哈希分成N份后的第i份（i从0开始），别名 --shard
+#     --lease-db PATH       多个工作进程共享的SQLite任务队列，按租约领取任务
+#     --worker-id NAME      共享任务队列中本进程的名称 (默认: 主机名-进程号)
+#     --lease-seconds SEC   任务租约的有效期，每1/3有效期续约一次 (默认: 120)
+#     --prefer-format FMT   首选的图片格式，可选值：png, webp, jpeg；该格式不存在时退回PNG (默认: png)
+#     --probe               扩展模式下先用HEAD请求探测变体是否存在，不存在的变体不再下载
+#     --missing-ttl DAYS    返回404/410的图片链接在多少天内不再请求，0表示不记录 (默认: 7)
+#     --adaptive            根据延迟和错误率自动调整并发数 (--threads/--concurrency 作为上限)
+#     --priority PATTERN=N  按CSV文件名通配符设置优先级，优先级高的先下载，可重复指定 (默认: 0)
+#     --interleave-variants 扩展模式下按CSV行顺序下载每个任务的全部变体，而不是先下载所有 _0
+#     --max-bandwidth RATE 全局下载带宽上限，如 10M、500K（不带单位按MB/s），0表示不限 (默认: 0)
+#     --host-rate R         每个主机每秒最多发起的请求数，0表示不限 (默认: 0)
+#     --verify              下载完成后完整解码校验图片，损坏的图片删除后重新下载（需要Pillow）
+#     --resize PX           另存一份最长边不超过PX像素的副本到输出目录的 derived 中，0表示不生成 (默认: 0)
+#     --reencode FMT[:Q]    派生图片的格式与质量，如 webp:85；单独使用时生成原尺寸的转码副本 (默认: 沿用原图格式)
+#     --thumbnail PX        生成最长边为PX像素的缩略图到 thumbnails，扩展模式下另拼出2x2总览图 (默认: 0)
+#     --postprocess-workers N 下载后处理使用的进程数，0表示CPU核数 (默认: 0)
+#     --quiet, -q           不打印逐张图片的信息，只显示进度条和汇总
+#     --metrics-log FILE    把每个任务的计时、字节数、重试次数和失败原因写入JSON Lines文件
+#     --metrics-report FILE 把运行结束时的指标汇总写入JSON文件
 #
 # 使用示例:
 #   1. 处理单个CSV文件（普通模式，生成 taskID_0.xxx）:
@@ -59,6 +173,18 @@
 #   5. 检查curl是否已安装:
 #      python MJ-CSV-DL.py --check-curl
 #
+#   6. 边抓取边下载（插件设置中填写 http://127.0.0.1:8787）:
+#      python MJ-CSV-DL.py path/to/output --serve 8787 --method async
+#
+#   7. 在其它Python程序中使用（需把本目录加入 sys.path 或 PYTHONPATH）:
+#      from mj_csv_dl import Downloader
+#      with Downloader("path/to/output", method="requests", threads=16, quiet=True) as downloader:
+#          for result in downloader.iter_results(downloader.tasks_from_csv("path/to/file.csv")):
+#              print(result["task_id"], result["success"])
+#
+#   8. 下载的同时校验图片并生成1024像素的webp训练副本和256像素的缩略图:
+#      python MJ-CSV-DL.py path/to/file.csv path/to/output --extended --resize 1024 --reencode webp:90 --thumbnail 256
+#
 # CSV文件格式要求:
 #   CSV文件必须包含以下字段:
 #   - 'Prompt': 文本提示内容
@@ -74,514 +200,12 @@
 #   3. 大量图片下载时建议使用多线程(--threads参数)提高效率
 #   4. 字段名区分大小写，但'任务id'和'任务ID'都被支持
 #   5. 如果保存的目录中已存在要下载的图片和文本文件，则自动略过不处理
+#   6. 删除输出目录中的 .mj_manifest.sqlite3 或使用 --no-manifest 可恢复为按文件是否存在判断
 # ========================================================================
 
-import os
-import csv
-import requests
-import argparse
-import random
-import traceback
-import time
-import urllib.request
-import subprocess
-import shutil
-import platform
-import sys
-import concurrent.futures
-from tqdm import tqdm
-from urllib.error import URLError, HTTPError
-from urllib.parse import urlparse
-
-def get_random_user_agent():
-    """返回一个随机的User-Agent字符串"""
-    user_agents = [
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:123.0) Gecko/20100101 Firefox/123.0",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:123.0) Gecko/20100101 Firefox/123.0",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Safari/605.1.15",
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0",
-    ]
-    return random.choice(user_agents)
-
-def get_browser_headers(url):
-    """返回模拟浏览器的请求头"""
-    parsed_url = urlparse(url)
-    domain = f"{parsed_url.scheme}://{parsed_url.netloc}"
-    headers = {
-        "User-Agent": get_random_user_agent(),
-        "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
-        "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Referer": domain,
-        "Cache-Control": "no-cache",
-        "Pragma": "no-cache",
-        "DNT": "1",
-        "Connection": "keep-alive",
-        "Sec-Fetch-Dest": "image",
-        "Sec-Fetch-Mode": "no-cors",
-        "Sec-Fetch-Site": "same-site",
-    }
-    return headers
-
-def get_extended_url(original_url, index):
-    """
-    根据原始图片链接构造扩展模式下的链接，
-    将链接中最后一个下划线后的数字替换为 index，
-    如：https://.../0_0.png 生成 https://.../0_1.png 等
-    """
-    base, ext = os.path.splitext(original_url)
-    pos = base.rfind('_')
-    if pos == -1:
-        return f"{base}_{index}{ext}"
-    else:
-        return f"{base[:pos+1]}{index}{ext}"
-
-def download_image_with_requests(url, save_path, max_retries=2):
-    """使用requests库下载图片"""
-    headers = get_browser_headers(url)
-    retry_count = 0
-    while retry_count <= max_retries:
-        try:
-            if retry_count > 0:
-                time.sleep(random.uniform(1.0, 3.0))
-            session = requests.Session()
-            parsed_url = urlparse(url)
-            domain = f"{parsed_url.scheme}://{parsed_url.netloc}"
-            session.get(domain, headers=headers, timeout=10)
-            response = session.get(url, headers=headers, stream=True, timeout=15)
-            response.raise_for_status()
-            content_type = response.headers.get('Content-Type', '')
-            if not content_type.startswith(('image/', 'application/octet-stream')):
-                print(f"警告: 响应不是图片类型 ({content_type}), 但仍尝试保存")
-            with open(save_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            print(f"成功下载图片(requests方式): {save_path}")
-            return True
-        except Exception as e:
-            retry_count += 1
-            if retry_count <= max_retries:
-                print(f"下载失败(requests方式), 重试 ({retry_count}/{max_retries}): {str(e)}")
-            else:
-                print(f"下载失败(requests方式), 已达最大重试次数: {str(e)}")
-                return False
-
-def download_image_with_urllib(url, save_path, max_retries=2):
-    """使用urllib库下载图片"""
-    headers = get_browser_headers(url)
-    retry_count = 0
-    while retry_count <= max_retries:
-        try:
-            if retry_count > 0:
-                time.sleep(random.uniform(1.0, 3.0))
-            req = urllib.request.Request(url, headers=headers)
-            with urllib.request.urlopen(req, timeout=15) as response:
-                if response.status != 200:
-                    raise HTTPError(url, response.status, "HTTP Error", response.headers, None)
-                content_type = response.headers.get('Content-Type', '')
-                if not content_type.startswith(('image/', 'application/octet-stream')):
-                    print(f"警告: 响应不是图片类型 ({content_type}), 但仍尝试保存")
-                with open(save_path, 'wb') as f:
-                    f.write(response.read())
-            print(f"成功下载图片(urllib方式): {save_path}")
-            return True
-        except Exception as e:
-            retry_count += 1
-            if retry_count <= max_retries:
-                print(f"下载失败(urllib方式), 重试 ({retry_count}/{max_retries}): {str(e)}")
-            else:
-                print(f"下载失败(urllib方式), 已达最大重试次数: {str(e)}")
-                return False
-
-def download_image_with_curl(url, save_path, max_retries=2):
-    """使用curl命令下载图片"""
-    curl_path = shutil.which("curl")
-    if not curl_path:
-        print("未找到curl命令，请安装curl后再试")
-        return False
-    headers = get_browser_headers(url)
-    retry_count = 0
-    user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
-    while retry_count <= max_retries:
-        try:
-            if retry_count > 0:
-                time.sleep(random.uniform(1.0, 3.0))
-            temp_file = f"{save_path}.tmp"
-            header_args = []
-            for key, value in headers.items():
-                if key != "User-Agent":
-                    header_args.extend(["-H", f"{key}: {value}"])
-            cmd = [curl_path, "-s", "-S", "--fail", "-L",
-                   "--connect-timeout", "15",
-                   "--max-time", "30",
-                   "-A", user_agent,
-                   "-o", temp_file] + header_args + [url]
-            if platform.system() == "Windows":
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                startupinfo.wShowWindow = 0
-                subprocess.run(cmd, startupinfo=startupinfo, check=True, stderr=subprocess.PIPE)
-            else:
-                subprocess.run(cmd, check=True, stderr=subprocess.PIPE)
-            if os.path.exists(temp_file) and os.path.getsize(temp_file) > 0:
-                if os.path.exists(save_path):
-                    os.remove(save_path)
-                os.rename(temp_file, save_path)
-                print(f"成功下载图片(curl方式): {save_path}")
-                return True
-            else:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-                raise Exception("下载文件为空")
-        except subprocess.CalledProcessError as e:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-            retry_count += 1
-            stderr = e.stderr.decode('utf-8', errors='replace') if e.stderr else ""
-            if retry_count <= max_retries:
-                print(f"下载失败(curl方式), 重试 ({retry_count}/{max_retries}): 错误码 {e.returncode}, {stderr}")
-            else:
-                print(f"下载失败(curl方式), 已达最大重试次数: 错误码 {e.returncode}, {stderr}")
-                return False
-        except Exception as e:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-            retry_count += 1
-            if retry_count <= max_retries:
-                print(f"下载失败(curl方式), 重试 ({retry_count}/{max_retries}): {str(e)}")
-            else:
-                print(f"下载失败(curl方式), 已达最大重试次数: {str(e)}")
-                return False
-
-def download_image_with_browser_simulation(image_url, task_url, save_path, max_retries=2):
-    """通过访问任务URL获取认证信息后下载图片"""
-    if not task_url:
-        print("无法使用浏览器模拟方式：缺少任务URL")
-        return False
-    print(f"尝试使用浏览器模拟方式下载: {image_url}")
-    print(f"通过任务链接: {task_url}")
-    headers = get_browser_headers(task_url)
-    retry_count = 0
-    while retry_count <= max_retries:
-        try:
-            if retry_count > 0:
-                time.sleep(random.uniform(1.5, 4.0))
-            session = requests.Session()
-            print("正在访问任务页面获取认证信息...")
-            task_response = session.get(task_url, headers=headers, timeout=15)
-            task_response.raise_for_status()
-            print("正在使用获取的认证信息下载图片...")
-            img_headers = get_browser_headers(image_url)
-            img_headers['Referer'] = task_url
-            response = session.get(image_url, headers=img_headers, stream=True, timeout=15)
-            response.raise_for_status()
-            content_type = response.headers.get('Content-Type', '')
-            if not content_type.startswith(('image/', 'application/octet-stream')):
-                print(f"警告: 响应不是图片类型 ({content_type}), 但仍尝试保存")
-            with open(save_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            print(f"成功下载图片(浏览器模拟方式): {save_path}")
-            return True
-        except Exception as e:
-            retry_count += 1
-            if retry_count <= max_retries:
-                print(f"下载失败(浏览器模拟方式), 重试 ({retry_count}/{max_retries}): {str(e)}")
-            else:
-                print(f"下载失败(浏览器模拟方式), 已达最大重试次数: {str(e)}")
-                return False
-
-def download_image(url, save_path, task_url=None, max_retries=2, method="curl"):
-    """根据用户选择的方式下载图片，不进行依次尝试"""
-    print(f"正在下载图片: {url}")
-    if method == "curl":
-        return download_image_with_curl(url, save_path, max_retries)
-    elif method == "browser":
-        return download_image_with_browser_simulation(url, task_url, save_path, max_retries)
-    elif method == "requests":
-        return download_image_with_requests(url, save_path, max_retries)
-    elif method == "urllib":
-        return download_image_with_urllib(url, save_path, max_retries)
-    else:
-        print("不支持的下载方式")
-        return False
-
-def download_worker(task):
-    """
-    线程工作函数，任务元组包含：
-    (image_url, image_path, task_url, task_id, prompt_text, extended_mode, method)
-    扩展模式下重试次数设置为1，其它模式下为2。
-    如果图片和文本文件已存在，则跳过处理；下载成功后写入对应的txt文件，下载失败则不生成txt。
-    """
-    image_url, image_path, task_url, task_id, prompt_text, extended_mode, download_method = task
-    txt_path = os.path.splitext(image_path)[0] + ".txt"
-    
-    # 检查图片和文本文件是否都已存在
-    if os.path.exists(image_path) and os.path.exists(txt_path):
-        print(f"跳过已存在的文件: {image_path} 和 {txt_path}")
-        return {"task_id": task_id, "image_url": image_url, "image_path": image_path, "success": True}
-    
-    
-    # 如果图片存在但文本文件不存在，仅生成文本文件
-    elif os.path.exists(image_path) and not os.path.exists(txt_path):
-        print(f"图片已存在，仅生成文本文件: {txt_path}")
-        try:
-            with open(txt_path, "w", encoding="utf-8") as f:
-                f.write(prompt_text)
-            print(f"成功保存Prompt文本: {txt_path}")
-        except Exception as e:
-            print(f"保存Prompt文本失败 ({task_id}): {str(e)}")
-        return {"task_id": task_id, "image_url": image_url, "image_path": image_path, "success": True}
-    
-    # 下载图片并生成文本文件
-    else:
-        retries = 1 if extended_mode else 2
-        success = download_image(image_url, image_path, task_url, max_retries=retries, method=download_method)
-        if success:
-            try:
-                with open(txt_path, "w", encoding="utf-8") as f:
-                    f.write(prompt_text)
-                print(f"成功保存Prompt文本: {txt_path}")
-            except Exception as e:
-                print(f"保存Prompt文本失败 ({task_id}): {str(e)}")
-        else:
-            if os.path.exists(txt_path):
-                os.remove(txt_path)
-            print(f"图片下载失败，未生成文本文件: {txt_path}")
-        return {"task_id": task_id, "image_url": image_url, "image_path": image_path, "success": success}
-
-
-def process_csv_file(csv_path, output_dir, num_threads=4, extended_mode=False, method="curl"):
-    """
-    处理单个CSV文件：
-      - 提取每行的任务ID、Prompt和图片链接
-      - 构造下载任务，文件命名统一为 <任务ID>_N.xxx（普通模式下N固定为0）
-      - 下载成功后在对应图片同名位置生成txt文件；下载失败则不生成txt文件
-    """
-    os.makedirs(output_dir, exist_ok=True)
-    try:
-        with open(csv_path, 'r', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile, quotechar='"', quoting=csv.QUOTE_ALL, skipinitialspace=True)
-            prompt_field = 'Prompt'
-            if prompt_field not in reader.fieldnames:
-                print(f"错误: CSV文件 {csv_path} 缺少必要字段 'Prompt'")
-                return
-            if '图片链接' not in reader.fieldnames:
-                print(f"错误: CSV文件 {csv_path} 缺少必要字段 '图片链接'")
-                return
-            task_id_field = '任务id' if '任务id' in reader.fieldnames else '任务ID'
-            if task_id_field not in reader.fieldnames:
-                print(f"错误: CSV文件 {csv_path} 缺少必要字段 '任务id' 或 '任务ID'")
-                return
-            task_url_field = '任务链接' if '任务链接' in reader.fieldnames else None
-            
-            rows = list(reader)
-            download_tasks = []
-            for i, row in enumerate(rows):
-                task_id = ''.join(c for c in row[task_id_field] if c.isalnum() or c in '._- ') or f"task_{i+1}"
-                prompt_text = row[prompt_field].strip()
-                image_url = row['图片链接'].strip()
-                task_url = row[task_url_field].strip() if task_url_field and task_url_field in row else None
-                if not image_url:
-                    continue
-                if extended_mode:
-                    for idx in range(4):
-                        new_task_id = f"{task_id}_{idx}"
-                        extended_image_url = get_extended_url(image_url, idx)
-                        image_path = os.path.join(output_dir, f"{new_task_id}.png")
-                        download_tasks.append((extended_image_url, image_path, task_url, new_task_id, prompt_text, True, method))
-                else:
-                    new_task_id = f"{task_id}_0"
-                    image_path = os.path.join(output_dir, f"{new_task_id}.png")
-                    download_tasks.append((image_url, image_path, task_url, new_task_id, prompt_text, False, method))
-            
-            total_tasks = len(download_tasks)
-            if total_tasks > 0:
-                with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-                    with tqdm(total=total_tasks, desc="下载进度", unit="张") as progress_bar:
-                        future_to_task = {executor.submit(download_worker, task): i for i, task in enumerate(download_tasks)}
-                        successful_downloads = 0
-                        for future in concurrent.futures.as_completed(future_to_task):
-                            result = future.result()
-                            if result["success"]:
-                                successful_downloads += 1
-                            progress_bar.update(1)
-                print(f"\n图片下载完成: 成功 {successful_downloads}/{total_tasks} 张")
-            else:
-                print("没有找到需要下载的图片链接")
-    except Exception as e:
-        print(f"处理CSV文件时出错: {str(e)}")
-
-def process_directory(input_dir, output_dir, num_threads=4, extended_mode=False, method="curl"):
-    """处理目录中的所有CSV文件"""
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith('.csv'):
-            csv_path = os.path.join(input_dir, filename)
-            print(f"\n正在处理: {csv_path}")
-            process_csv_file(csv_path, output_dir, num_threads, extended_mode, method)
-
-def process_input(input_path, output_dir, num_threads=4, extended_mode=False, method="curl"):
-    """根据输入路径类型处理文件或目录"""
-    if os.path.isfile(input_path) and input_path.lower().endswith('.csv'):
-        process_csv_file(input_path, output_dir, num_threads, extended_mode, method)
-    elif os.path.isdir(input_path):
-        process_directory(input_path, output_dir, num_threads, extended_mode, method)
-    else:
-        print("错误: 输入路径不是CSV文件也不是目录！")
-        
-        
-def main_interactive():
-    """交互式模式的主函数"""
-    print("=" * 80)
-    print("MJ CSV下载工具 - 交互模式")
-    print("=" * 80)
-    print("\n完整使用提示：")
-    print("  脚本用途:")
-    print("    该脚本用于处理包含Midjourney任务数据的CSV文件，提取并保存文本提示(Prompt)为txt文件，")
-    print("    同时下载相应的图片。支持单个CSV文件处理和批量目录处理。")
-    print("\n  主要功能:")
-    print("    1. 从CSV提取Prompt文本并保存为txt文件，文件命名统一采用扩展模式的命名方式（例如 任务ID_0.txt）")
-    print("    2. 下载CSV中的图片链接指向的图片，图片文件名与文本文件对应（例如 任务ID_0.png）")
-    print("    3. 支持单个CSV文件或整个目录的批量处理")
-    print("    4. 支持多线程并行下载，提高处理速度")
-    print("    5. 提供四种下载方式供用户选择（默认使用curl方式），用户可通过参数或交互提示选择方式")
-    print("    6. 【扩展模式】：在扩展模式下，每个任务构造0_0至0_3四个下载任务（命名如 taskID_0、taskID_1...），")
-    print("       如果某个图片下载失败，则对应的txt文件不生成；扩展模式下最多重试1次，普通模式下重试2次。")
-    print("    7. 【优化】：如果保存的目录中已存在要下载的图片和文本文件，则自动略过不处理。")
-    print("\n  使用步骤：")
-    print("    1. 输入CSV文件路径或目录路径")
-    print("    2. 输入文件保存目录")
-    print("    3. 选择是否启用扩展模式（下载多个图片）")
-    print("    4. 选择下载方式（curl, browser, requests, urllib）")
-    print("\n  CSV文件格式要求:")
-    print("    CSV文件必须包含以下字段:")
-    print("    - 'Prompt': 文本提示内容")
-    print("    - '任务id'或'任务ID': 用于文件命名的任务标识符")
-    print("    - '图片链接': 要下载的图片URL")
-    print("    可选字段:")
-    print("    - '任务链接': 任务页面URL，用于增强图片下载功能")
-    print("\n  注意事项:")
-    print("    1. 扩展模式下针对下载失败的图片最多重试1次，且下载失败时不生成对应的txt文件")
-    print("    2. 普通模式下下载失败最多重试2次")
-    print("    3. 大量图片下载时建议使用多线程（默认4个线程）提高效率")
-    print("    4. 字段名区分大小写，但'任务id'和'任务ID'都被支持")
-    print("    5. 如果保存的目录中已存在要下载的图片和文本文件，则自动略过不处理")
-    print("=" * 80)
-    while True:
-        input_path = input("请输入CSV文件路径或目录路径: ").strip()
-        if os.path.exists(input_path):
-            break
-        print("路径不存在，请重新输入！")
-    while True:
-        output_dir = input("请输入文件保存目录: ").strip()
-        try:
-            os.makedirs(output_dir, exist_ok=True)
-            break
-        except Exception as e:
-            print(f"无法创建目录: {str(e)}，请重新输入！")
-    
-    ext_input = input("是否启用扩展模式（下载多个图片）？(y/n 默认n): ").strip().lower()
-    extended_mode = ext_input == 'y'
-    
-    print("\n请选择下载方式：")
-    print("  1. curl      (使用 curl 命令下载，默认)")
-    print("  2. browser   (通过浏览器模拟方式下载)")
-    print("  3. requests  (使用 Python requests 库下载)")
-    print("  4. urllib    (使用 Python urllib 库下载)")
-    method_input = input("请输入对应的方式 (可直接输入名称或数字，默认: curl): ").strip().lower()
-    if method_input in ["", "1", "curl"]:
-        download_method = "curl"
-    elif method_input in ["2", "browser"]:
-        download_method = "browser"
-    elif method_input in ["3", "requests"]:
-        download_method = "requests"
-    elif method_input in ["4", "urllib"]:
-        download_method = "urllib"
-    else:
-        print("输入不合法，默认使用 curl")
-        download_method = "curl"
-    
-    process_input(input_path, output_dir, 4, extended_mode, download_method)
-
-def test_download_image(url, output_dir=None, task_url=None):
-    """测试下载单个图片URL功能"""
-    if not output_dir:
-        output_dir = os.path.join(os.getcwd(), "test_images")
-    os.makedirs(output_dir, exist_ok=True)
-    parsed_url = urlparse(url)
-    file_name = os.path.basename(parsed_url.path)
-    if not file_name:
-        file_name = f"test_image_{int(time.time())}.png"
-    if not os.path.splitext(file_name)[1]:
-        file_name += ".png"
-    save_path = os.path.join(output_dir, file_name)
-    print(f"测试下载图片: {url}")
-    if task_url:
-        print(f"使用任务URL: {task_url}")
-    print(f"保存路径: {save_path}")
-    result = download_image(url, save_path)
-    if result:
-        print("✅ 测试成功: 图片已成功下载")
-    else:
-        print("❌ 测试失败: 无法下载图片")
-    return result
-
-def check_curl_installation():
-    """检查curl是否已安装"""
-    curl_path = shutil.which("curl")
-    if curl_path:
-        print(f"✅ curl已安装: {curl_path}")
-        return True
-    else:
-        print("❌ curl未安装。建议安装curl以提高下载成功率。")
-        if platform.system() == "Windows":
-            print("  Windows安装方法: 例如使用Chocolatey: choco install curl")
-        elif platform.system() == "Darwin":
-            print("  macOS安装方法: brew install curl")
-        elif platform.system() == "Linux":
-            print("  Linux安装方法: sudo apt-get install curl 或 sudo yum install curl")
-        return False
+# 实现位于同目录的 mj_csv_dl 包中，本脚本只是命令行入口（python -m mj_csv_dl 与之等价）
 
-def main():
-    """命令行模式的主函数"""
-    parser = argparse.ArgumentParser(description="MJ CSV下载工具 - 处理CSV数据并下载图片")
-    parser.add_argument('input_path', nargs='?', help='CSV文件或目录路径')
-    parser.add_argument('output_dir', nargs='?', help='文件保存目录')
-    parser.add_argument('--test-url', help='测试下载单个图片URL')
-    parser.add_argument('--test-task-url', help='测试下载时使用的任务URL（用于浏览器模拟下载）')
-    parser.add_argument('--test-output', help='测试下载图片的保存目录')
-    parser.add_argument('--check-curl', action='store_true', help='检查curl是否已安装')
-    parser.add_argument('--threads', '-t', type=int, default=4, help='并行下载的线程数 (默认: 4)')
-    parser.add_argument('--interactive', action='store_true', help='使用交互式模式运行脚本')
-    parser.add_argument('--extended', action='store_true', help='启用扩展模式下载多个图片（构造0_0至0_3）')
-    parser.add_argument('--method', choices=["curl", "browser", "requests", "urllib"], default="curl",
-                        help='选择下载方式 (默认: curl)')
-    args = parser.parse_args()
-    
-    if args.check_curl:
-        check_curl_installation()
-        return
-    if args.test_url:
-        test_download_image(args.test_url, args.test_output, args.test_task_url)
-    elif args.interactive:
-        main_interactive()
-    elif args.input_path and args.output_dir:
-        input_path = args.input_path.strip()
-        output_dir = args.output_dir.strip()
-        if not os.path.exists(input_path):
-            print(f"错误: 输入路径 '{input_path}' 不存在！")
-            return
-        try:
-            os.makedirs(output_dir, exist_ok=True)
-        except Exception as e:
-            print(f"错误: 无法创建输出目录 '{output_dir}': {str(e)}")
-            return
-        process_input(input_path, output_dir, args.threads, args.extended, args.method)
-    else:
-        print("没有提供足够的命令行参数，默认进入交互模式...\n")
-        main_interactive()
+from mj_csv_dl.cli import main
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,594 @@
+# ========================================================================
+# MJ-CSV-基准测试.py - MJ CSV下载工具的性能基准测试
+# ========================================================================
+# 脚本用途:
+#   在本机启动一个模拟图片CDN，生成与Chrome插件导出格式一致的CSV，
+#   然后用不同的下载方式和线程数运行 MJ-CSV-下载脚本.py，对比各方式的吞吐与资源占用。
+#   全程不访问真实CDN，结果可重复。
+#
+# 模拟CDN:
+#   - /<任务ID>/0_N.png 或 .webp 返回可完整解码的合成图片（随机像素，PNG由zlib生成，WebP需安装Pillow，
+#     未安装时 .webp 返回404），大小在给定范围内按任务固定，可用于 --verify 等下载后处理的测试
+#     图片带强ETag并支持 Range 续传，If-Range 与ETag不一致时返回完整内容
+#   - /jobs/<任务ID> 返回一个带cookie的小HTML页面（供browser方式使用）
+#   - 每个任务只有前 --variants 张图片存在，其余返回404（模拟扩展模式下不存在的变体）
+#   - 可配置响应延迟、错误率(500)和限流比例(429 + Retry-After)
+#   - --methods 包含 h2 时另外启动一个HTTP/2（h2c）版本的模拟CDN，h2方式的CSV指向它（需安装h2）
+#
+# 输出指标（每种下载方式 × 线程数）:
+#   成功图片数、耗时、图片/秒、MB/秒、服务端记录的请求延迟p50/p99、下载进程的峰值内存(RSS)
+#
+# 命令行参数说明:
+#   python MJ-CSV-基准测试.py [选项]
+#
+#   可选参数:
+#     --rows N              生成的CSV行数 (默认: 200)
+#     --methods LIST        逗号分隔的下载方式 (默认: curl,requests,urllib)
+#     --threads LIST        逗号分隔的线程数 (默认: 4,16)
+#     --extended            以扩展模式运行（每行4张图片）
+#     --variants N          每个任务实际存在的图片数 (默认: 4)
+#     --format FMT          CSV中图片链接的格式 png 或 webp (默认: png)
+#     --latency-ms MS       每个请求的基础延迟 (默认: 30)
+#     --jitter-ms MS        延迟的随机抖动范围 (默认: 20)
+#     --size-kb MIN-MAX     图片大小范围 (默认: 200-1200)
+#     --error-rate P        返回500的概率 (默认: 0)
+#     --throttle-rate P     返回429的概率 (默认: 0)
+#     --retry-after S       429响应中的 Retry-After 秒数 (默认: 1)
+#     --extra-args ARGS     传给下载脚本的其它参数，例如 "--adaptive --host-rate 200"
+#     --json PATH           把结果另存为JSON
+#     --h2-port PORT        HTTP/2模拟CDN的监听端口 (默认: 随机)
+#     --serve               只启动模拟CDN并打印地址，按 Ctrl+C 退出（可配合手动测试）
+#
+# 使用示例:
+#   python MJ-CSV-基准测试.py --rows 500 --methods curl,requests,async --threads 8,32
+#   python MJ-CSV-基准测试.py --extended --variants 2 --throttle-rate 0.05 --extra-args "--adaptive"
+#   python MJ-CSV-基准测试.py --methods requests,h2 --threads 8,64 --extra-args "--pool-size 8"
+# ========================================================================
+
+import os
+import sys
+import csv
+import io
+import hashlib
+import functools
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import asyncio
+import threading
+import subprocess
+import statistics
+import struct
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DOWNLOADER_SCRIPT = os.path.join(SCRIPT_DIR, "MJ-CSV-下载脚本.py")
+CSV_FIELDS = ['Prompt', 'Prompt 参数', '任务ID', '任务链接', '图片链接', '用户名', '用户ID', '用户主页', '其他信息']
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PAYLOAD_WIDTH = 256
+_random_pool = os.urandom(4 * 1024 * 1024)
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def encode_png(width, height, pixels):
+    """把RGB像素编码为PNG（不压缩的deflate块，随机像素本来也压缩不了，文件大小与像素数据一致）"""
+    stride = width * 3
+    raw = b"".join(b"\x00" + pixels[row * stride:(row + 1) * stride] for row in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (PNG_SIGNATURE + _png_chunk(b"IHDR", header) + _png_chunk(b"IDAT", zlib.compress(raw, 0))
+            + _png_chunk(b"IEND", b""))
+
+
+@functools.lru_cache(maxsize=32)
+def build_payload(path, fmt, min_size, max_size):
+    """
+    根据路径生成大小约为给定范围内某个固定值的合成图片（随机像素，可完整解码），同一路径每次返回相同内容；
+    最近生成的图片缓存起来，重试与续传请求不必重新编码
+    """
+    rng = random.Random(path)
+    size = rng.randint(min_size, max_size)
+    offset = rng.randint(0, len(_random_pool) - 1)
+    height = max(1, size // (PAYLOAD_WIDTH * 3))
+    length = PAYLOAD_WIDTH * height * 3
+    pixels = (_random_pool[offset:] + _random_pool[:offset])[:length]
+    if len(pixels) < length:
+        pixels = (pixels * (length // len(pixels) + 1))[:length]
+    if fmt == "webp":
+        image = Image.frombytes("RGB", (PAYLOAD_WIDTH, height), pixels)
+        output = io.BytesIO()
+        # 无损、最快的编码方式：随机像素的无损WebP与原始像素数据大小相近
+        image.save(output, "WEBP", lossless=True, quality=0, method=0)
+        return output.getvalue()
+    return encode_png(PAYLOAD_WIDTH, height, pixels)
+
+
+class MockCDNConfig:
+    """模拟CDN的行为配置"""
+
+    def __init__(self, latency_ms=30, jitter_ms=20, min_size=200 * 1024, max_size=1200 * 1024,
+                 error_rate=0.0, throttle_rate=0.0, retry_after=1, variants=4):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.min_size = min_size
+        self.max_size = max_size
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.variants = variants
+
+
+class MockCDNServer(ThreadingHTTPServer):
+    """本地模拟图片CDN，记录每个图片请求的处理耗时与状态码"""
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, config):
+        super().__init__(address, MockCDNHandler)
+        self.config = config
+        self.stats_lock = threading.Lock()
+        self.records = []
+
+    def handle_error(self, request, client_address):
+        # 客户端提前断开连接（超时、取消）属于正常情况，不打印堆栈
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def record(self, status, latency, size):
+        with self.stats_lock:
+            self.records.append((status, latency, size))
+
+    def take_records(self):
+        with self.stats_lock:
+            records, self.records = self.records, []
+        return records
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class MockCDNHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None, head_only=False):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and not head_only:
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._handle(head_only=True)
+
+    def do_GET(self):
+        self._handle(head_only=False)
+
+    def _handle(self, head_only):
+        started = time.perf_counter()
+        status, body, headers, delay, is_image = build_mock_response(self.server.config, self.path,
+                                                                     self.headers.get("Range"),
+                                                                     self.headers.get("If-Range"))
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            self._send(status, body, headers, head_only)
+        finally:
+            if is_image:
+                self.server.record(status, time.perf_counter() - started, 0 if head_only else len(body))
+
+
+def build_mock_response(config, path, range_header=None, if_range=None):
+    """
+    按模拟CDN的配置生成响应，HTTP/1.1与h2服务器共用。
+    图片带强ETag；Range 请求的 If-Range 与ETag不一致时返回完整内容（200）。
+    返回 (状态码, 响应体, 响应头, 延迟秒数, 是否为图片请求)，延迟由调用方等待
+    """
+    path = path.split("?", 1)[0]
+    if path.startswith("/jobs/"):
+        return (200, b"<html><body>job</body></html>",
+                {"Content-Type": "text/html", "Set-Cookie": "mj_session=bench; Path=/"}, 0.0, False)
+    name, ext = os.path.splitext(os.path.basename(path))
+    if ext not in (".png", ".webp") or (ext == ".webp" and Image is None):
+        return 404, b"", {}, 0.0, False
+    delay = max(0.0, config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)) / 1000.0
+    try:
+        variant = int(name.rsplit("_", 1)[-1])
+    except ValueError:
+        variant = 0
+    roll = random.random()
+    if variant >= config.variants:
+        status, body, headers = 404, b"", {}
+    elif roll < config.throttle_rate:
+        status, body, headers = 429, b"", {"Retry-After": str(config.retry_after)}
+    elif roll < config.throttle_rate + config.error_rate:
+        status, body, headers = 500, b"", {}
+    else:
+        fmt = ext[1:]
+        status = 200
+        body = build_payload(path, fmt, config.min_size, config.max_size)
+        headers = {"Content-Type": f"image/{fmt}", "ETag": '"%s"' % hashlib.sha1(body).hexdigest()[:16]}
+    if (status == 200 and range_header and range_header.startswith("bytes=")
+            and if_range in (None, headers["ETag"])):
+        start = int(range_header[6:].split("-", 1)[0] or 0)
+        if start < len(body):
+            headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+            body = body[start:]
+            status = 206
+    headers["Accept-Ranges"] = "bytes"
+    return status, body, headers, delay, True
+
+
+class H2MockCDNProtocol(asyncio.Protocol):
+    """
+    模拟CDN的HTTP/2（h2c，prior knowledge）连接：每个流独立处理，
+    响应体按对方的流量控制窗口分帧发送，窗口用尽时等待 WINDOW_UPDATE
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        self.transport = None
+        self.outgoing = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.local_settings = h2.settings.Settings(
+            client=False, initial_values={h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: self.server.max_streams})
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                asyncio.ensure_future(self._respond(event.stream_id, dict(event.headers)))
+            elif isinstance(event, h2.events.DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.WindowUpdated):
+                self._flush()
+            elif isinstance(event, h2.events.StreamReset):
+                self.outgoing.pop(event.stream_id, None)
+        self.transport.write(self.conn.data_to_send())
+
+    def connection_lost(self, exc):
+        self.outgoing.clear()
+
+    async def _respond(self, stream_id, headers):
+        started = time.perf_counter()
+        status, body, response_headers, delay, is_image = build_mock_response(
+            self.server.config, headers.get(":path", "/"), headers.get("range"), headers.get("if-range"))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.transport.is_closing():
+            return
+        head_only = headers.get(":method") == "HEAD"
+        response_headers = [(":status", str(status)), ("content-length", str(len(body)))] + \
+            [(key.lower(), value) for key, value in response_headers.items()]
+        try:
+            self.conn.send_headers(stream_id, response_headers, end_stream=head_only or not body)
+        except h2.exceptions.StreamClosedError:
+            return
+        if body and not head_only:
+            self.outgoing[stream_id] = (memoryview(body), 0)
+            self._flush()
+        self.transport.write(self.conn.data_to_send())
+        if is_image:
+            self.server.record(status, time.perf_counter() - started, 0 if head_only else len(body))
+
+    def _flush(self):
+        """在流量控制窗口允许的范围内继续发送各个流的响应体"""
+        for stream_id, (body, sent) in list(self.outgoing.items()):
+            try:
+                while sent < len(body):
+                    size = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size,
+                               len(body) - sent)
+                    if size <= 0:
+                        break
+                    self.conn.send_data(stream_id, body[sent:sent + size])
+                    sent += size
+                if sent < len(body):
+                    self.outgoing[stream_id] = (body, sent)
+                    continue
+                self.conn.end_stream(stream_id)
+            except h2.exceptions.StreamClosedError:
+                pass
+            self.outgoing.pop(stream_id, None)
+        self.transport.write(self.conn.data_to_send())
+
+
+class H2MockCDNServer:
+    """HTTP/2版本的模拟CDN（h2c，需安装h2），在后台线程的事件循环中运行，接口与 MockCDNServer 相同"""
+
+    def __init__(self, address, config, max_streams=100):
+        self.config = config
+        self.max_streams = max_streams
+        self.stats_lock = threading.Lock()
+        self.records = []
+        self.loop = asyncio.new_event_loop()
+        self._server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: H2MockCDNProtocol(self), address[0], address[1]))
+        self.server_address = self._server.sockets[0].getsockname()
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    record = MockCDNServer.record
+    take_records = MockCDNServer.take_records
+    base_url = MockCDNServer.base_url
+
+
+def start_mock_cdn(config, host="127.0.0.1", port=0, http2=False):
+    """在后台线程中启动模拟CDN（http2为True时启动h2c版本），返回服务器对象"""
+    server = H2MockCDNServer((host, port), config) if http2 else MockCDNServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def generate_csv(path, rows, base_url, fmt="png"):
+    """生成与插件导出格式一致的CSV（带BOM）"""
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDS)
+        for i in range(rows):
+            job_id = str(uuid.UUID(int=random.Random(i).getrandbits(128)))
+            writer.writerow([
+                f"benchmark prompt {i}, synthetic scene",
+                "--ar 1:1 --v 6",
+                job_id,
+                f"{base_url}/jobs/{job_id}",
+                f"{base_url}/{job_id}/0_0.{fmt}",
+                "bench_user",
+                "bench_uid",
+                f"{base_url}/users/bench_uid",
+                "",
+            ])
+
+
+def percentile(values, pct):
+    """计算百分位数（最近秩法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+OUTPUT_SKIP_SUFFIXES = (".txt", ".tmp", ".hdr", ".validator", ".part")
+
+
+def count_output(output_dir):
+    """统计输出目录中的图片数量与总字节数（不含txt、下载中的临时文件、元数据索引与隐藏文件）"""
+    images = 0
+    total_bytes = 0
+    for name in os.listdir(output_dir):
+        if name.startswith((".", "metadata.")) or name.endswith(OUTPUT_SKIP_SUFFIXES):
+            continue
+        path = os.path.join(output_dir, name)
+        if os.path.isfile(path):
+            images += 1
+            total_bytes += os.path.getsize(path)
+    return images, total_bytes
+
+
+def _read_peak_rss(pid):
+    """读取Linux下进程的峰值RSS（/proc/<pid>/status 中的VmHWM），单位字节"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def run_downloader(csv_path, output_dir, method, threads, extended=False, extra_args=None):
+    """
+    运行下载脚本，返回 (耗时秒数, 峰值RSS字节数或None, 退出码)。
+    Linux下轮询VmHWM（exec之后重新计数，不受本进程内存影响）；其它系统使用 wait4 的 ru_maxrss。
+    """
+    cmd = [sys.executable, DOWNLOADER_SCRIPT, csv_path, output_dir, "--method", method, "--threads", str(threads)]
+    if extended:
+        cmd.append("--extended")
+    cmd.extend(extra_args or [])
+    started = time.perf_counter()
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    peak_rss = None
+    if os.path.exists(f"/proc/{process.pid}/status"):
+        while process.poll() is None:
+            peak_rss = _read_peak_rss(process.pid) or peak_rss
+            time.sleep(0.1)
+    elif hasattr(os, "wait4") and resource is not None:
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # Linux下ru_maxrss单位为KB，macOS下为字节
+        peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    else:
+        process.wait()
+    return time.perf_counter() - started, peak_rss, process.returncode
+
+
+def run_benchmark(server, csv_path, methods, thread_counts, extended=False, extra_args=None, h2_target=None):
+    """
+    对每种下载方式和线程数各运行一次，返回结果列表；
+    h2方式使用 h2_target 指定的 (HTTP/2模拟CDN, 指向它的CSV)
+    """
+    results = []
+    default_server, default_csv_path = server, csv_path
+    for method in methods:
+        server, csv_path = h2_target if method == "h2" and h2_target else (default_server, default_csv_path)
+        for threads in thread_counts:
+            output_dir = tempfile.mkdtemp(prefix=f"mj-bench-{method}-{threads}-")
+            try:
+                server.take_records()
+                elapsed, peak_rss, returncode = run_downloader(csv_path, output_dir, method, threads,
+                                                               extended, extra_args)
+                records = server.take_records()
+                images, total_bytes = count_output(output_dir)
+            finally:
+                shutil.rmtree(output_dir, ignore_errors=True)
+            latencies = [latency for status, latency, _ in records if status in (200, 206)]
+            result = {
+                "method": method,
+                "threads": threads,
+                "returncode": returncode,
+                "images": images,
+                "requests": len(records),
+                "throttled": sum(1 for status, _, _ in records if status == 429),
+                "errors": sum(1 for status, _, _ in records if status >= 500),
+                "elapsed": elapsed,
+                "images_per_sec": images / elapsed if elapsed > 0 else 0.0,
+                "mb_per_sec": total_bytes / elapsed / (1024 * 1024) if elapsed > 0 else 0.0,
+                "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+                "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+                "mean_ms": statistics.mean(latencies) * 1000 if latencies else None,
+                "peak_rss_mb": peak_rss / (1024 * 1024) if peak_rss else None,
+            }
+            results.append(result)
+            print_result_row(result)
+    return results
+
+
+def _fmt(value, spec):
+    return format(value, spec) if value is not None else "-"
+
+
+def print_result_header():
+    print(f"{'方式':<10}{'线程':>6}{'成功图片':>10}{'请求':>8}{'429':>6}{'5xx':>6}{'耗时(s)':>10}"
+          f"{'图片/s':>10}{'MB/s':>9}{'p50(ms)':>10}{'p99(ms)':>10}{'峰值RSS(MB)':>13}")
+
+
+def print_result_row(result):
+    print(f"{result['method']:<10}{result['threads']:>6}{result['images']:>10}{result['requests']:>8}"
+          f"{result['throttled']:>6}{result['errors']:>6}{result['elapsed']:>10.2f}"
+          f"{result['images_per_sec']:>10.1f}{result['mb_per_sec']:>9.1f}"
+          f"{_fmt(result['p50_ms'], '>10.1f')}{_fmt(result['p99_ms'], '>10.1f')}"
+          f"{_fmt(result['peak_rss_mb'], '>13.1f')}")
+
+
+def parse_size_range(value):
+    """解析 "MIN-MAX"（单位KB）为字节数"""
+    low, _, high = value.partition("-")
+    low_kb = int(low)
+    high_kb = int(high) if high else low_kb
+    return low_kb * 1024, max(low_kb, high_kb) * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MJ CSV下载工具 - 本地模拟CDN基准测试")
+    parser.add_argument('--rows', type=int, default=200, help='生成的CSV行数 (默认: 200)')
+    parser.add_argument('--methods', default="curl,requests,urllib", help='逗号分隔的下载方式 (默认: curl,requests,urllib)')
+    parser.add_argument('--threads', default="4,16", help='逗号分隔的线程数 (默认: 4,16)')
+    parser.add_argument('--extended', action='store_true', help='以扩展模式运行（每行4张图片）')
+    parser.add_argument('--variants', type=int, default=4, help='每个任务实际存在的图片数 (默认: 4)')
+    parser.add_argument('--format', choices=["png", "webp"], default="png", help='CSV中图片链接的格式 (默认: png)')
+    parser.add_argument('--latency-ms', type=float, default=30, help='每个请求的基础延迟 (默认: 30)')
+    parser.add_argument('--jitter-ms', type=float, default=20, help='延迟的随机抖动范围 (默认: 20)')
+    parser.add_argument('--size-kb', default="200-1200", help='图片大小范围，单位KB (默认: 200-1200)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回500的概率 (默认: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='返回429的概率 (默认: 0)')
+    parser.add_argument('--retry-after', type=int, default=1, help='429响应中的 Retry-After 秒数 (默认: 1)')
+    parser.add_argument('--extra-args', default="", help='传给下载脚本的其它参数')
+    parser.add_argument('--json', help='把结果另存为JSON')
+    parser.add_argument('--port', type=int, default=0, help='模拟CDN监听端口 (默认: 随机)')
+    parser.add_argument('--h2-port', type=int, default=0, help='HTTP/2模拟CDN监听端口，methods包含h2时启动 (默认: 随机)')
+    parser.add_argument('--serve', action='store_true', help='只启动模拟CDN，按 Ctrl+C 退出')
+    args = parser.parse_args()
+    if args.format == "webp" and Image is None:
+        print("WebP格式的模拟图片需要安装Pillow（pip install Pillow）")
+        return
+
+    min_size, max_size = parse_size_range(args.size_kb)
+    config = MockCDNConfig(args.latency_ms, args.jitter_ms, min_size, max_size,
+                           args.error_rate, args.throttle_rate, args.retry_after, args.variants)
+    server = start_mock_cdn(config, port=args.port)
+    print(f"模拟CDN已启动: {server.base_url}")
+    methods = [m.strip() for m in args.methods.split(",") if m.strip()]
+    h2_server = None
+    if "h2" in methods:
+        if h2 is None:
+            print("h2方式的基准测试需要安装h2（pip install \"httpx[http2]\"），跳过h2")
+            methods.remove("h2")
+        else:
+            h2_server = start_mock_cdn(config, port=args.h2_port, http2=True)
+            print(f"HTTP/2模拟CDN已启动（h2c）: {h2_server.base_url}")
+
+    work_dir = tempfile.mkdtemp(prefix="mj-bench-")
+    try:
+        csv_path = os.path.join(work_dir, "MJ-bench.csv")
+        generate_csv(csv_path, args.rows, server.base_url, args.format)
+        h2_target = None
+        if h2_server is not None:
+            h2_csv_path = os.path.join(work_dir, "MJ-bench-h2.csv")
+            generate_csv(h2_csv_path, args.rows, h2_server.base_url, args.format)
+            h2_target = (h2_server, h2_csv_path)
+        if args.serve:
+            print(f"示例CSV: {csv_path}")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                return
+        thread_counts = [int(t) for t in args.threads.split(",") if t.strip()]
+        print(f"CSV行数: {args.rows}，扩展模式: {'是' if args.extended else '否'}，"
+              f"图片大小: {args.size_kb}KB，延迟: {args.latency_ms}±{args.jitter_ms}ms\n")
+        print_result_header()
+        results = run_benchmark(server, csv_path, methods, thread_counts, args.extended, args.extra_args.split(),
+                                h2_target)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"config": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+            print(f"\n结果已保存: {args.json}")
+    finally:
+        server.shutdown()
+        if h2_server is not None:
+            h2_server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
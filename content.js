@@ -22,6 +22,14 @@ function createSettingsPanel() {
             <label for="scrollDelay">滚动延迟(毫秒) 使用上下键可调整:</label>
             <input type="number" id="scrollDelay" min="100" max="5000" step="100" value="${localStorage.getItem('scrollDelay') || 1000}">
         </div>
+        <div class="setting-item">
+            <label for="ingestUrl">实时发送到下载脚本(--serve)，留空不发送:</label>
+            <input type="text" id="ingestUrl" placeholder="http://127.0.0.1:8787" value="${localStorage.getItem('ingestUrl') || ''}">
+        </div>
+        <div class="setting-item">
+            <label for="ingestToken">接收服务令牌(--serve-token)，未设置时留空:</label>
+            <input type="password" id="ingestToken" value="${localStorage.getItem('ingestToken') || ''}">
+        </div>
         <div class="settings-footer">
             <button id="saveSettings" class="save-button">
                 保存设置
@@ -34,6 +42,8 @@ function createSettingsPanel() {
     document.getElementById('saveSettings').addEventListener('click', () => {
         const delay = document.getElementById('scrollDelay').value;
         localStorage.setItem('scrollDelay', delay);
+        localStorage.setItem('ingestUrl', document.getElementById('ingestUrl').value.trim());
+        localStorage.setItem('ingestToken', document.getElementById('ingestToken').value.trim());
         panel.style.display = 'none';
     });
 
@@ -342,6 +352,20 @@ async function scrollAndScrape(checkActive) {
     
     const scrapedData = [];
     const seenIds = new Set();
+    let scrapedCount = 0;
+    // 接收服务确认收到的记录已写入 ingest-日期.csv，从列表和页面中移除，长时间抓取时内存不随记录数增长
+    const ingestSender = createIngestSender(items => {
+        const acknowledged = new Set(items);
+        const remaining = scrapedData.filter(item => !acknowledged.has(item));
+        scrapedData.length = 0;
+        scrapedData.push(...remaining);
+        for (const item of items) {
+            const checkbox = contentDiv.querySelector(`.select-item[data-id="${CSS.escape(item.jobId)}"]`);
+            if (checkbox) {
+                checkbox.closest('.result-item').remove();
+            }
+        }
+    });
     
     let lastHeight = 0;
     let sameHeightCount = 0;
@@ -458,9 +482,11 @@ async function scrollAndScrape(checkActive) {
                             promptParams,
                             metadata: ''
                         });
+                        scrapedCount++;
                         resultDiv.querySelector('.status-text').textContent = 
-                            `正在抓取中...（已抓取 ${scrapedData.length} 张不重复图片）`;
+                            `正在抓取中...（已抓取 ${scrapedCount} 张不重复图片）`;
                         updateResultDisplay(scrapedData, contentDiv, true);
+                        ingestSender.add(scrapedData[scrapedData.length - 1]);
                     }
                 }
             } catch (error) {
@@ -496,7 +522,7 @@ async function scrollAndScrape(checkActive) {
                     scrapeButton.title = '开始抓取';
                     scrapeButton.classList.remove('scraping');
                     resultDiv.querySelector('.status-text').textContent = 
-                        `抓取完成（共抓取 ${scrapedData.length} 张不重复图片）`;
+                        `抓取完成（共抓取 ${scrapedCount} 张不重复图片）`;
                 }
                 break;
             }
@@ -513,13 +539,92 @@ async function scrollAndScrape(checkActive) {
         button.querySelector('.icon-search').style.display = 'block';
         button.querySelector('.icon-stop').style.display = 'none';
         resultDiv.querySelector('.status-text').textContent = 
-            `抓取完成（共抓取 ${scrapedData.length} 张不重复图片）`;
+            `抓取完成（共抓取 ${scrapedCount} 张不重复图片）`;
     }
     
-    console.log('抓取结束，最终数据量:', scrapedData.length);
+    console.log('抓取结束，最终数据量:', scrapedCount);
+    await ingestSender.flush();
     updateResultDisplay(scrapedData, contentDiv, false);
 }
 
+// 每攒够这么多条记录发送一次
+const INGEST_BATCH_SIZE = 20;
+
+// 转换为与CSV导出相同列名的记录
+function toExportRecord(item) {
+    return {
+        'Prompt': item.prompt,
+        'Prompt 参数': item.promptParams,
+        '任务ID': item.jobId,
+        '任务链接': item.jobLink,
+        // 导出时强制将图片链接中的 .webp 替换为 .png
+        '图片链接': item.imgLink.replace(/\.webp$/, '.png'),
+        '用户名': item.userName,
+        '用户ID': item.userId,
+        '用户主页': item.userProfileLink,
+        '其他信息': item.metadata
+    };
+}
+
+// 抓取过程中把记录分批发送到本地接收服务（MJ-CSV-下载脚本.py --serve），边抓取边下载；
+// 服务确认收到一批记录后以这批抓取项调用 onAcknowledged
+function createIngestSender(onAcknowledged) {
+    const ingestUrl = (localStorage.getItem('ingestUrl') || '').trim().replace(/\/+$/, '');
+    const ingestToken = (localStorage.getItem('ingestToken') || '').trim();
+    const pending = [];
+    let sending = null;
+
+    async function send() {
+        const batch = pending.splice(0, pending.length);
+        const headers = { 'Content-Type': 'application/json' };
+        if (ingestToken) {
+            headers['X-MJ-Token'] = ingestToken;
+        }
+        try {
+            const response = await fetch(`${ingestUrl}/records`, {
+                method: 'POST',
+                headers,
+                body: JSON.stringify(batch.map(toExportRecord))
+            });
+            if (response.status >= 500) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            if (response.ok) {
+                onAcknowledged(batch);
+            } else {
+                // 被拒绝的记录留在页面中，仍可手动导出
+                console.error('接收服务拒绝了记录:', await response.text());
+            }
+        } catch (error) {
+            // 服务未启动或暂时不可用：放回队列，下次发送时重试
+            console.error('发送到接收服务失败，稍后重试:', error);
+            pending.unshift(...batch);
+        }
+    }
+
+    async function flush() {
+        if (!ingestUrl) return;
+        while (sending) {
+            await sending;
+        }
+        if (pending.length === 0) return;
+        sending = send();
+        await sending;
+        sending = null;
+    }
+
+    return {
+        add(item) {
+            if (!ingestUrl) return;
+            pending.push(item);
+            if (pending.length >= INGEST_BATCH_SIZE && !sending) {
+                flush();
+            }
+        },
+        flush
+    };
+}
+
 
 
 // 分离 Prompt 和 Prompt 参数
@@ -631,6 +736,9 @@ function updateResultDisplay(scrapedData, contentDiv, isPartial = false) {
     if (scrapedData.length > 0) {
         exportButton.style.display = 'inline-block';
         exportButton.onclick = () => exportToCSV(scrapedData);
+    } else if (!isPartial) {
+        // 记录都已由接收服务确认收到
+        exportButton.style.display = 'none';
     }
 }
 
@@ -648,18 +756,17 @@ function exportToCSV(scrapedData) {
     const csvContent = BOM + [
         ['Prompt', 'Prompt 参数', '任务ID', '任务链接', '图片链接', '用户名', '用户ID', '用户主页', '其他信息'].join(','),
         ...selectedData.map(item => {
-            // 导出时强制将图片链接中的 .webp 替换为 .png
-            let exportImgLink = item.imgLink.replace(/\.webp$/, '.png');
+            const record = toExportRecord(item);
             return [
-                `"${item.prompt.replace(/"/g, '""')}"`,
-                `"${item.promptParams.replace(/"/g, '""')}"`,
-                item.jobId,
-                item.jobLink,
-                exportImgLink,
-                item.userName,
-                item.userId,
-                item.userProfileLink,
-                `"${item.metadata.replace(/"/g, '""')}"`
+                `"${record['Prompt'].replace(/"/g, '""')}"`,
+                `"${record['Prompt 参数'].replace(/"/g, '""')}"`,
+                record['任务ID'],
+                record['任务链接'],
+                record['图片链接'],
+                record['用户名'],
+                record['用户ID'],
+                record['用户主页'],
+                `"${record['其他信息'].replace(/"/g, '""')}"`
             ].join(',');
         })
     ].join('\n');
@@ -1020,6 +1127,10 @@ style.textContent = `
         width: 100px;
     }
     
+    .setting-item input[type="text"] {
+        width: 180px;
+    }
+    
     .setting-item label {
         min-width: 120px;
     }
@@ -0,0 +1,24 @@
+"""
+mj_csv_dl - Midjourney CSV下载工具
+
+命令行入口为 MJ-CSV-下载脚本.py（或 python -m mj_csv_dl），在其它程序中使用:
+
+    from mj_csv_dl import Downloader
+
+    with Downloader("output", method="requests", threads=16) as downloader:
+        successful, processed = downloader.download_csv("MJ-top.csv")
+
+导入本包不会导入下载引擎及其依赖（requests、tqdm等），首次访问 Downloader 时才加载。
+"""
+
+__all__ = ["Downloader", "configure"]
+
+
+def __getattr__(name):
+    if name == "Downloader":
+        from .engine import Downloader
+        return Downloader
+    if name == "configure":
+        from .core import configure
+        return configure
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,224 @@
+"""命令行入口：解析参数、设置配置后按模式（单次处理、监视、接收服务、交互式）运行"""
+
+import os
+import argparse
+
+from . import core
+
+def main_interactive():
+    """交互式模式的主函数"""
+    print("=" * 80)
+    print("MJ CSV下载工具 - 交互模式")
+    print("=" * 80)
+    print("\n完整使用提示：")
+    print("  脚本用途:")
+    print("    该脚本用于处理包含Midjourney任务数据的CSV文件，提取并保存文本提示(Prompt)为txt文件，")
+    print("    同时下载相应的图片。支持单个CSV文件处理和批量目录处理。")
+    print("\n  主要功能:")
+    print("    1. 从CSV提取Prompt文本并保存为txt文件，文件命名统一采用扩展模式的命名方式（例如 任务ID_0.txt）")
+    print("    2. 下载CSV中的图片链接指向的图片，图片文件名与文本文件对应（例如 任务ID_0.png）")
+    print("    3. 支持单个CSV文件或整个目录的批量处理")
+    print("    4. 支持多线程并行下载，提高处理速度")
+    print("    5. 提供六种下载方式供用户选择（curl、browser、requests、urllib、async、h2，默认使用curl方式），用户可通过参数或交互提示选择方式")
+    print("    6. 【扩展模式】：在扩展模式下，每个任务构造0_0至0_3四个下载任务（命名如 taskID_0、taskID_1...），")
+    print("       如果某个图片下载失败，则对应的txt文件不生成；扩展模式下最多重试1次，普通模式下重试2次。")
+    print("    7. 【优化】：如果保存的目录中已存在要下载的图片和文本文件，则自动略过不处理。")
+    print("\n  使用步骤：")
+    print("    1. 输入CSV文件路径或目录路径")
+    print("    2. 输入文件保存目录")
+    print("    3. 选择是否启用扩展模式（下载多个图片）")
+    print("    4. 选择下载方式（curl, browser, requests, urllib, async, h2）")
+    print("\n  CSV文件格式要求:")
+    print("    CSV文件必须包含以下字段:")
+    print("    - 'Prompt': 文本提示内容")
+    print("    - '任务id'或'任务ID': 用于文件命名的任务标识符")
+    print("    - '图片链接': 要下载的图片URL")
+    print("    可选字段:")
+    print("    - '任务链接': 任务页面URL，用于增强图片下载功能")
+    print("\n  注意事项:")
+    print("    1. 扩展模式下针对下载失败的图片最多重试1次，且下载失败时不生成对应的txt文件")
+    print("    2. 普通模式下下载失败最多重试2次")
+    print("    3. 大量图片下载时建议使用多线程（默认4个线程）提高效率")
+    print("    4. 字段名区分大小写，但'任务id'和'任务ID'都被支持")
+    print("    5. 如果保存的目录中已存在要下载的图片和文本文件，则自动略过不处理")
+    print("=" * 80)
+    while True:
+        input_path = input("请输入CSV文件路径或目录路径: ").strip()
+        if os.path.exists(input_path):
+            break
+        print("路径不存在，请重新输入！")
+    while True:
+        output_dir = input("请输入文件保存目录: ").strip()
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            break
+        except Exception as e:
+            print(f"无法创建目录: {str(e)}，请重新输入！")
+    
+    ext_input = input("是否启用扩展模式（下载多个图片）？(y/n 默认n): ").strip().lower()
+    extended_mode = ext_input == 'y'
+    
+    print("\n请选择下载方式：")
+    print("  1. curl      (使用 curl 命令下载，默认)")
+    print("  2. browser   (通过浏览器模拟方式下载)")
+    print("  3. requests  (使用 Python requests 库下载)")
+    print("  4. urllib    (使用 Python urllib 库下载)")
+    print("  5. async     (使用 asyncio + aiohttp 高并发下载，需安装aiohttp)")
+    print("  6. h2        (使用 HTTP/2 多路复用下载，需安装httpx[http2])")
+    method_input = input("请输入对应的方式 (可直接输入名称或数字，默认: curl): ").strip().lower()
+    if method_input in ["", "1", "curl"]:
+        download_method = "curl"
+    elif method_input in ["2", "browser"]:
+        download_method = "browser"
+    elif method_input in ["3", "requests"]:
+        download_method = "requests"
+    elif method_input in ["4", "urllib"]:
+        download_method = "urllib"
+    elif method_input in ["5", "async"]:
+        download_method = "async"
+    elif method_input in ["6", "h2"]:
+        download_method = "h2"
+    else:
+        print("输入不合法，默认使用 curl")
+        download_method = "curl"
+    
+    core.process_input(input_path, output_dir, 4, extended_mode, download_method)
+
+def main():
+    """命令行模式的主函数"""
+    parser = argparse.ArgumentParser(description="MJ CSV下载工具 - 处理CSV数据并下载图片")
+    parser.add_argument('input_path', nargs='?', help='CSV文件或目录路径')
+    parser.add_argument('output_dir', nargs='?', help='文件保存目录')
+    parser.add_argument('--test-url', help='测试下载单个图片URL')
+    parser.add_argument('--test-task-url', help='测试下载时使用的任务URL（用于浏览器模拟下载）')
+    parser.add_argument('--test-output', help='测试下载图片的保存目录')
+    parser.add_argument('--check-curl', action='store_true', help='检查curl是否已安装')
+    parser.add_argument('--threads', '-t', type=int, default=4, help='并行下载的线程数 (默认: 4)')
+    parser.add_argument('--interactive', action='store_true', help='使用交互式模式运行脚本')
+    parser.add_argument('--extended', action='store_true', help='启用扩展模式下载多个图片（构造0_0至0_3）')
+    parser.add_argument('--recursive', '-r', action='store_true', help='处理目录时递归查找子目录中的CSV文件')
+    parser.add_argument('--watch', action='store_true',
+                        help='持续监视输入目录或文件，只下载新出现的CSV文件和新增的行，按 Ctrl+C 退出')
+    parser.add_argument('--serve', metavar='[HOST:]PORT',
+                        help='启动本地接收服务，浏览器插件抓取时实时发送记录，收到即下载；只需提供输出目录')
+    parser.add_argument('--serve-token', metavar='TOKEN',
+                        help='接收服务要求请求带上的令牌（X-MJ-Token 请求头），与插件设置中的令牌一致')
+    parser.add_argument('--watch-interval', type=float, default=10.0,
+                        help='监视模式下轮询检查的间隔（秒），安装watchdog后改为文件系统事件触发 (默认: 10)')
+    parser.add_argument('--method', choices=core.DOWNLOAD_METHODS, default="curl",
+                        help='选择下载方式 (默认: curl)')
+    parser.add_argument('--curl-batch', type=int, default=core.CURL_BATCH_SIZE,
+                        help=f'curl方式下每次curl调用批量下载的图片数，0表示逐张调用 (默认: {core.CURL_BATCH_SIZE})')
+    parser.add_argument('--no-manifest', action='store_true',
+                        help=f'不使用输出目录中的下载清单({core.MANIFEST_FILENAME})，仅按文件是否存在判断是否跳过')
+    parser.add_argument('--content-store', action='store_true',
+                        help=f'启用内容寻址存储，相同内容的图片只下载和保存一次 (存放于输出目录的 {core.CONTENT_STORE_DIRNAME})')
+    parser.add_argument('--output-format', choices=["files", "shards"], default="files",
+                        help='files: 每张图片保存为单独的图片和txt文件；shards: 打包为WebDataset格式的tar分片 (默认: files)')
+    parser.add_argument('--shard-size', type=float, default=1024,
+                        help='分片输出时每个tar分片的大小上限，单位MB (默认: 1024)')
+    parser.add_argument('--index-format', choices=["jsonl", "parquet"], default="jsonl",
+                        help='分片输出时元数据索引的格式，parquet需要安装pyarrow (默认: jsonl)')
+    parser.add_argument('--processes', '-p', type=int, default=1,
+                        help='下载使用的进程数，每个进程运行 --threads 个线程（或async事件循环），结果汇总到主进程 (默认: 1)')
+    parser.add_argument('--partition', '--shard', type=core.parse_partition, metavar='i/N',
+                        help='只处理按任务ID哈希分成N份后的第i份（i从0开始），用于多台机器分工')
+    parser.add_argument('--lease-db',
+                        help='多个工作进程共享的SQLite任务队列路径，按租约领取任务，崩溃进程的任务会被回收')
+    parser.add_argument('--worker-id', help='共享任务队列中本进程的名称 (默认: 主机名-进程号)')
+    parser.add_argument('--lease-seconds', type=float, default=core.LEASE_SECONDS,
+                        help=f'共享任务队列中任务租约的有效期（秒），每1/3有效期续约一次 (默认: {core.LEASE_SECONDS:g})')
+    parser.add_argument('--prefer-format', choices=core.IMAGE_FORMATS, default=core.PREFERRED_FORMAT,
+                        help='首选的图片格式，例如webp体积通常只有PNG的几分之一；该格式不存在时退回PNG (默认: png)')
+    parser.add_argument('--probe', action='store_true',
+                        help='扩展模式下先用HEAD请求探测变体是否存在，不存在的变体不再下载')
+    parser.add_argument('--missing-ttl', type=float, default=core.MISSING_CACHE_TTL / 86400,
+                        help='返回404/410的图片链接在多少天内不再请求，0表示不记录 (默认: 7)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='根据延迟和错误率自动调整并发数 (--threads/--concurrency 作为上限)')
+    parser.add_argument('--priority', action='append', metavar='PATTERN=N',
+                        help='按CSV文件名设置优先级，优先级高的先下载，可重复指定，如 "MJ-top*=10"')
+    parser.add_argument('--interleave-variants', action='store_true',
+                        help='扩展模式下按CSV行顺序下载每个任务的全部变体（默认先下载所有 _0 再下载变体）')
+    parser.add_argument('--max-bandwidth', type=core.parse_bandwidth, default=0.0, metavar='RATE',
+                        help='全局下载带宽上限，如 10M、500K（字节/秒，不带单位按MB/s），0表示不限 (默认: 0)')
+    parser.add_argument('--host-rate', type=float, default=0.0,
+                        help='每个主机每秒最多发起的请求数，0表示不限 (默认: 0)')
+    parser.add_argument('--concurrency', type=int, default=core.ASYNC_CONCURRENCY,
+                        help=f'async方式下同时进行的最大请求数 (默认: {core.ASYNC_CONCURRENCY})')
+    parser.add_argument('--h2-connections', type=int, default=core.H2_MAX_CONNECTIONS,
+                        help=f'h2方式下HTTP/2连接数的上限 (默认: {core.H2_MAX_CONNECTIONS})')
+    parser.add_argument('--h2-streams', type=int, default=core.H2_MAX_STREAMS,
+                        help=f'h2方式下每个主机同时在途的流数上限 (默认: {core.H2_MAX_STREAMS})')
+    parser.add_argument('--pool-size', type=int, default=core.HTTP_POOL_SIZE,
+                        help=f'共享连接池中每个主机的最大连接数 (默认: {core.HTTP_POOL_SIZE})')
+    parser.add_argument('--task-page-ttl', type=float, default=core.TASK_PAGE_CACHE_TTL,
+                        help=f'browser方式下任务页面cookie的缓存时间（秒），0表示每张图片都重新访问 (默认: {core.TASK_PAGE_CACHE_TTL:g})')
+    parser.add_argument('--verify', action='store_true',
+                        help='下载完成后完整解码校验图片，损坏的图片删除后重新下载（需要安装Pillow）')
+    parser.add_argument('--resize', type=int, default=0, metavar='PX',
+                        help=f'另存一份最长边不超过PX像素的副本到输出目录的 {core.DERIVED_DIRNAME} 中，0表示不生成 (默认: 0)')
+    parser.add_argument('--reencode', type=core.parse_reencode, metavar='FMT[:Q]',
+                        help=f'派生图片的格式与质量，如 webp:85；单独使用时把原尺寸的转码副本存入 {core.DERIVED_DIRNAME} (默认: 沿用原图格式)')
+    parser.add_argument('--thumbnail', type=int, default=0, metavar='PX',
+                        help=f'生成最长边为PX像素的缩略图到 {core.THUMBNAIL_DIRNAME}，扩展模式下另拼出每个任务的2x2总览图 (默认: 0)')
+    parser.add_argument('--postprocess-workers', type=int, default=0,
+                        help='下载后处理（校验、缩放、缩略图）使用的进程数，0表示CPU核数 (默认: 0)')
+    parser.add_argument('--quiet', '-q', action='store_true',
+                        help='不打印逐张图片的信息，只显示进度条和汇总')
+    parser.add_argument('--metrics-log', help='把每个任务的计时、字节数、重试次数和失败原因写入JSON Lines文件')
+    parser.add_argument('--metrics-report', help='把运行结束时的指标汇总写入JSON文件')
+    args = parser.parse_args()
+    core.configure(
+        pool_size=args.pool_size, task_page_ttl=args.task_page_ttl, concurrency=args.concurrency,
+        h2_connections=args.h2_connections, h2_streams=args.h2_streams, curl_batch=args.curl_batch,
+        manifest=not args.no_manifest, content_store=args.content_store,
+        missing_ttl=args.missing_ttl, probe=args.probe, prefer_format=args.prefer_format,
+        output_format=args.output_format, shard_size=args.shard_size, index_format=args.index_format,
+        partition=args.partition, lease_db=args.lease_db, worker_id=args.worker_id, lease_seconds=args.lease_seconds,
+        processes=args.processes, adaptive=args.adaptive, host_rate=args.host_rate,
+        priority=args.priority, interleave_variants=args.interleave_variants, max_bandwidth=args.max_bandwidth,
+        verify=args.verify, resize=args.resize, thumbnail=args.thumbnail, reencode=args.reencode,
+        postprocess_workers=args.postprocess_workers,
+        quiet=args.quiet, metrics_log=args.metrics_log, metrics_report=args.metrics_report,
+    )
+    
+    if args.method == "h2" and core._import_httpx() is None:
+        print('错误: h2下载方式需要安装httpx[http2]，请执行: pip install "httpx[http2]"')
+        return
+    if core.postprocess_enabled() and core._import_pil() is None:
+        print("错误: 下载后处理（--verify/--resize/--reencode/--thumbnail）需要安装Pillow，请执行: pip install Pillow")
+        return
+    if args.check_curl:
+        core.check_curl_installation()
+        return
+    if args.test_url:
+        core.test_download_image(args.test_url, args.test_output, args.test_task_url, args.method)
+    elif args.interactive:
+        main_interactive()
+    elif args.serve:
+        output_dir = (args.output_dir or args.input_path or "").strip()
+        if not output_dir:
+            print("错误: 接收服务模式需要提供输出目录！")
+            return
+        os.makedirs(output_dir, exist_ok=True)
+        core.serve_ingest(args.serve, output_dir, args.threads, args.extended, args.method, args.serve_token)
+    elif args.input_path and args.output_dir:
+        input_path = args.input_path.strip()
+        output_dir = args.output_dir.strip()
+        if not os.path.exists(input_path):
+            print(f"错误: 输入路径 '{input_path}' 不存在！")
+            return
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+        except Exception as e:
+            print(f"错误: 无法创建输出目录 '{output_dir}': {str(e)}")
+            return
+        if args.watch:
+            core.watch_input(input_path, output_dir, args.threads, args.extended, args.method, args.recursive,
+                        args.watch_interval)
+        else:
+            core.process_input(input_path, output_dir, args.threads, args.extended, args.method, args.recursive)
+    else:
+        print("没有提供足够的命令行参数，默认进入交互模式...\n")
+        main_interactive()
@@ -0,0 +1,4139 @@
+"""
+MJ CSV下载工具的核心实现：下载方式、调度器、下载清单、分片输出、多进程与监视/接收模式。
+
+配置保存在模块级变量中，由 configure() 或各个 configure_* 函数设置（整个进程共用一份）；
+requests、tqdm、aiohttp、httpx 等较重的依赖在首次使用时才导入。
+"""
+
+import os
+import csv
+import argparse
+import random
+import traceback
+import time
+import subprocess
+import shutil
+import platform
+import sys
+import threading
+import itertools
+import io
+import json
+import collections
+import heapq
+import re
+import contextvars
+import hashlib
+import hmac
+import sqlite3
+import tarfile
+import http.client
+import concurrent.futures
+import contextlib
+import fnmatch
+import multiprocessing
+import queue
+import socket
+from urllib.error import URLError
+from urllib.parse import urlparse, urljoin
+
+# 共享连接池配置：所有下载线程复用同一个requests会话，每个主机最多保持 HTTP_POOL_SIZE 个长连接
+HTTP_POOL_SIZE = 16
+_http_session = None
+_http_session_lock = threading.Lock()
+_timed_pool_classes = None
+_warmed_hosts = set()
+_warmed_hosts_lock = threading.Lock()
+# 标准库(urllib方式)的长连接按线程缓存，并单独统计请求数与新建连接数
+_stdlib_local = threading.local()
+_stdlib_stats = {"requests": 0, "connections": 0}
+_stdlib_stats_lock = threading.Lock()
+# h2方式：所有线程共用少量HTTP/2连接，每张图片占用一个流；H2_MAX_CONNECTIONS 为连接数上限，
+# H2_MAX_STREAMS 为每个主机同时在途的流数上限（流量控制由h2协议栈完成）
+H2_MAX_CONNECTIONS = 2
+H2_MAX_STREAMS = 100
+_h2_clients = {}
+_h2_stream_slots = {}
+_h2_lock = threading.Lock()
+_h2_stats = {"requests": 0, "connections": 0}
+_h2_trace_local = threading.local()
+_curl_path = None
+_curl_parallel_supported = None
+# 进行中的curl传输数，用于按传输平分带宽上限
+_curl_transfers = 0
+_curl_transfers_lock = threading.Lock()
+# browser方式访问任务页面得到的cookie按 (任务URL, 图片主机) 缓存，同一任务的各张图片只访问一次任务页面
+TASK_PAGE_CACHE_TTL = 600.0
+TASK_PAGE_CACHE_MAX_ENTRIES = 4096
+_task_page_cache = None
+# 线程池中在途工作单元数上限 = 线程数 × PENDING_FACTOR，避免一次性为所有任务创建Future
+PENDING_FACTOR = 4
+# 任务迭代器产生None表示暂时没有新任务（接收服务），调度循环最多等待这么多秒后再次取任务
+IDLE_POLL_INTERVAL = 0.05
+# 下载清单：在输出目录中以SQLite记录每个任务的状态，用于快速断点续传
+MANIFEST_FILENAME = ".mj_manifest.sqlite3"
+MANIFEST_ENABLED = True
+# 下载清单每隔这么多秒提交一次；多个进程共用清单时为0（每次写入立即提交，不长时间占用写锁）
+MANIFEST_COMMIT_INTERVAL = 1.0
+_manifests = {}
+_manifests_lock = threading.Lock()
+# 返回404/410的图片链接视为不存在：不再重试，并记入下载清单的 missing 表，
+# 有效期内再次运行时直接跳过；PROBE_VARIANTS 时扩展模式先用HEAD请求探测变体是否存在
+PERMANENT_HTTP_STATUSES = (404, 410)
+# 首选的图片格式：非png时先下载该格式的链接，不存在时退回CSV中的PNG链接，并按实际内容确定文件扩展名
+PREFERRED_FORMAT = "png"
+IMAGE_FORMATS = ("png", "webp", "jpeg")
+FORMAT_EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg", "gif": ".gif", "avif": ".avif"}
+MISSING_CACHE_TTL = 7 * 24 * 3600.0
+PROBE_VARIANTS = False
+# 内容寻址存储：图片按SHA-256存放在输出目录的 .blobs 下，任务文件名以硬链接/符号链接指向同一份数据
+CONTENT_STORE_ENABLED = False
+CONTENT_STORE_DIRNAME = ".blobs"
+# 分片输出：图片与Prompt按WebDataset格式打包进大小受限的tar分片，每个样本的元数据（含CSV其它列）写入一个索引文件
+OUTPUT_FORMAT = "files"
+SHARD_DIRNAME = "shards"
+SHARD_MAX_BYTES = 1024 * 1024 * 1024
+METADATA_INDEX_FILENAME = "metadata.jsonl"
+METADATA_INDEX_FORMAT = "jsonl"
+_shard_writers = {}
+_shard_writers_lock = threading.Lock()
+# 多进程下载：PROCESS_COUNT > 1 时主进程解析CSV并分发任务，每个子进程运行自己的线程池或事件循环，
+# 结果汇总回主进程统一更新进度条与指标
+PROCESS_COUNT = 1
+PROCESS_TASK_BATCH = 16
+SHARD_NAME_TAG = ""
+_process_stats = {"requests": 0, "connections": 0, "page_fetches": 0, "page_hits": 0,
+                  "verified": 0, "corrupt": 0, "derived": 0}
+# 多进程/多机器分工：PARTITION=(i, N) 时只处理任务ID哈希后属于第i份的任务；
+# LEASE_DB_PATH 指定共享的SQLite任务队列时，各个工作进程按租约领取任务并定期续约，崩溃进程的任务在租约过期后被回收
+PARTITION = None
+LEASE_DB_PATH = None
+LEASE_SECONDS = 120.0
+LEASE_BATCH_SIZE = 64
+# 共享队列中下载失败（非404/410）的任务放回队列重试，每个任务最多被领取这么多次
+LEASE_MAX_ATTEMPTS = 3
+WORKER_ID = None
+_lease_queue = None
+# 一次运行内（跨CSV文件）已排入下载队列的任务，用于去重：只保留最近 DEDUP_WINDOW 个键的摘要（LRU），
+# 更早出现的重复任务由下载清单中的done记录（或已存在的文件）跳过，内存占用与任务总数无关
+DEDUP_WINDOW = 100_000
+_seen_tasks = collections.OrderedDict()
+_seen_tasks_lock = threading.Lock()
+_duplicate_count = 0
+# 输出控制与运行指标：QUIET 时不打印逐张图片的信息，只保留进度条；
+# 每个任务的耗时、字节数、重试次数与失败原因汇总到 RunMetrics，可写入JSON Lines日志
+QUIET = False
+METRICS_LOG_PATH = None
+METRICS_REPORT_PATH = None
+_run_metrics = None
+_request_metrics = contextvars.ContextVar("mj_request_metrics", default=None)
+# 最近一次下载失败的原因（线程与协程各自独立）
+_last_error = contextvars.ContextVar("mj_last_error", default=None)
+# 下载成功的图片在接收时计算的SHA-256（按图片路径，线程与协程各自独立），结束任务时不必再读取文件
+_downloaded_bodies = contextvars.ContextVar("mj_downloaded_bodies", default=None)
+# 自适应并发与按主机限速：ADAPTIVE_ENABLED 时按延迟和错误率自动调整并发数（--threads/--concurrency 为上限），
+# HOST_RATE_LIMIT 为每个主机每秒最多发起的请求数（0表示不限），收到429/503时按 Retry-After 暂停该主机
+ADAPTIVE_ENABLED = False
+HOST_RATE_LIMIT = 0.0
+THROTTLE_PAUSE = 5.0
+_host_rate_limiter = None
+# 全局带宽上限（字节/秒，0表示不限），多进程时由各进程平分
+MAX_BANDWIDTH = 0.0
+_bandwidth_limiter = None
+# 任务优先级：扩展模式下先下载所有任务的 _0 图片，再下载 _1～_3 变体；
+# CSV_PRIORITIES 为 ((文件名通配符, 优先级), ...)，优先级高的CSV先下载
+PRIMARY_FIRST = True
+CSV_PRIORITIES = ()
+# 下载后处理：下载完成的图片只读取一次，在处理进程池中完整解码校验（损坏的图片重新下载）并计算SHA-256，
+# 按需生成派生图片：缩放/转码后的副本（DERIVED_DIRNAME）与缩略图（THUMBNAIL_DIRNAME，扩展模式下另拼出2x2总览图）。
+# 处理与网络下载同时进行；POSTPROCESS_WORKERS 为处理进程数（0表示CPU核数）
+POSTPROCESS_VERIFY = False
+RESIZE_MAX_EDGE = 0
+THUMBNAIL_SIZE = 0
+DERIVED_FORMAT = None
+DERIVED_QUALITY = 90
+POSTPROCESS_WORKERS = 0
+DERIVED_DIRNAME = "derived"
+THUMBNAIL_DIRNAME = "thumbnails"
+_postprocess_pool = None
+_postprocess_lock = threading.Lock()
+_postprocess_stats = {"verified": 0, "corrupt": 0, "derived": 0}
+# 批量curl模式：每次curl调用处理的图片数（0表示逐张调用curl）
+CURL_BATCH_SIZE = 32
+# async方式下同时进行的最大请求数（单个事件循环内的协程数）
+ASYNC_CONCURRENCY = 100
+DOWNLOAD_METHODS = ["curl", "browser", "requests", "urllib", "async", "h2"]
+
+def log(message):
+    """打印逐张图片的处理信息，--quiet 模式下不输出"""
+    if not QUIET:
+        print(message)
+
+def begin_request_metrics():
+    """开始记录一次下载尝试的指标（线程与协程各自独立），返回指标字典"""
+    metrics = {}
+    _request_metrics.set(metrics)
+    return metrics
+
+def record_request_metrics(**values):
+    """记录当前下载尝试的指标，例如 dns_ms、connect_ms、tls_ms、ttfb_ms、transfer_ms、bytes"""
+    metrics = _request_metrics.get()
+    if metrics is not None:
+        metrics.update((key, value) for key, value in values.items() if value is not None)
+
+def elapsed_ms(started):
+    """返回从 started（time.perf_counter）到现在的毫秒数"""
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def get_random_user_agent():
+    """返回一个随机的User-Agent字符串"""
+    user_agents = [
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:123.0) Gecko/20100101 Firefox/123.0",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:123.0) Gecko/20100101 Firefox/123.0",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Safari/605.1.15",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0",
+    ]
+    return random.choice(user_agents)
+
+def get_browser_headers(url):
+    """返回模拟浏览器的请求头"""
+    parsed_url = urlparse(url)
+    domain = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    headers = {
+        "User-Agent": get_random_user_agent(),
+        "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
+        "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Referer": domain,
+        "Cache-Control": "no-cache",
+        "Pragma": "no-cache",
+        "DNT": "1",
+        "Connection": "keep-alive",
+        "Sec-Fetch-Dest": "image",
+        "Sec-Fetch-Mode": "no-cors",
+        "Sec-Fetch-Site": "same-site",
+    }
+    return headers
+
+def get_extended_url(original_url, index):
+    """
+    根据原始图片链接构造扩展模式下的链接，
+    将链接中最后一个下划线后的数字替换为 index，
+    如：https://.../0_0.png 生成 https://.../0_1.png 等
+    """
+    base, ext = os.path.splitext(original_url)
+    pos = base.rfind('_')
+    if pos == -1:
+        return f"{base}_{index}{ext}"
+    else:
+        return f"{base[:pos+1]}{index}{ext}"
+
+def configure_http_pool(pool_size):
+    """设置共享连接池中每个主机的最大连接数，已创建的会话会被关闭并在下次使用时重建"""
+    global HTTP_POOL_SIZE, _http_session
+    with _http_session_lock:
+        HTTP_POOL_SIZE = max(1, int(pool_size))
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+
+def get_shared_session():
+    """返回进程内共享的requests会话（线程安全的连接池，支持keep-alive）"""
+    global _http_session
+    if _http_session is None:
+        import requests
+
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                        pool_maxsize=HTTP_POOL_SIZE)
+                # 新建连接时分别记录DNS解析、TCP连接与TLS握手耗时（requests与浏览器模拟方式）
+                adapter.poolmanager.pool_classes_by_scheme = _get_timed_pool_classes()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
+
+def resolve_host(host, port):
+    """解析主机地址并记录 dns_ms，返回去重后的IP地址列表（按getaddrinfo的优先顺序）"""
+    started = time.perf_counter()
+    infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    record_request_metrics(dns_ms=elapsed_ms(started))
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
+def _get_timed_pool_classes():
+    """返回记录建连耗时的urllib3连接池类（按scheme），首次使用时创建"""
+    global _timed_pool_classes
+    if _timed_pool_classes is None:
+        import urllib3
+
+        class _TimedConnectionMixin:
+            def _new_conn(self):
+                host = self._dns_host
+                began = time.perf_counter()
+                try:
+                    addresses = resolve_host(host, self.port)
+                except OSError:
+                    # 解析失败时交给urllib3按原有方式报告错误
+                    return super()._new_conn()
+                started = time.perf_counter()
+                try:
+                    for index, address in enumerate(addresses):
+                        self._dns_host = address
+                        try:
+                            sock = super()._new_conn()
+                            break
+                        except urllib3.exceptions.ConnectTimeoutError:
+                            if index == len(addresses) - 1:
+                                raise
+                finally:
+                    self._dns_host = host
+                record_request_metrics(connect_ms=elapsed_ms(started), reused=False)
+                self._new_conn_ms = elapsed_ms(began)
+                return sock
+
+        class _TimedHTTPConnection(_TimedConnectionMixin, urllib3.connection.HTTPConnection):
+            pass
+
+        class _TimedHTTPSConnection(_TimedConnectionMixin, urllib3.connection.HTTPSConnection):
+            def connect(self):
+                self._new_conn_ms = 0.0
+                started = time.perf_counter()
+                super().connect()
+                record_request_metrics(tls_ms=round(elapsed_ms(started) - self._new_conn_ms, 1))
+
+        class _TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+            ConnectionCls = _TimedHTTPConnection
+
+        class _TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+            ConnectionCls = _TimedHTTPSConnection
+
+        _timed_pool_classes = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+    return _timed_pool_classes
+
+def warm_up_host(url, headers):
+    """访问站点首页获取cookie，每次运行中每个主机最多预热一次"""
+    parsed_url = urlparse(url)
+    domain = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    with _warmed_hosts_lock:
+        if domain in _warmed_hosts:
+            return
+        _warmed_hosts.add(domain)
+    try:
+        get_shared_session().get(domain, headers=headers, timeout=10)
+    except Exception as e:
+        log(f"预热连接失败 ({domain}): {str(e)}")
+
+def get_curl_path():
+    """查找并缓存curl可执行文件路径"""
+    global _curl_path
+    if _curl_path is None:
+        _curl_path = shutil.which("curl") or ""
+    return _curl_path
+
+def _get_stdlib_connection(scheme, netloc, fresh=False):
+    """返回当前线程中指向指定主机的http.client长连接"""
+    connections = getattr(_stdlib_local, "connections", None)
+    if connections is None:
+        connections = _stdlib_local.connections = {}
+    key = (scheme, netloc)
+    conn = connections.get(key)
+    if conn is None or fresh:
+        if conn is not None:
+            conn.close()
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=15)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=15)
+        conn._create_connection = _timed_create_connection
+        connections[key] = conn
+        with _stdlib_stats_lock:
+            _stdlib_stats["connections"] += 1
+    return conn
+
+def _timed_create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """http.client 建立TCP连接：分别记录DNS解析与连接耗时，依次尝试解析出的各个地址"""
+    host, port = address
+    addresses = resolve_host(host, port)
+    started = time.perf_counter()
+    for index, ip in enumerate(addresses):
+        try:
+            sock = socket.create_connection((ip, port), timeout, source_address)
+            break
+        except OSError:
+            if index == len(addresses) - 1:
+                raise
+    record_request_metrics(connect_ms=elapsed_ms(started))
+    return sock
+
+def _stdlib_request(conn, path, headers):
+    """在连接上发送GET请求，新建连接时记录DNS解析、TCP连接与TLS握手耗时"""
+    reused = conn.sock is not None
+    if not reused:
+        started = time.perf_counter()
+        conn.connect()
+        if isinstance(conn, http.client.HTTPSConnection):
+            metrics = _request_metrics.get() or {}
+            tcp_ms = metrics.get("dns_ms", 0.0) + metrics.get("connect_ms", 0.0)
+            record_request_metrics(tls_ms=round(elapsed_ms(started) - tcp_ms, 1))
+    started = time.perf_counter()
+    conn.request("GET", path, headers=headers)
+    response = conn.getresponse()
+    record_request_metrics(ttfb_ms=elapsed_ms(started), status=response.status, reused=reused)
+    return response
+
+def _stdlib_get(url, headers, max_redirects=5):
+    """使用线程内缓存的长连接发送GET请求并跟随重定向，返回 (最终URL, 响应)"""
+    for _ in range(max_redirects + 1):
+        parsed_url = urlparse(url)
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        conn = _get_stdlib_connection(parsed_url.scheme, parsed_url.netloc)
+        try:
+            response = _stdlib_request(conn, path, headers)
+        except (http.client.HTTPException, ConnectionError):
+            # 服务器已关闭空闲连接，重建后再试一次
+            conn = _get_stdlib_connection(parsed_url.scheme, parsed_url.netloc, fresh=True)
+            response = _stdlib_request(conn, path, headers)
+        with _stdlib_stats_lock:
+            _stdlib_stats["requests"] += 1
+        if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+            response.read()
+            url = urljoin(url, response.getheader("Location"))
+            continue
+        return url, response
+    raise URLError(f"重定向次数过多: {url}")
+
+def get_connection_reuse_stats():
+    """汇总共享连接池的请求数、新建连接数与复用次数"""
+    total_requests = _stdlib_stats["requests"]
+    total_connections = _stdlib_stats["connections"]
+    session = _http_session
+    if session is not None:
+        adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    total_requests += pool.num_requests
+                    total_connections += pool.num_connections
+    total_requests += _h2_stats["requests"] + _process_stats["requests"]
+    total_connections += _h2_stats["connections"] + _process_stats["connections"]
+    return {
+        "requests": total_requests,
+        "connections": total_connections,
+        "reused": max(0, total_requests - total_connections),
+    }
+
+def print_connection_reuse_stats():
+    """打印连接复用统计"""
+    stats = get_connection_reuse_stats()
+    if stats["requests"] == 0:
+        return
+    ratio = stats["reused"] / stats["requests"] * 100
+    print(f"连接复用统计: 请求 {stats['requests']} 次, 新建连接 {stats['connections']} 个, "
+          f"复用 {stats['reused']} 次 ({ratio:.1f}%)")
+
+# 图片格式的magic bytes，用于校验下载内容是否为图片
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+def detect_image_format(head):
+    """根据文件开头的字节判断图片格式（png/jpeg/gif/webp/avif），无法识别时返回None"""
+    for signature, name in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return name
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis"):
+        return "avif"
+    return None
+
+def configure_image_format(preferred):
+    """设置首选的图片格式"""
+    global PREFERRED_FORMAT
+    PREFERRED_FORMAT = preferred if preferred in IMAGE_FORMATS else "png"
+
+def get_image_save_path(output_dir, task_id):
+    """按首选格式生成图片保存路径（下载完成后按实际内容修正扩展名）"""
+    return os.path.join(output_dir, f"{task_id}{FORMAT_EXTENSIONS[PREFERRED_FORMAT]}")
+
+def get_format_url(url, image_format):
+    """把图片链接的扩展名替换为指定格式，如 .../0_0.png -> .../0_0.webp"""
+    parsed_url = urlparse(url)
+    base, ext = os.path.splitext(parsed_url.path)
+    if ext.lower() not in (".png", ".webp", ".jpg", ".jpeg"):
+        return url
+    return parsed_url._replace(path=f"{base}.{image_format}").geturl()
+
+def get_candidate_urls(url):
+    """按优先顺序返回要尝试的图片链接：首选格式在前，PNG作为最后的退路"""
+    if PREFERRED_FORMAT == "png":
+        return [url]
+    candidates = [get_format_url(url, PREFERRED_FORMAT), get_format_url(url, "png")]
+    return list(dict.fromkeys(candidates))
+
+def download_image_candidates(task, download):
+    """
+    依次用 download(url) 尝试各个候选链接：首选格式不存在（404/410）时改用下一个链接，
+    其它错误直接返回失败，由调度器按原来的顺序重试。
+    """
+    candidates = get_candidate_urls(task[0])
+    for index, url in enumerate(candidates):
+        if download(url):
+            return True
+        failure = _last_error.get() or {}
+        if index + 1 == len(candidates) or failure.get("status") not in PERMANENT_HTTP_STATUSES:
+            return False
+        discard_temp_file(get_temp_path(task[1]))
+        log(f"该格式的图片不存在，改用: {candidates[index + 1]}")
+    return False
+
+async def download_image_candidates_async(task, download):
+    """协程版本的 download_image_candidates"""
+    candidates = get_candidate_urls(task[0])
+    for index, url in enumerate(candidates):
+        if await download(url):
+            return True
+        failure = _last_error.get() or {}
+        if index + 1 == len(candidates) or failure.get("status") not in PERMANENT_HTTP_STATUSES:
+            return False
+        discard_temp_file(get_temp_path(task[1]))
+        log(f"该格式的图片不存在，改用: {candidates[index + 1]}")
+    return False
+
+def apply_detected_extension(image_path):
+    """按文件头识别出的实际格式修正图片扩展名，返回修正后的路径"""
+    with open(image_path, "rb") as f:
+        image_format = detect_image_format(f.read(16))
+    ext = FORMAT_EXTENSIONS.get(image_format)
+    base, current_ext = os.path.splitext(image_path)
+    if ext is None or ext == current_ext.lower():
+        return image_path
+    os.replace(image_path, base + ext)
+    return base + ext
+
+def find_existing_image(image_path):
+    """返回已存在的图片路径；图片按实际内容确定扩展名，之前的运行（如 --prefer-format webp）可能以其它扩展名保存"""
+    if os.path.exists(image_path):
+        return image_path
+    base = os.path.splitext(image_path)[0]
+    for ext in dict.fromkeys(FORMAT_EXTENSIONS.values()):
+        if os.path.exists(base + ext):
+            return base + ext
+    return None
+
+def get_temp_path(save_path):
+    """下载过程中写入的临时文件，校验通过后才重命名为最终文件"""
+    return f"{save_path}.tmp"
+
+def get_resume_offset(temp_file):
+    """返回上次中断留下的临时文件大小，用于 Range 断点续传"""
+    try:
+        return os.path.getsize(temp_file)
+    except OSError:
+        return 0
+
+def get_validator_path(temp_file):
+    """与临时文件放在一起的续传校验值（ETag 或 Last-Modified），续传时作为 If-Range 发送"""
+    return f"{temp_file}.validator"
+
+def read_resume_validator(temp_file):
+    """返回临时文件对应的续传校验值，没有时返回None"""
+    try:
+        with open(get_validator_path(temp_file), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def save_resume_validator(temp_file, headers):
+    """
+    开始写入临时文件时保存响应的强ETag（没有时用 Last-Modified）；
+    弱ETag不能用于 If-Range，没有可用的校验值时删除旧记录，中断后不续传
+    """
+    etag = headers.get("ETag") or ""
+    validator = etag if etag.startswith('"') else headers.get("Last-Modified")
+    path = get_validator_path(temp_file)
+    if validator:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(validator)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def add_range_header(headers, offset, validator=None):
+    """已有部分内容时返回带 Range（有校验值时另带 If-Range）请求头的副本"""
+    if offset <= 0:
+        return headers
+    headers = dict(headers, Range=f"bytes={offset}-")
+    if validator:
+        headers["If-Range"] = validator
+    return headers
+
+def discard_temp_file(temp_file):
+    """删除临时文件及其续传校验值，下次从头下载"""
+    for path in (temp_file, get_validator_path(temp_file)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def check_range_status(status, temp_file):
+    """服务器无法满足 Range 请求（416）时删除临时文件，下次从头下载"""
+    if status == 416:
+        discard_temp_file(temp_file)
+
+def get_expected_size(temp_file, offset, status, headers):
+    """
+    按响应头返回临时文件下载完成后应有的完整字节数，无法确定时返回None；
+    206 响应的 Content-Range 与已下载的内容不衔接时删除临时文件并抛出异常
+    """
+    if status == 206 and offset > 0:
+        match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", headers.get("Content-Range") or "")
+        if not match or int(match.group(1)) != offset:
+            discard_temp_file(temp_file)
+            raise IOError("Range响应与已下载的内容不衔接，将重新下载")
+        return int(match.group(2)) if match.group(2) != "*" else None
+    content_length = headers.get("Content-Length") or ""
+    if status != 200 or not content_length.isdigit() or headers.get("Content-Encoding"):
+        return None
+    return int(content_length)
+
+def open_temp_file(temp_file, offset, status, headers):
+    """
+    根据响应打开临时文件：206 且 Content-Range 与已下载内容衔接时追加写入，
+    否则（包括 If-Range 不匹配时服务器返回的完整内容）从头写入并保存新的续传校验值。
+    返回 (文件对象, 预期的完整字节数)，无法确定时字节数为None。
+    """
+    expected_size = get_expected_size(temp_file, offset, status, headers)
+    if status == 206 and offset > 0:
+        return open(temp_file, "ab"), expected_size
+    save_resume_validator(temp_file, headers)
+    return open(temp_file, "wb"), expected_size
+
+def finalize_temp_file(temp_file, save_path, expected_size=None):
+    """
+    校验临时文件的大小（与 Content-Length 一致）和图片magic bytes，通过后原子地重命名为最终文件。
+    内容不完整时保留临时文件供下次续传；不是图片时删除临时文件。
+    """
+    size = os.path.getsize(temp_file)
+    if expected_size is not None and size != expected_size:
+        if size > expected_size:
+            discard_temp_file(temp_file)
+        raise IOError(f"下载不完整: {size}/{expected_size} 字节")
+    with open(temp_file, "rb") as f:
+        head = f.read(16)
+    if detect_image_format(head) is None:
+        discard_temp_file(temp_file)
+        raise IOError("下载的内容不是有效的图片文件")
+    os.replace(temp_file, save_path)
+    discard_temp_file(get_validator_path(temp_file))
+    return size
+
+class DownloadError(IOError):
+    """
+    一次下载尝试失败：status 为HTTP状态码（没有时为None），headers 为响应头，
+    set_last_error 从中提取状态码和 Retry-After
+    """
+
+    def __init__(self, message, status=None, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers
+
+class TempDownload:
+    """
+    一次下载尝试写入的临时文件（各下载方式共用）：
+    已有 .tmp 时请求带 Range 与 If-Range（保存的ETag/Last-Modified）断点续传，服务器上的图片已变化时返回完整内容；
+    按响应打开临时文件并边接收边写入（同时计算SHA-256），finish() 校验大小与magic bytes后原子地重命名为最终文件；
+    启用下载后处理时同时把内容留在内存中交给处理进程池，不必再读取文件；中途失败时保留临时文件与校验值供下次续传
+    """
+
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.temp_file = get_temp_path(save_path)
+        self.offset = get_resume_offset(self.temp_file)
+        self.validator = read_resume_validator(self.temp_file) if self.offset else None
+        if self.offset and self.validator is None:
+            # 没有校验值时无法确认服务器上的图片未变化，不续传
+            discard_temp_file(self.temp_file)
+            self.offset = 0
+        self.file = None
+        self.expected_size = None
+        self.size = 0
+        self.started = None
+        self.digest = hashlib.sha256()
+        self.body = bytearray() if postprocess_enabled() else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """关闭临时文件并删除curl续传时的分段文件"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.offset and os.path.exists(self.curl_output()):
+            os.remove(self.curl_output())
+
+    def request_headers(self, headers):
+        """返回本次请求使用的请求头（已有部分内容时带 Range 与 If-Range）"""
+        record_request_metrics(resumed_from=self.offset or None)
+        return add_range_header(headers, self.offset, self.validator)
+
+    def curl_output(self):
+        """
+        curl的输出文件：续传时写入单独的分段文件，收到响应后由 accept_response()
+        按206（追加到临时文件）或200（图片已变化，替换临时文件）处理
+        """
+        return f"{self.temp_file}.part" if self.offset else self.temp_file
+
+    def curl_headers(self):
+        """curl续传时附加的 Range 与 If-Range 请求头"""
+        if not self.offset:
+            return []
+        return [f"Range: bytes={self.offset}-", f"If-Range: {self.validator}"]
+
+    def accept_response(self, status, headers):
+        """由curl等外部进程写入时，按其2xx响应头合并续传的内容、确定预期大小并保存续传校验值"""
+        if self.offset and status == 206:
+            self.expected_size = get_expected_size(self.temp_file, self.offset, status, headers)
+            with open(self.curl_output(), "rb") as part, open(self.temp_file, "ab") as f:
+                shutil.copyfileobj(part, f)
+            os.remove(self.curl_output())
+            return
+        if self.offset:
+            # If-Range 不匹配时服务器返回完整内容，从头开始
+            os.replace(self.curl_output(), self.temp_file)
+            self.offset = 0
+        self.expected_size = get_expected_size(self.temp_file, 0, status, headers)
+        save_resume_validator(self.temp_file, headers)
+
+    def open(self, status, headers):
+        """收到响应后打开临时文件；状态码不是2xx时抛出 DownloadError（416时先删除临时文件）"""
+        if not 200 <= status < 300:
+            check_range_status(status, self.temp_file)
+            raise DownloadError(f"HTTP {status}", status, headers)
+        content_type = headers.get("Content-Type") or ""
+        if not content_type.startswith(("image/", "application/octet-stream")):
+            log(f"警告: 响应不是图片类型 ({content_type}), 但仍尝试保存")
+        self.file, self.expected_size = open_temp_file(self.temp_file, self.offset, status, headers)
+        if "a" in self.file.mode:
+            # 续传时先计入已下载部分的哈希（以及留在内存中的内容）
+            with open(self.temp_file, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    self.digest.update(chunk)
+                    if self.body is not None:
+                        self.body += chunk
+        self.started = time.perf_counter()
+
+    def write(self, chunk):
+        """写入一块响应内容，返回字节数（用于带宽限制）"""
+        self.file.write(chunk)
+        self.digest.update(chunk)
+        if self.body is not None:
+            self.body += chunk
+        self.size += len(chunk)
+        return len(chunk)
+
+    def finish(self):
+        """
+        结束写入并校验临时文件，通过后重命名为最终文件；
+        由curl等外部进程写入临时文件时不调用 open()，传输指标由调用方记录
+        """
+        data = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            record_request_metrics(transfer_ms=elapsed_ms(self.started), bytes=self.size)
+            sha256 = self.digest.hexdigest()
+            data = self.body
+        elif not os.path.exists(self.temp_file):
+            raise IOError("下载文件为空")
+        else:
+            sha256 = file_sha256(self.temp_file)
+        finalize_temp_file(self.temp_file, self.save_path, self.expected_size)
+        bodies = _downloaded_bodies.get()
+        if bodies is None:
+            bodies = {}
+            _downloaded_bodies.set(bodies)
+        bodies[self.save_path] = {"sha256": sha256, "data": data}
+
+def pop_downloaded_body(save_path):
+    """
+    取出当前线程/协程中该图片下载时记录的信息 {"sha256", "data"}，没有时返回None；
+    data 为启用下载后处理时留在内存中的图片内容（由curl写入文件时为None）
+    """
+    bodies = _downloaded_bodies.get()
+    return bodies.pop(save_path, None) if bodies else None
+
+def download_failed(label, exc):
+    """记录一次下载尝试失败的原因（只保留第一行）并返回False，是否重试由调度器决定"""
+    message = str(exc).split("\n", 1)[0] or type(exc).__name__
+    log(f"下载失败({label}): {message}")
+    set_last_error(message, exc)
+    return False
+
+def download_image_with_requests(url, save_path):
+    """使用requests库下载图片（共享连接池）"""
+    headers = get_browser_headers(url)
+    try:
+        session = get_shared_session()
+        warm_up_host(url, headers)
+        with TempDownload(save_path) as download:
+            started = time.perf_counter()
+            with session.get(url, headers=download.request_headers(headers), stream=True, timeout=15) as response:
+                record_request_metrics(ttfb_ms=elapsed_ms(started), status=response.status_code)
+                download.open(response.status_code, response.headers)
+                for chunk in response.iter_content(chunk_size=65536):
+                    throttle_bandwidth(download.write(chunk))
+            download.finish()
+        log(f"成功下载图片(requests方式): {save_path}")
+        return True
+    except Exception as e:
+        return download_failed("requests方式", e)
+
+def download_image_with_urllib(url, save_path):
+    """使用标准库下载图片（线程内复用长连接）"""
+    headers = get_browser_headers(url)
+    try:
+        with TempDownload(save_path) as download:
+            _, response = _stdlib_get(url, download.request_headers(headers))
+            if not 200 <= response.status < 300:
+                # 读完响应体以便继续复用连接
+                response.read()
+            download.open(response.status, response.headers)
+            for chunk in iter(lambda: response.read(65536), b""):
+                throttle_bandwidth(download.write(chunk))
+            download.finish()
+        log(f"成功下载图片(urllib方式): {save_path}")
+        return True
+    except Exception as e:
+        return download_failed("urllib方式", e)
+
+CURL_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
+
+def run_curl(cmd, **kwargs):
+    """执行curl命令，Windows下隐藏命令行窗口"""
+    if platform.system() == "Windows":
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = 0
+        kwargs["startupinfo"] = startupinfo
+    return subprocess.run(cmd, **kwargs)
+
+def configure_curl_batch(batch_size):
+    """设置批量curl模式下每次curl调用处理的图片数，0表示逐张调用curl"""
+    global CURL_BATCH_SIZE
+    CURL_BATCH_SIZE = max(0, int(batch_size))
+
+def curl_supports_parallel():
+    """检查curl是否支持 --parallel 与 --no-progress-meter（curl 7.67+），结果会被缓存"""
+    global _curl_parallel_supported
+    if _curl_parallel_supported is None:
+        curl_path = get_curl_path()
+        _curl_parallel_supported = False
+        if curl_path:
+            try:
+                result = run_curl([curl_path, "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                version = result.stdout.decode("utf-8", errors="replace").split()[1]
+                major, minor = (int(part) for part in version.split(".")[:2])
+                _curl_parallel_supported = (major, minor) >= (7, 67)
+            except Exception:
+                _curl_parallel_supported = False
+    return _curl_parallel_supported
+
+# curl write-out 中的计时字段，由 parse_curl_timings 转换为统一的指标字典
+CURL_TIMING_FORMAT = ("%{time_namelookup} %{time_connect} %{time_appconnect} %{time_starttransfer} "
+                      "%{time_total} %{size_download} %{num_connects}")
+
+def parse_curl_timings(fields):
+    """把 CURL_TIMING_FORMAT 输出的7个字段转换为指标字典（毫秒）"""
+    try:
+        namelookup, connect, appconnect, starttransfer, total = (float(value) for value in fields[:5])
+        size, num_connects = int(float(fields[5])), int(fields[6])
+    except (ValueError, IndexError):
+        return {}
+    return {
+        "dns_ms": round(namelookup * 1000, 1),
+        "connect_ms": round((connect - namelookup) * 1000, 1),
+        "tls_ms": round((appconnect - connect) * 1000, 1) if appconnect > 0 else None,
+        "ttfb_ms": round(starttransfer * 1000, 1),
+        "transfer_ms": round((total - starttransfer) * 1000, 1),
+        "total_ms": round(total * 1000, 1),
+        "bytes": size,
+        "reused": num_connects == 0,
+    }
+
+def _curl_config_quote(value):
+    """按curl配置文件语法为字符串加引号"""
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def get_header_path(save_path):
+    """curl写出响应头（-D）的临时文件，用于读取 Retry-After 等响应头"""
+    return f"{save_path}.hdr"
+
+def read_curl_headers(header_file):
+    """读取并删除curl写出的响应头文件，返回最后一个响应的头部（跟随重定向时文件中有多段）"""
+    try:
+        with open(header_file, "rb") as f:
+            data = f.read()
+    except OSError:
+        data = b""
+    discard_temp_file(header_file)
+    blocks = [block for block in re.split(rb"\r?\n\r?\n", data) if block.startswith(b"HTTP/")]
+    lines = blocks[-1].split(b"\n", 1) if blocks else []
+    return http.client.parse_headers(io.BytesIO((lines[1] if len(lines) > 1 else b"") + b"\r\n\r\n"))
+
+@contextlib.contextmanager
+def curl_transfer_slots(count):
+    """
+    登记同时进行的curl传输数并返回每个传输的限速（字节/秒，未设置带宽上限时为None）：
+    curl在子进程中接收数据，全局带宽上限按进行中的传输数平分后用 --limit-rate 交给curl执行
+    """
+    global _curl_transfers
+    with _curl_transfers_lock:
+        _curl_transfers += count
+        total = _curl_transfers
+    try:
+        yield max(1024, int(MAX_BANDWIDTH / total)) if MAX_BANDWIDTH > 0 else None
+    finally:
+        with _curl_transfers_lock:
+            _curl_transfers -= count
+
+def _build_curl_batch_config(items, rate=None):
+    """
+    为一批 (url, TempDownload, header_file) 生成curl配置文件内容，每个传输用 next 分隔并带有独立的请求头，
+    已有部分内容时带 Range 与 If-Range 续传；
+    write-out 输出 "MJDL <序号> <HTTP状态码> <计时字段...>" 用于把结果与指标映射回各个任务
+    """
+    blocks = []
+    for index, (url, download, header_file) in enumerate(items):
+        write_out = f"MJDL {index} %{{http_code}} {CURL_TIMING_FORMAT}\\n"
+        lines = [
+            "fail", "location", "silent", "show-error",
+            "connect-timeout = 15",
+            "max-time = 30",
+            f"user-agent = {_curl_config_quote(CURL_USER_AGENT)}",
+            f"output = {_curl_config_quote(download.curl_output())}",
+            f"dump-header = {_curl_config_quote(header_file)}",
+            f"write-out = {_curl_config_quote(write_out)}",
+        ]
+        lines.extend(f"header = {_curl_config_quote(header)}" for header in download.curl_headers())
+        if rate is not None:
+            lines.append(f"limit-rate = {rate}")
+        lines.extend(_curl_config_request(url))
+        blocks.append("\n".join(lines))
+    return "\nnext\n".join(blocks) + "\n"
+
+def _curl_config_request(url):
+    """curl配置文件中一个传输的浏览器请求头与URL"""
+    lines = [f"header = {_curl_config_quote(f'{key}: {value}')}"
+             for key, value in get_browser_headers(url).items() if key != "User-Agent"]
+    lines.append(f"url = {_curl_config_quote(url)}")
+    return lines
+
+def _run_curl_probes(urls, request):
+    """用一个curl进程发送探测请求（request 为 "head" 或 "range = 0-0"），返回各链接的HTTP状态码"""
+    curl_path = get_curl_path()
+    statuses = [None] * len(urls)
+    if not curl_path or not urls:
+        return statuses
+    blocks = []
+    for index, url in enumerate(urls):
+        write_out = f"MJPR {index} %{{http_code}}\\n"
+        lines = [request, "location", "silent",
+                 "connect-timeout = 10",
+                 "max-time = 10",
+                 f"user-agent = {_curl_config_quote(CURL_USER_AGENT)}",
+                 f"output = {_curl_config_quote(os.devnull)}",
+                 f"write-out = {_curl_config_quote(write_out)}"]
+        blocks.append("\n".join(lines + _curl_config_request(url)))
+    cmd = [curl_path, "-K", "-"]
+    if curl_supports_parallel():
+        cmd[1:1] = ["--parallel", "--parallel-max", str(HTTP_POOL_SIZE)]
+    try:
+        completed = run_curl(cmd, input=("\nnext\n".join(blocks) + "\n").encode("utf-8"),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except Exception:
+        return statuses
+    for line in completed.stdout.decode("utf-8", errors="replace").splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == "MJPR" and parts[2].isdigit() and int(parts[2]):
+            statuses[int(parts[1])] = int(parts[2])
+    return statuses
+
+def probe_image_urls_with_curl(urls):
+    """
+    curl方式的变体探测：一个curl进程并行发送HEAD请求（返回405/501的链接改用只取1字节的Range请求），
+    返回与 urls 一一对应的HTTP状态码，网络错误时为None（交给正常下载流程处理）
+    """
+    statuses = _run_curl_probes(urls, "head")
+    fallback = [index for index, status in enumerate(statuses) if status in (405, 501)]
+    for index, status in zip(fallback, _run_curl_probes([urls[index] for index in fallback], "range = 0-0")):
+        statuses[index] = status
+    return statuses
+
+def download_images_with_curl_batch(items):
+    """
+    使用一个curl进程批量下载多张图片，每张只尝试一次（重试由调度器安排）：
+    通过标准输入传入配置文件（-K -），以 --parallel 并行传输（最多 min(图片数, HTTP_POOL_SIZE) 个）并复用连接，
+    每个文件先写入 .tmp（已有时带 If-Range 断点续传），校验通过后再重命名。
+    items 为 (url, save_path) 列表，返回一一对应的 {"ok", "status", "error", "retry_after", "metrics"}
+    """
+    results = [{"ok": False, "status": None, "error": "未找到curl命令", "retry_after": None, "metrics": {}}
+               for _ in items]
+    curl_path = get_curl_path()
+    if not curl_path:
+        print("未找到curl命令，请安装curl后再试")
+        return results
+    downloads = [TempDownload(save_path) for _, save_path in items]
+    config_items = [(url, download, get_header_path(save_path))
+                    for (url, save_path), download in zip(items, downloads)]
+    statuses = {}
+    timings = {}
+    parallel = min(len(items), HTTP_POOL_SIZE)
+    with curl_transfer_slots(parallel) as rate:
+        cmd = [curl_path, "--no-progress-meter", "--parallel", "--parallel-max", str(parallel), "-K", "-"]
+        try:
+            completed = run_curl(cmd, input=_build_curl_batch_config(config_items, rate).encode("utf-8"),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            for line in completed.stdout.decode("utf-8", errors="replace").splitlines():
+                parts = line.split()
+                if len(parts) >= 3 and parts[0] == "MJDL" and parts[2].isdigit():
+                    statuses[int(parts[1])] = int(parts[2])
+                    timings[int(parts[1])] = parse_curl_timings(parts[3:])
+            stderr = completed.stderr.decode("utf-8", errors="replace").strip()
+        except Exception as e:
+            stderr = str(e)
+    failed = False
+    for index, ((url, save_path), download) in enumerate(zip(items, downloads)):
+        status = statuses.get(index) or None
+        headers = read_curl_headers(get_header_path(save_path))
+        result = results[index]
+        result.update(status=status, error=None, metrics=begin_request_metrics())
+        record_request_metrics(status=status, resumed_from=download.offset or None, **timings.get(index, {}))
+        try:
+            if status is None or not 200 <= status < 300:
+                check_range_status(status, download.temp_file)
+                raise DownloadError(f"HTTP {status}" if status else "curl传输失败", status, headers)
+            download.accept_response(status, headers)
+            download.finish()
+            result["ok"] = True
+            log(f"成功下载图片(curl批量方式): {save_path}")
+        except Exception as e:
+            failed = True
+            result.update(error=str(e), retry_after=parse_retry_after(headers.get("Retry-After")))
+            log(f"下载失败(curl批量方式): {str(e)} {url}")
+        finally:
+            download.close()
+    if failed and stderr:
+        log(f"curl错误输出: {stderr}")
+    return results
+
+def download_image_with_curl(url, save_path):
+    """使用curl命令下载图片，响应头写入临时文件以读取 Retry-After"""
+    curl_path = get_curl_path()
+    if not curl_path:
+        print("未找到curl命令，请安装curl后再试")
+        set_last_error("未找到curl命令")
+        return False
+    header_args = []
+    for key, value in get_browser_headers(url).items():
+        if key != "User-Agent":
+            header_args.extend(["-H", f"{key}: {value}"])
+    header_file = get_header_path(save_path)
+    try:
+        with TempDownload(save_path) as download, curl_transfer_slots(1) as rate:
+            record_request_metrics(resumed_from=download.offset or None)
+            cmd = [curl_path, "-s", "-S", "--fail", "-L",
+                   "--connect-timeout", "15",
+                   "--max-time", "30",
+                   "-A", CURL_USER_AGENT,
+                   "-D", header_file,
+                   "-w", f"%{{http_code}} {CURL_TIMING_FORMAT}",
+                   "-o", download.curl_output()] + (["--limit-rate", str(rate)] if rate else [])
+            for header in download.curl_headers():
+                cmd.extend(["-H", header])
+            cmd += header_args + [url]
+            completed = run_curl(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            fields = completed.stdout.decode("utf-8", errors="replace").split()
+            status = int(fields[0]) if fields and fields[0].isdigit() and int(fields[0]) else None
+            record_request_metrics(status=status, **parse_curl_timings(fields[1:]))
+            headers = read_curl_headers(header_file)
+            if status is not None and 200 <= status < 300:
+                # 传输中断时也先保存校验值，保留已下载的部分下次续传
+                download.accept_response(status, headers)
+            if completed.returncode != 0:
+                stderr = completed.stderr.decode("utf-8", errors="replace").strip()
+                status = parse_curl_http_status(stderr) or status
+                if status == 416:
+                    discard_temp_file(download.temp_file)
+                raise DownloadError(f"curl错误码 {completed.returncode}, {stderr}", status, headers)
+            download.finish()
+        log(f"成功下载图片(curl方式): {save_path}")
+        return True
+    except Exception as e:
+        discard_temp_file(header_file)
+        return download_failed("curl方式", e)
+
+class TaskPageCache:
+    """
+    线程安全的任务页面cookie缓存：
+      - 键为 (任务URL, 图片主机)，值为访问任务页面得到的cookie，超过TTL后失效
+      - 同一个键同时只有一个线程访问任务页面，其它线程等待并复用其结果
+      - 下载图片收到401/403时由调用方 invalidate，下次重新访问任务页面
+    """
+
+    def __init__(self, ttl, max_entries=TASK_PAGE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.fetches = 0
+        self._entries = {}
+        self._fetch_locks = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, cookies = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        return cookies
+
+    def get(self, key, fetch):
+        """返回 (cookies, 是否命中缓存)；缓存中没有时调用 fetch() 访问任务页面"""
+        with self._lock:
+            cookies = self._lookup(key)
+            if cookies is not None:
+                self.hits += 1
+                return cookies, True
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+        with fetch_lock:
+            with self._lock:
+                cookies = self._lookup(key)
+                if cookies is not None:
+                    self.hits += 1
+                    return cookies, True
+            try:
+                cookies = fetch()
+                with self._lock:
+                    self.fetches += 1
+                    self._entries[key] = (time.monotonic() + self.ttl, cookies)
+                    self._evict()
+            finally:
+                with self._lock:
+                    self._fetch_locks.pop(key, None)
+        return cookies, False
+
+    def _evict(self):
+        if len(self._entries) <= self.max_entries:
+            return
+        now = time.monotonic()
+        for key in [key for key, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+        # 仍然超出上限时按插入顺序淘汰最早的条目
+        while len(self._entries) > self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+    def invalidate(self, key):
+        """使缓存的cookie失效"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+def configure_task_page_cache(ttl):
+    """设置任务页面cookie缓存的有效期（秒），0表示不缓存"""
+    global TASK_PAGE_CACHE_TTL, _task_page_cache
+    TASK_PAGE_CACHE_TTL = max(0.0, float(ttl))
+    _task_page_cache = None
+
+def get_task_page_cache():
+    """返回进程内共享的任务页面cookie缓存，未启用时返回None"""
+    global _task_page_cache
+    if TASK_PAGE_CACHE_TTL <= 0:
+        return None
+    with _http_session_lock:
+        if _task_page_cache is None:
+            _task_page_cache = TaskPageCache(TASK_PAGE_CACHE_TTL)
+    return _task_page_cache
+
+def print_task_page_cache_stats():
+    """打印任务页面缓存统计"""
+    fetches = _process_stats["page_fetches"] + (_task_page_cache.fetches if _task_page_cache else 0)
+    hits = _process_stats["page_hits"] + (_task_page_cache.hits if _task_page_cache else 0)
+    if fetches == 0:
+        return
+    print(f"任务页面缓存: 访问任务页面 {fetches} 次, 复用 {hits} 次")
+
+def fetch_task_page_cookies(session, task_url):
+    """访问任务页面并返回得到的cookie"""
+    log("正在访问任务页面获取认证信息...")
+    started = time.perf_counter()
+    task_response = session.get(task_url, headers=get_browser_headers(task_url), timeout=15)
+    record_request_metrics(page_ms=elapsed_ms(started))
+    task_response.raise_for_status()
+    return task_response.cookies.get_dict()
+
+def download_image_with_browser_simulation(image_url, task_url, save_path):
+    """通过访问任务URL获取认证信息后下载图片"""
+    if not task_url:
+        log("无法使用浏览器模拟方式：缺少任务URL")
+        set_last_error("缺少任务URL")
+        return False
+    log(f"尝试使用浏览器模拟方式下载: {image_url}")
+    log(f"通过任务链接: {task_url}")
+    cache = get_task_page_cache()
+    cache_key = (task_url, urlparse(image_url).netloc)
+    try:
+        session = get_shared_session()
+        if cache is not None:
+            cookies, cached = cache.get(cache_key, lambda: fetch_task_page_cookies(session, task_url))
+            record_request_metrics(page_cached=cached)
+        else:
+            cookies = fetch_task_page_cookies(session, task_url)
+        log("正在使用获取的认证信息下载图片...")
+        img_headers = get_browser_headers(image_url)
+        img_headers['Referer'] = task_url
+        with TempDownload(save_path) as download:
+            started = time.perf_counter()
+            with session.get(image_url, headers=download.request_headers(img_headers), cookies=cookies,
+                             stream=True, timeout=15) as response:
+                record_request_metrics(ttfb_ms=elapsed_ms(started), status=response.status_code)
+                if response.status_code in (401, 403) and cache is not None:
+                    # 认证信息可能已失效，下次尝试重新访问任务页面
+                    cache.invalidate(cache_key)
+                download.open(response.status_code, response.headers)
+                for chunk in response.iter_content(chunk_size=65536):
+                    throttle_bandwidth(download.write(chunk))
+            download.finish()
+        log(f"成功下载图片(浏览器模拟方式): {save_path}")
+        return True
+    except Exception as e:
+        return download_failed("浏览器模拟方式", e)
+
+def configure_async_engine(concurrency):
+    """设置async方式下的最大并发请求数"""
+    global ASYNC_CONCURRENCY
+    ASYNC_CONCURRENCY = max(1, int(concurrency))
+
+def _import_httpx():
+    """按需导入httpx（h2方式的可选依赖，需同时安装h2），未安装时返回None"""
+    try:
+        import httpx
+        import h2  # noqa: F401  httpx的HTTP/2支持依赖h2
+        return httpx
+    except ImportError:
+        return None
+
+def configure_h2(max_connections=H2_MAX_CONNECTIONS, max_streams=H2_MAX_STREAMS):
+    """设置h2方式的HTTP/2连接数与每个主机的并发流数上限，已创建的客户端会被关闭并在下次使用时重建"""
+    global H2_MAX_CONNECTIONS, H2_MAX_STREAMS
+    with _h2_lock:
+        H2_MAX_CONNECTIONS = max(1, int(max_connections))
+        H2_MAX_STREAMS = max(1, int(max_streams))
+        for client in _h2_clients.values():
+            client.close()
+        _h2_clients.clear()
+        _h2_stream_slots.clear()
+
+def get_h2_client(scheme):
+    """
+    返回进程内共享的HTTP/2客户端（线程安全）：https 通过ALPN协商HTTP/2，服务器不支持时退回HTTP/1.1；
+    http 地址直接使用h2c（prior knowledge），用于本地的h2测试服务器
+    """
+    with _h2_lock:
+        client = _h2_clients.get(scheme)
+        if client is None:
+            httpx = _import_httpx()
+            if httpx is None:
+                raise RuntimeError('未安装httpx[http2]，无法使用h2下载方式，请执行: pip install "httpx[http2]"')
+            limits = httpx.Limits(max_connections=H2_MAX_CONNECTIONS, max_keepalive_connections=H2_MAX_CONNECTIONS)
+            timeout = httpx.Timeout(30.0, connect=15.0, read=15.0)
+            client = httpx.Client(http2=True, http1=(scheme == "https"), limits=limits, timeout=timeout,
+                                  follow_redirects=True)
+            _h2_clients[scheme] = client
+        return client
+
+def get_h2_stream_slot(host):
+    """返回限制该主机同时在途流数的信号量"""
+    with _h2_lock:
+        slot = _h2_stream_slots.get(host)
+        if slot is None:
+            slot = _h2_stream_slots[host] = threading.BoundedSemaphore(H2_MAX_STREAMS)
+        return slot
+
+def _h2_trace(event_name, info):
+    """httpx请求跟踪回调：记录新建连接与TLS握手的耗时"""
+    if event_name == "connection.connect_tcp.started":
+        _h2_trace_local.connect_started = time.perf_counter()
+    elif event_name == "connection.connect_tcp.complete":
+        record_request_metrics(connect_ms=elapsed_ms(_h2_trace_local.connect_started))
+        with _h2_lock:
+            _h2_stats["connections"] += 1
+    elif event_name == "connection.start_tls.started":
+        _h2_trace_local.tls_started = time.perf_counter()
+    elif event_name == "connection.start_tls.complete":
+        record_request_metrics(tls_ms=elapsed_ms(_h2_trace_local.tls_started))
+
+def download_image_with_h2(url, save_path):
+    """使用HTTP/2下载图片：所有线程共用少量连接多路复用，每张图片占用一个流，不再受每主机连接数限制"""
+    headers = get_browser_headers(url)
+    # HTTP/2禁止逐跳首部；br压缩需要额外的库，图片本身也不会压缩
+    headers.pop("Connection", None)
+    headers["Accept-Encoding"] = "gzip, deflate"
+    try:
+        parsed_url = urlparse(url)
+        client = get_h2_client(parsed_url.scheme)
+        with TempDownload(save_path) as download, get_h2_stream_slot(parsed_url.netloc):
+            started = time.perf_counter()
+            with client.stream("GET", url, headers=download.request_headers(headers),
+                               extensions={"trace": _h2_trace}) as response:
+                with _h2_lock:
+                    _h2_stats["requests"] += 1
+                record_request_metrics(ttfb_ms=elapsed_ms(started), status=response.status_code,
+                                       http_version=response.http_version)
+                download.open(response.status_code, response.headers)
+                for chunk in response.iter_bytes(65536):
+                    throttle_bandwidth(download.write(chunk))
+            download.finish()
+        log(f"成功下载图片(h2方式): {save_path}")
+        return True
+    except Exception as e:
+        return download_failed("h2方式", e)
+
+def _import_aiohttp():
+    """按需导入aiohttp（async方式的可选依赖），未安装时返回None"""
+    try:
+        import aiohttp
+        return aiohttp
+    except ImportError:
+        print("未安装aiohttp，无法使用async下载方式，请执行: pip install aiohttp")
+        return None
+
+def _create_trace_config(aiohttp):
+    """创建记录DNS解析、建立连接与连接复用的aiohttp跟踪配置"""
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_dns_start(session, context, params):
+        context.dns_started = time.perf_counter()
+
+    async def on_dns_end(session, context, params):
+        record_request_metrics(dns_ms=elapsed_ms(context.dns_started))
+
+    async def on_connect_start(session, context, params):
+        context.connect_started = time.perf_counter()
+
+    async def on_connect_end(session, context, params):
+        record_request_metrics(connect_ms=elapsed_ms(context.connect_started), reused=False)
+
+    async def on_connection_reused(session, context, params):
+        record_request_metrics(reused=True)
+
+    trace_config.on_dns_resolvehost_start.append(on_dns_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_end)
+    trace_config.on_connection_create_start.append(on_connect_start)
+    trace_config.on_connection_create_end.append(on_connect_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reused)
+    return trace_config
+
+def _create_async_session(aiohttp, concurrency):
+    """创建async方式使用的aiohttp会话，连接数上限与并发数一致"""
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=30, sock_connect=15, sock_read=15)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                 trace_configs=[_create_trace_config(aiohttp)])
+
+async def _async_warm_up_host(session, url, headers, warmed_hosts):
+    """async方式下的主机预热，每次运行中每个主机最多一次"""
+    parsed_url = urlparse(url)
+    domain = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    if domain in warmed_hosts:
+        return
+    warmed_hosts.add(domain)
+    try:
+        async with session.get(domain, headers=headers) as response:
+            await response.read()
+    except Exception as e:
+        log(f"预热连接失败 ({domain}): {str(e)}")
+
+async def download_image_async(session, url, save_path, warmed_hosts=None):
+    """在事件循环中下载图片，边接收边写入磁盘"""
+    headers = get_browser_headers(url)
+    if warmed_hosts is not None:
+        await _async_warm_up_host(session, url, headers, warmed_hosts)
+    try:
+        with TempDownload(save_path) as download:
+            started = time.perf_counter()
+            async with session.get(url, headers=download.request_headers(headers)) as response:
+                record_request_metrics(ttfb_ms=elapsed_ms(started), status=response.status)
+                download.open(response.status, response.headers)
+                async for chunk in response.content.iter_chunked(65536):
+                    await throttle_bandwidth_async(download.write(chunk))
+            download.finish()
+        log(f"成功下载图片(async方式): {save_path}")
+        return True
+    except Exception as e:
+        return download_failed("async方式", e)
+
+def download_image_with_async(url, save_path):
+    """使用asyncio + aiohttp下载单张图片（批量下载请使用 run_async_downloads）"""
+    import asyncio
+
+    aiohttp = _import_aiohttp()
+    if aiohttp is None:
+        set_last_error("未安装aiohttp")
+        return False
+
+    async def _run():
+        async with _create_async_session(aiohttp, 1) as session:
+            return await download_image_async(session, url, save_path, set())
+
+    return asyncio.run(_run())
+
+def download_image(url, save_path, task_url=None, method="curl"):
+    """
+    根据用户选择的方式下载图片，不进行依次尝试；每次调用只尝试一次，
+    失败原因由 pop_last_error() 取出，是否重试由调度器决定
+    """
+    log(f"正在下载图片: {url}")
+    if method == "curl":
+        return download_image_with_curl(url, save_path)
+    elif method == "browser":
+        return download_image_with_browser_simulation(url, task_url, save_path)
+    elif method == "requests":
+        return download_image_with_requests(url, save_path)
+    elif method == "urllib":
+        return download_image_with_urllib(url, save_path)
+    elif method == "async":
+        return download_image_with_async(url, save_path)
+    elif method == "h2":
+        return download_image_with_h2(url, save_path)
+    else:
+        print("不支持的下载方式")
+        set_last_error("不支持的下载方式")
+        return False
+
+def parse_retry_after(value):
+    """解析 Retry-After 响应头（秒数或HTTP日期），返回等待秒数，无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        import email.utils
+
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def parse_curl_http_status(stderr):
+    """从curl --fail 的错误输出中提取HTTP状态码"""
+    match = re.search(r"returned error: (\d{3})", stderr or "")
+    return int(match.group(1)) if match else None
+
+def set_last_error(message, exc=None, status=None, retry_after=None):
+    """
+    记录当前线程/协程最近一次下载失败的原因。
+    传入异常时从中提取HTTP状态码和 Retry-After（兼容 requests、urllib 和 aiohttp 的异常）。
+    """
+    if exc is not None:
+        response = getattr(exc, "response", None)
+        code = getattr(response, "status_code", None) or getattr(exc, "status", None) or getattr(exc, "code", None)
+        if isinstance(code, int):
+            status = code
+        headers = getattr(response, "headers", None) or getattr(exc, "headers", None)
+        if headers is not None:
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+    _last_error.set({"message": message, "status": status, "retry_after": retry_after})
+
+def pop_last_error():
+    """取出并清空最近一次下载失败的信息：{"message", "status", "retry_after"}"""
+    failure = _last_error.get() or {"message": "", "status": None, "retry_after": None}
+    _last_error.set(None)
+    return failure
+
+def file_sha256(path):
+    """计算文件的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class DownloadManifest:
+    """
+    输出目录中的下载清单（SQLite），以 (任务ID, 图片URL) 为主键记录：
+    状态(pending/done/failed)、字节数、内容哈希、尝试次数和最后一次错误。
+    下载开始前写入pending，成功后改为done；被中断的任务保持pending，下次运行会重新下载。
+    写入每隔 commit_interval 秒提交一次，为0时每次写入立即提交。
+    """
+
+    def __init__(self, output_dir, commit_interval=1.0):
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS downloads ("
+            " task_id TEXT NOT NULL,"
+            " url TEXT NOT NULL,"
+            " image_path TEXT,"
+            " status TEXT NOT NULL,"
+            " size INTEGER,"
+            " sha256 TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT,"
+            " updated_at REAL,"
+            " PRIMARY KEY (task_id, url))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_url ON downloads (url)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS missing ("
+            " url TEXT PRIMARY KEY,"
+            " status INTEGER,"
+            " checked_at REAL)"
+        )
+        self.conn.commit()
+        self.last_commit = time.time()
+
+    def _execute(self, sql, params):
+        with self.lock:
+            self.conn.execute(sql, params)
+            if time.time() - self.last_commit >= self.commit_interval:
+                self.conn.commit()
+                self.last_commit = time.time()
+
+    def get(self, task_id, url):
+        """返回任务记录字典，不存在时返回None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, size, sha256, attempts, last_error, image_path FROM downloads"
+                " WHERE task_id = ? AND url = ?", (task_id, url)).fetchone()
+        if row is None:
+            return None
+        keys = ("status", "size", "sha256", "attempts", "last_error", "image_path")
+        return dict(zip(keys, row))
+
+    def find_stored_by_url(self, url):
+        """
+        返回同一URL任意已完成任务的 (内容哈希, 保存时的图片路径)，用于内容寻址存储直接复用；
+        图片路径的扩展名是按实际内容确定的（例如首选webp时退回的png），没有记录时返回None
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT sha256, image_path FROM downloads WHERE url = ? AND status = 'done' AND sha256 IS NOT NULL"
+                " LIMIT 1", (url,)).fetchone()
+        return tuple(row) if row else None
+
+    def mark_pending(self, task_id, url, image_path):
+        self._execute(
+            "INSERT INTO downloads (task_id, url, image_path, status, attempts, updated_at)"
+            " VALUES (?, ?, ?, 'pending', 1, ?)"
+            " ON CONFLICT(task_id, url) DO UPDATE SET status = 'pending', image_path = excluded.image_path,"
+            " attempts = attempts + 1, updated_at = excluded.updated_at",
+            (task_id, url, image_path, time.time()))
+
+    def mark_done(self, task_id, url, image_path, size, sha256):
+        self._execute(
+            "INSERT INTO downloads (task_id, url, image_path, status, size, sha256, updated_at)"
+            " VALUES (?, ?, ?, 'done', ?, ?, ?)"
+            " ON CONFLICT(task_id, url) DO UPDATE SET status = 'done', image_path = excluded.image_path,"
+            " size = excluded.size, sha256 = excluded.sha256, last_error = NULL,"
+            " updated_at = excluded.updated_at",
+            (task_id, url, image_path, size, sha256, time.time()))
+
+    def mark_failed(self, task_id, url, image_path, error):
+        self._execute(
+            "INSERT INTO downloads (task_id, url, image_path, status, last_error, updated_at)"
+            " VALUES (?, ?, ?, 'failed', ?, ?)"
+            " ON CONFLICT(task_id, url) DO UPDATE SET status = 'failed', last_error = excluded.last_error,"
+            " updated_at = excluded.updated_at",
+            (task_id, url, image_path, error, time.time()))
+
+    def find_missing(self, url, max_age):
+        """URL在 max_age 秒内被确认不存在时返回当时的HTTP状态码，否则返回None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status FROM missing WHERE url = ? AND checked_at > ?",
+                (url, time.time() - max_age)).fetchone()
+        return row[0] if row else None
+
+    def mark_missing(self, url, status):
+        self._execute(
+            "INSERT INTO missing (url, status, checked_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(url) DO UPDATE SET status = excluded.status, checked_at = excluded.checked_at",
+            (url, status, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+def configure_manifest(enabled):
+    """启用或禁用下载清单"""
+    global MANIFEST_ENABLED
+    MANIFEST_ENABLED = bool(enabled)
+
+def get_manifest(output_dir):
+    """返回输出目录对应的下载清单（按目录缓存），禁用或无法创建时返回None"""
+    if not MANIFEST_ENABLED:
+        return None
+    key = os.path.abspath(output_dir)
+    with _manifests_lock:
+        manifest = _manifests.get(key)
+        if manifest is None:
+            try:
+                manifest = DownloadManifest(key, MANIFEST_COMMIT_INTERVAL)
+            except sqlite3.Error as e:
+                print(f"无法打开下载清单，将仅按文件是否存在判断 ({key}): {str(e)}")
+                manifest = False
+            _manifests[key] = manifest
+    return manifest or None
+
+def close_manifests():
+    """提交并关闭所有已打开的下载清单"""
+    with _manifests_lock:
+        for manifest in _manifests.values():
+            if manifest:
+                manifest.close()
+        _manifests.clear()
+
+def normalize_image_url(url):
+    """规范化图片URL用于去重：协议和主机名转小写，去掉查询参数与锚点"""
+    parsed_url = urlparse(url.strip())
+    return f"{parsed_url.scheme.lower()}://{parsed_url.netloc.lower()}{parsed_url.path}"
+
+def reset_task_dedup():
+    """清空本次运行的去重记录"""
+    global _duplicate_count
+    with _seen_tasks_lock:
+        _seen_tasks.clear()
+        _duplicate_count = 0
+
+def task_dedup_key(task):
+    """(任务ID, 规范化图片URL) 的16字节摘要，作为去重记录的键"""
+    key = f"{task[3]}\n{normalize_image_url(task[0])}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+def dedup_tasks(tasks):
+    """
+    跨CSV去重：以 (任务ID, 规范化图片URL) 为键，同一次运行中重复出现的任务只保留第一个。
+    多个导出文件（top/likes/用户页）包含同一作品时，图片只会排入下载队列一次。
+    """
+    global _duplicate_count
+    for task in tasks:
+        key = task_dedup_key(task)
+        with _seen_tasks_lock:
+            if key in _seen_tasks:
+                _seen_tasks.move_to_end(key)
+                _duplicate_count += 1
+                continue
+            _seen_tasks[key] = None
+            if len(_seen_tasks) > DEDUP_WINDOW:
+                _seen_tasks.popitem(last=False)
+        yield task
+
+def configure_content_store(enabled):
+    """启用或禁用内容寻址存储"""
+    global CONTENT_STORE_ENABLED
+    CONTENT_STORE_ENABLED = bool(enabled)
+
+def get_blob_path(output_dir, sha256, ext):
+    """返回内容哈希对应的存储路径：<输出目录>/.blobs/<前两位>/<哈希><扩展名>"""
+    return os.path.join(output_dir, CONTENT_STORE_DIRNAME, sha256[:2], f"{sha256}{ext}")
+
+def link_blob(blob_path, image_path):
+    """把任务文件名链接到存储中的数据：优先硬链接，其次符号链接，都不支持时复制"""
+    if os.path.lexists(image_path):
+        os.remove(image_path)
+    try:
+        os.link(blob_path, image_path)
+    except OSError:
+        try:
+            os.symlink(os.path.relpath(blob_path, os.path.dirname(image_path)), image_path)
+        except OSError:
+            shutil.copyfile(blob_path, image_path)
+
+def store_in_content_store(image_path, sha256):
+    """把刚下载的图片移入内容寻址存储，相同内容只保留一份"""
+    blob_path = get_blob_path(os.path.dirname(image_path), sha256, os.path.splitext(image_path)[1])
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    if os.path.exists(blob_path):
+        os.remove(image_path)
+    else:
+        os.replace(image_path, blob_path)
+    link_blob(blob_path, image_path)
+
+class ShardWriter:
+    """
+    WebDataset风格的分片写入器（线程安全）：
+      - 每个样本以 <key>.<图片扩展名>、<key>.txt（Prompt）、<key>.json（元数据）三个成员写入当前tar分片
+      - 分片超过 max_bytes 后关闭并开始下一个（shards/shard-000000.tar、shard-000001.tar ...），
+        再次运行时从已有分片之后继续编号
+      - 每个样本在 metadata.jsonl 中追加一行：所在分片、成员名、图片链接、Prompt以及CSV中的其它列；
+        多进程下载时各子进程写入自己的 metadata-pN.jsonl，由主进程合并（merge_metadata_indexes）
+    """
+
+    def __init__(self, output_dir, max_bytes):
+        self.output_dir = output_dir
+        self.shard_dir = os.path.join(output_dir, SHARD_DIRNAME)
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.next_index = self._next_shard_index()
+        self.tar = None
+        self.shard_name = None
+        self.index_path = get_metadata_index_path(output_dir)
+        self.index_file = open(self.index_path, "a", encoding="utf-8")
+        self.samples = 0
+
+    def _next_shard_index(self):
+        indexes = [int(match.group(1)) for match in
+                   (re.match(rf"shard-{re.escape(SHARD_NAME_TAG)}(\d+)\.tar$", name)
+                    for name in os.listdir(self.shard_dir)) if match]
+        return max(indexes) + 1 if indexes else 0
+
+    def _open_next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        self.shard_name = f"shard-{SHARD_NAME_TAG}{self.next_index:06d}.tar"
+        self.next_index += 1
+        self.tar = tarfile.open(os.path.join(self.shard_dir, self.shard_name), "w", format=tarfile.PAX_FORMAT)
+
+    def _add_member(self, name, fileobj, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self.tar.addfile(info, fileobj)
+
+    def add(self, key, image_path, prompt_text, metadata):
+        """把一个样本写入当前分片并追加到元数据索引，返回样本在分片中的位置 "shards/<分片名>/<成员名>" """
+        image_name = key + (os.path.splitext(image_path)[1].lower() or ".png")
+        image_size = os.path.getsize(image_path)
+        prompt = prompt_text.encode("utf-8")
+        sample = json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+        with self.lock:
+            if self.tar is None or (self.samples and self.tar.offset + image_size > self.max_bytes):
+                self._open_next_shard()
+            with open(image_path, "rb") as f:
+                self._add_member(image_name, f, image_size)
+            self._add_member(f"{key}.txt", io.BytesIO(prompt), len(prompt))
+            self._add_member(f"{key}.json", io.BytesIO(sample), len(sample))
+            self.tar.fileobj.flush()
+            record = dict(metadata, key=key, shard=self.shard_name, image=image_name, size=image_size)
+            self.index_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.samples += 1
+            return f"{SHARD_DIRNAME}/{self.shard_name}/{image_name}"
+
+    def close(self):
+        with self.lock:
+            if self.tar is not None:
+                self.tar.close()
+                self.tar = None
+            self.index_file.close()
+        if METADATA_INDEX_FORMAT == "parquet" and not SHARD_NAME_TAG:
+            write_parquet_index(self.index_path)
+
+def get_metadata_index_path(output_dir):
+    """元数据索引路径：子进程中为 metadata-pN.jsonl，避免多个进程追加同一个文件"""
+    base, ext = os.path.splitext(METADATA_INDEX_FILENAME)
+    tag = f"-{SHARD_NAME_TAG.rstrip('-')}" if SHARD_NAME_TAG else ""
+    return os.path.join(output_dir, f"{base}{tag}{ext}")
+
+def merge_metadata_indexes(output_dir):
+    """
+    多进程分片输出结束后由主进程调用：把各子进程的元数据索引（包括之前中断留下的）追加到 metadata.jsonl
+    并删除，需要时生成一次Parquet索引
+    """
+    base, ext = os.path.splitext(METADATA_INDEX_FILENAME)
+    index_path = os.path.join(output_dir, METADATA_INDEX_FILENAME)
+    parts = sorted(name for name in os.listdir(output_dir) if fnmatch.fnmatch(name, f"{base}-p*{ext}"))
+    if parts:
+        with open(index_path, "a", encoding="utf-8") as index_file:
+            for name in parts:
+                with open(os.path.join(output_dir, name), encoding="utf-8") as f:
+                    shutil.copyfileobj(f, index_file)
+                os.remove(os.path.join(output_dir, name))
+    if METADATA_INDEX_FORMAT == "parquet" and os.path.exists(index_path):
+        write_parquet_index(index_path)
+
+def write_parquet_index(index_path):
+    """把JSON Lines元数据索引转换为同名的Parquet文件（需要pyarrow）"""
+    try:
+        import pyarrow.json
+        import pyarrow.parquet
+    except ImportError:
+        print("未安装pyarrow，元数据索引仅保存为JSON Lines，请执行: pip install pyarrow")
+        return
+    parquet_path = os.path.splitext(index_path)[0] + ".parquet"
+    pyarrow.parquet.write_table(pyarrow.json.read_json(index_path), parquet_path)
+    print(f"元数据索引已写入: {parquet_path}")
+
+def configure_output_format(output_format, shard_size_mb=1024, index_format="jsonl"):
+    """设置输出方式（files：逐个图片与txt文件；shards：tar分片）、分片大小上限（MB）和元数据索引格式"""
+    global OUTPUT_FORMAT, SHARD_MAX_BYTES, METADATA_INDEX_FORMAT
+    OUTPUT_FORMAT = output_format
+    SHARD_MAX_BYTES = max(1, int(shard_size_mb * 1024 * 1024))
+    METADATA_INDEX_FORMAT = index_format
+    if OUTPUT_FORMAT == "shards" and not MANIFEST_ENABLED:
+        print("提示: 分片输出依靠下载清单判断已完成的任务，使用 --no-manifest 时再次运行会重复下载")
+
+def use_shard_output():
+    """是否把下载结果写入tar分片"""
+    return OUTPUT_FORMAT == "shards"
+
+def get_shard_writer(output_dir):
+    """返回输出目录对应的分片写入器（按目录缓存）"""
+    key = os.path.abspath(output_dir)
+    with _shard_writers_lock:
+        writer = _shard_writers.get(key)
+        if writer is None:
+            writer = _shard_writers[key] = ShardWriter(key, SHARD_MAX_BYTES)
+    return writer
+
+def close_shard_writers():
+    """关闭所有分片写入器"""
+    with _shard_writers_lock:
+        for writer in _shard_writers.values():
+            writer.close()
+            print(f"分片输出: {writer.samples} 个样本已写入 {writer.shard_dir}")
+        _shard_writers.clear()
+
+def write_to_shard(task, image_path, sha256):
+    """把下载完成的图片和Prompt写入分片后删除临时图片，返回样本在分片中的位置"""
+    image_url, _, task_url, task_id, prompt_text, extended_mode, download_method, metadata = task
+    sample = {"task_id": task_id, "image_url": image_url, "task_url": task_url, "prompt": prompt_text,
+              "sha256": sha256}
+    sample.update(metadata or {})
+    # WebDataset按文件名中第一个点分隔样本键和扩展名
+    key = task_id.replace(".", "_")
+    location = get_shard_writer(os.path.dirname(image_path)).add(key, image_path, prompt_text, sample)
+    os.remove(image_path)
+    return location
+
+def _import_pil():
+    """按需导入Pillow（下载后处理的可选依赖），未安装时返回None"""
+    try:
+        from PIL import Image
+        return Image
+    except ImportError:
+        return None
+
+def parse_reencode(value):
+    """解析 --reencode 参数，如 webp、jpeg:85，返回 (格式, 质量)"""
+    image_format, _, quality = str(value).strip().lower().partition(":")
+    image_format = "jpeg" if image_format == "jpg" else image_format
+    if image_format not in IMAGE_FORMATS:
+        raise argparse.ArgumentTypeError(f"派生图片格式应为 {', '.join(IMAGE_FORMATS)} 之一: {value}")
+    if not quality:
+        return image_format, DERIVED_QUALITY
+    if not quality.isdigit() or not 1 <= int(quality) <= 100:
+        raise argparse.ArgumentTypeError(f"图片质量应为1～100的整数: {value}")
+    return image_format, int(quality)
+
+def configure_postprocess(verify=False, resize=0, thumbnail=0, reencode=None, workers=0):
+    """
+    设置下载后处理：verify 只校验图片能否完整解码；resize 为派生副本的最长边像素，
+    reencode 为派生图片的格式（如 "webp:90" 或 ("webp", 90)，None 表示沿用原图格式），
+    thumbnail 为缩略图的最长边像素；设置了 resize/reencode/thumbnail 时同样会校验图片
+    """
+    global POSTPROCESS_VERIFY, RESIZE_MAX_EDGE, THUMBNAIL_SIZE, DERIVED_FORMAT, DERIVED_QUALITY, POSTPROCESS_WORKERS
+    if isinstance(reencode, str):
+        reencode = parse_reencode(reencode)
+    POSTPROCESS_VERIFY = bool(verify)
+    RESIZE_MAX_EDGE = max(0, int(resize or 0))
+    THUMBNAIL_SIZE = max(0, int(thumbnail or 0))
+    DERIVED_FORMAT, DERIVED_QUALITY = reencode if reencode else (None, DERIVED_QUALITY)
+    POSTPROCESS_WORKERS = max(0, int(workers or 0))
+
+def postprocess_enabled():
+    """是否对下载完成的图片进行后处理"""
+    return POSTPROCESS_VERIFY or RESIZE_MAX_EDGE > 0 or THUMBNAIL_SIZE > 0 or DERIVED_FORMAT is not None
+
+def get_postprocess_pool():
+    """
+    返回进程内共享的处理进程池（首次使用时创建）。
+    多进程下载的子进程不能再创建子进程，此时改用线程池（Pillow解码与缩放时会释放GIL）。
+    """
+    global _postprocess_pool
+    with _postprocess_lock:
+        if _postprocess_pool is None:
+            workers = POSTPROCESS_WORKERS or os.cpu_count() or 1
+            if multiprocessing.current_process().daemon:
+                _postprocess_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            else:
+                _postprocess_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _postprocess_pool
+
+def close_postprocess_pool():
+    """等待处理中的图片完成并关闭处理进程池"""
+    global _postprocess_pool
+    with _postprocess_lock:
+        pool, _postprocess_pool = _postprocess_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+def print_postprocess_stats():
+    """打印下载后处理统计"""
+    verified = _process_stats["verified"] + _postprocess_stats["verified"]
+    if verified == 0:
+        return
+    corrupt = _process_stats["corrupt"] + _postprocess_stats["corrupt"]
+    derived = _process_stats["derived"] + _postprocess_stats["derived"]
+    print(f"下载后处理: 校验图片 {verified} 张, 损坏后重新下载 {corrupt} 次, 生成派生图片 {derived} 个")
+
+def _postprocess_options():
+    """传给处理进程的参数（处理进程不共享本进程的模块配置）"""
+    return {"resize": RESIZE_MAX_EDGE, "thumbnail": THUMBNAIL_SIZE, "format": DERIVED_FORMAT,
+            "quality": DERIVED_QUALITY, "derived_dir": DERIVED_DIRNAME, "thumbnail_dir": THUMBNAIL_DIRNAME}
+
+def _save_derived_image(image, path, image_format, quality):
+    """保存派生图片：先写临时文件再重命名，不会留下写了一半的文件"""
+    if image_format == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGBA")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = get_temp_path(path)
+    image.save(temp_path, format=image_format.upper(), quality=quality)
+    os.replace(temp_path, path)
+
+def _save_thumbnail_grid(Image, thumbnail_dir, group, ext, options):
+    """扩展模式下同一任务的4张缩略图都已生成时，拼成一张2x2的总览图，返回是否生成"""
+    paths = [os.path.join(thumbnail_dir, f"{group}_{index}{ext}") for index in range(4)]
+    if not all(os.path.exists(path) for path in paths):
+        return False
+    size = options["thumbnail"]
+    grid = Image.new("RGB", (size * 2, size * 2), "white")
+    for index, path in enumerate(paths):
+        with Image.open(path) as cell:
+            cell.load()
+            grid.paste(cell, ((index % 2) * size + (size - cell.width) // 2,
+                              (index // 2) * size + (size - cell.height) // 2))
+    _save_derived_image(grid, os.path.join(thumbnail_dir, f"{group}_grid{ext}"),
+                        options["format"] or "jpeg", options["quality"])
+    return True
+
+def describe_decode_error(exc):
+    """解码失败的原因：异常类型加上去掉对象repr（如 <_io.BytesIO object at 0x...>）后的消息"""
+    message = re.sub(r"\s*<[^<>]* at 0x[0-9a-fA-F]+>", "", str(exc)).strip()
+    return f"图片解码失败: {type(exc).__name__}" + (f" ({message})" if message else "")
+
+def process_image_bytes(data, image_path, options):
+    """
+    处理进程中执行：完整解码图片以校验是否损坏，计算SHA-256，并按 options 生成派生图片。
+    返回 {"ok", "error", "sha256", "derived", "process_ms"}
+    """
+    started = time.perf_counter()
+    outcome = {"ok": True, "error": None, "sha256": hashlib.sha256(data).hexdigest(), "derived": 0}
+    Image = _import_pil()
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        outcome.update(ok=False, error=describe_decode_error(e), process_ms=elapsed_ms(started))
+        return outcome
+    output_dir, name = os.path.split(image_path)
+    stem = os.path.splitext(name)[0]
+    source_format = (image.format or "png").lower()
+    if options["resize"] or options["format"]:
+        image_format = options["format"] or (source_format if source_format in IMAGE_FORMATS else "png")
+        derived = image.copy()
+        if options["resize"]:
+            derived.thumbnail((options["resize"], options["resize"]), Image.LANCZOS)
+        _save_derived_image(derived, os.path.join(output_dir, options["derived_dir"],
+                                                  stem + FORMAT_EXTENSIONS[image_format]),
+                            image_format, options["quality"])
+        outcome["derived"] += 1
+    if options["thumbnail"]:
+        image_format = options["format"] or "jpeg"
+        ext = FORMAT_EXTENSIONS[image_format]
+        thumbnail_dir = os.path.join(output_dir, options["thumbnail_dir"])
+        thumbnail = image.copy()
+        thumbnail.thumbnail((options["thumbnail"], options["thumbnail"]), Image.LANCZOS)
+        _save_derived_image(thumbnail, os.path.join(thumbnail_dir, stem + ext), image_format, options["quality"])
+        outcome["derived"] += 1
+        match = re.fullmatch(r"(.+)_[0-3]", stem)
+        if match and _save_thumbnail_grid(Image, thumbnail_dir, match.group(1), ext, options):
+            outcome["derived"] += 1
+    image.close()
+    outcome["process_ms"] = elapsed_ms(started)
+    return outcome
+
+def submit_postprocess(image_path, data=None):
+    """
+    把刚下载完成的图片提交到处理进程池，返回Future；data 为下载时留在内存中的内容，
+    没有时（curl写入的文件）读取一次文件，之后计算SHA-256也不再读取
+    """
+    if data is None:
+        with open(image_path, "rb") as f:
+            data = f.read()
+    return get_postprocess_pool().submit(process_image_bytes, data, image_path, _postprocess_options())
+
+def complete_postprocess(task, processed):
+    """
+    记录一张图片的处理结果，返回图片是否完好：
+    损坏的图片被删除，由调用方重新下载
+    """
+    with _postprocess_lock:
+        _postprocess_stats["verified"] += 1
+        _postprocess_stats["derived"] += processed["derived"]
+        if not processed["ok"]:
+            _postprocess_stats["corrupt"] += 1
+    if processed["ok"]:
+        return True
+    log(f"图片已损坏，将重新下载: {task[1]} ({processed['error']})")
+    discard_temp_file(task[1])
+    return False
+
+def _postprocess_error(exc):
+    """处理进程本身出错（不是图片损坏）时保留图片，只记录日志"""
+    log(f"下载后处理出错，保留已下载的图片: {str(exc)}")
+    return {"ok": True, "error": None, "sha256": None, "derived": 0, "process_ms": None}
+
+def start_postprocess(task, latency, metrics):
+    """
+    下载成功后把图片交给处理进程池，不等待处理完成：返回带 postprocess（Future）的尝试结果，
+    下载线程或协程立即去下载下一张图片；处理完成后由调度循环调用 finish_postprocess 结束这次尝试
+    """
+    body = pop_downloaded_body(task[1]) or {}
+    try:
+        future = submit_postprocess(task[1], body.get("data"))
+    except Exception as e:
+        future = concurrent.futures.Future()
+        future.set_exception(e)
+    return {"postprocess": future, "latency": latency, "metrics": metrics}
+
+def finish_postprocess(task, attempt, pending):
+    """
+    图片处理完成后结束这次下载尝试（pending 为 start_postprocess 的返回值），处理耗时记入 process_ms：
+    图片完好时完成任务；损坏时删除图片，与下载失败一样由调度器延迟后重新下载
+    """
+    _request_metrics.set(pending["metrics"])
+    try:
+        processed = pending["postprocess"].result()
+    except Exception as e:
+        processed = _postprocess_error(e)
+    record_request_metrics(process_ms=processed["process_ms"])
+    if not complete_postprocess(task, processed):
+        set_last_error(processed["error"])
+        processed = None
+    return _attempt_outcome(task, attempt, processed is not None, pending["latency"], pending["metrics"], processed)
+
+def task_result(task, success, **extra):
+    """生成任务结果字典，extra 中可附带 skipped、error、attempts、status、metrics 等信息"""
+    result = {"task_id": task[3], "image_url": task[0], "image_path": task[1],
+              "method": task[6], "success": success}
+    result.update(extra)
+    return result
+
+def link_from_content_store(task, manifest):
+    """
+    同一URL的图片已在存储中时直接链接，无需再次下载。
+    成功时返回任务结果，否则返回None。
+    """
+    image_url, image_path, task_url, task_id, prompt_text, extended_mode, download_method, metadata = task
+    stored = manifest.find_stored_by_url(image_url)
+    if stored is None:
+        return None
+    sha256, stored_path = stored
+    # 存储中的文件按下载时的实际格式命名，任务文件名也使用同样的扩展名
+    ext = os.path.splitext(stored_path or image_path)[1]
+    blob_path = get_blob_path(os.path.dirname(image_path), sha256, ext)
+    if not os.path.exists(blob_path):
+        return None
+    image_path = os.path.splitext(image_path)[0] + ext
+    link_blob(blob_path, image_path)
+    write_prompt_file(os.path.splitext(image_path)[0] + ".txt", prompt_text, task_id)
+    manifest.mark_done(task_id, image_url, image_path, os.path.getsize(blob_path), sha256)
+    log(f"从内容存储复用图片: {image_path}")
+    return task_result(task, True, skipped=True, image_path=image_path)
+
+def write_prompt_file(txt_path, prompt_text, task_id):
+    """保存Prompt文本文件"""
+    try:
+        with open(txt_path, "w", encoding="utf-8") as f:
+            f.write(prompt_text)
+        log(f"成功保存Prompt文本: {txt_path}")
+    except Exception as e:
+        log(f"保存Prompt文本失败 ({task_id}): {str(e)}")
+
+def check_existing_task(task):
+    """
+    检查任务是否已完成：
+    下载清单中记录为done时直接跳过（一次索引查询，不访问输出文件）；
+    记录为pending/failed时重新下载（可能是被中断的残缺文件）；
+    清单中没有记录时按文件判断：图片和文本文件都存在时跳过，仅图片存在时补写文本文件。
+    跳过时返回任务结果，需要下载时返回None。
+    """
+    image_url, image_path, task_url, task_id, prompt_text, extended_mode, download_method, metadata = task
+    txt_path = os.path.splitext(image_path)[0] + ".txt"
+    manifest = get_manifest(os.path.dirname(image_path))
+    if manifest is not None:
+        record = manifest.get(task_id, image_url)
+        if record is not None:
+            if record["status"] == "done":
+                log(f"跳过已完成的任务(下载清单): {image_path}")
+                return task_result(task, True, skipped=True)
+        missing_status = find_missing_url(manifest, image_url)
+        if missing_status is not None and find_existing_image(image_path) is None:
+            log(f"跳过已确认不存在的图片(HTTP {missing_status}): {image_url}")
+            return task_result(task, False, skipped=True, status=missing_status, error=f"HTTP {missing_status}")
+        if CONTENT_STORE_ENABLED and not use_shard_output():
+            linked = link_from_content_store(task, manifest)
+            if linked is not None:
+                return linked
+        if record is not None:
+            return None
+    existing_path = find_existing_image(image_path)
+    if existing_path is None:
+        return None
+    if manifest is not None:
+        manifest.mark_done(task_id, image_url, existing_path, os.path.getsize(existing_path), None)
+    if os.path.exists(txt_path):
+        log(f"跳过已存在的文件: {image_path} 和 {txt_path}")
+    else:
+        log(f"图片已存在，仅生成文本文件: {txt_path}")
+        write_prompt_file(txt_path, prompt_text, task_id)
+    return task_result(task, True, skipped=True, image_path=existing_path)
+
+def configure_missing_cache(ttl_days, probe=False):
+    """设置不存在图片记录的有效期（天，0表示不记录）以及扩展模式下是否先探测变体"""
+    global MISSING_CACHE_TTL, PROBE_VARIANTS
+    MISSING_CACHE_TTL = max(0.0, float(ttl_days)) * 24 * 3600
+    PROBE_VARIANTS = bool(probe)
+
+def find_missing_url(manifest, url):
+    """返回下载清单中该URL在有效期内的不存在记录（HTTP状态码），没有时返回None"""
+    if manifest is None or MISSING_CACHE_TTL <= 0:
+        return None
+    return manifest.find_missing(url, MISSING_CACHE_TTL)
+
+def record_missing_url(task, status):
+    """把返回404/410的图片链接记入下载清单，有效期内再次运行时不再请求"""
+    manifest = get_manifest(os.path.dirname(task[1]))
+    if manifest is not None and MISSING_CACHE_TTL > 0:
+        manifest.mark_missing(task[0], status)
+
+def should_probe(task):
+    """扩展模式下启用 --probe 时，下载前先探测变体是否存在"""
+    return PROBE_VARIANTS and task[5]
+
+def probe_image_url(url):
+    """
+    用HEAD请求探测图片是否存在（服务器不支持HEAD时改用只取1字节的Range请求），
+    返回HTTP状态码，网络错误时返回None（交给正常下载流程处理）
+    """
+    import requests
+
+    session = get_shared_session()
+    headers = get_browser_headers(url)
+    started = time.perf_counter()
+    try:
+        response = session.head(url, headers=headers, timeout=10, allow_redirects=True)
+        status = response.status_code
+        if status in (405, 501):
+            with session.get(url, headers=dict(headers, Range="bytes=0-0"), stream=True, timeout=10) as response:
+                status = response.status_code
+    except requests.RequestException:
+        return None
+    record_request_metrics(probe_ms=elapsed_ms(started), probe_status=status)
+    return status
+
+async def probe_image_url_async(session, url):
+    """协程版本的 probe_image_url"""
+    headers = get_browser_headers(url)
+    started = time.perf_counter()
+    try:
+        async with session.head(url, headers=headers, allow_redirects=True) as response:
+            status = response.status
+        if status in (405, 501):
+            async with session.get(url, headers=dict(headers, Range="bytes=0-0")) as response:
+                status = response.status
+    except Exception:
+        return None
+    record_request_metrics(probe_ms=elapsed_ms(started), probe_status=status)
+    return status
+
+def probe_outcome(task, status):
+    """探测结果为不存在时结束任务并返回结果，否则返回None继续下载"""
+    if status not in PERMANENT_HTTP_STATUSES:
+        return None
+    log(f"探测到图片不存在(HTTP {status})，跳过下载: {task[0]}")
+    record_missing_url(task, status)
+    result = finish_task(task, False, f"HTTP {status}")
+    result.update(attempts=0, status=status, metrics={"probe_status": status})
+    return {"result": result}
+
+def start_task(task):
+    """下载开始前在清单中把任务标记为pending"""
+    image_url, image_path, task_url, task_id, prompt_text, extended_mode, download_method, metadata = task
+    manifest = get_manifest(os.path.dirname(image_path))
+    if manifest is not None:
+        manifest.mark_pending(task_id, image_url, image_path)
+
+def finish_task(task, success, error=None, processed=None, sha256=None):
+    """
+    根据下载结果生成或清理txt文件，更新下载清单，并返回任务结果；
+    processed 为下载后处理的结果，sha256 为下载时边接收边计算的哈希，有其一时不必再读取文件
+    """
+    image_url, image_path, task_url, task_id, prompt_text, extended_mode, download_method, metadata = task
+    txt_path = os.path.splitext(image_path)[0] + ".txt"
+    manifest = get_manifest(os.path.dirname(image_path))
+    if success:
+        if PREFERRED_FORMAT != "png":
+            image_path = apply_detected_extension(image_path)
+        size = os.path.getsize(image_path)
+        if processed and processed["sha256"]:
+            sha256 = processed["sha256"]
+        if sha256 is None and (manifest is not None or CONTENT_STORE_ENABLED):
+            sha256 = file_sha256(image_path)
+        if use_shard_output():
+            image_path = write_to_shard(task, image_path, sha256)
+        else:
+            write_prompt_file(txt_path, prompt_text, task_id)
+            if CONTENT_STORE_ENABLED:
+                store_in_content_store(image_path, sha256)
+        if manifest is not None:
+            manifest.mark_done(task_id, image_url, image_path, size, sha256)
+    else:
+        if os.path.exists(txt_path):
+            os.remove(txt_path)
+        log(f"图片下载失败，未生成文本文件: {txt_path}")
+        if manifest is not None:
+            manifest.mark_failed(task_id, image_url, image_path, error or "未知错误")
+    return task_result(task, success, image_path=image_path, error=None if success else (error or "未知错误"))
+
+def download_batch_attempt(items):
+    """
+    批量curl模式下调度器使用的线程工作函数：items 为一批 (任务, 尝试次数)，只启动一个curl进程，
+    每个任务只尝试一次；跳过规则与 download_attempt 一致，返回与 items 一一对应的结果字典
+    （启用下载后处理时，下载成功的任务返回 start_postprocess 的结果）
+    """
+    outcomes = [None] * len(items)
+    fresh = []
+    for index, (task, attempt) in enumerate(items):
+        if attempt == 0:
+            existing = check_existing_task(task)
+            if existing is not None:
+                outcomes[index] = {"result": existing}
+            else:
+                fresh.append(index)
+    probing = [index for index in fresh if should_probe(items[index][0])]
+    if probing:
+        # 一批中需要探测的变体由一个curl进程并行探测，不存在的变体不再下载
+        for index, status in zip(probing, probe_image_urls_with_curl([items[index][0][0] for index in probing])):
+            outcomes[index] = probe_outcome(items[index][0], status)
+    for index in fresh:
+        if outcomes[index] is None:
+            start_task(items[index][0])
+    pending = [index for index in range(len(items)) if outcomes[index] is None]
+    if not pending:
+        return outcomes
+    log(f"正在批量下载 {len(pending)} 张图片(curl批量方式)")
+    downloaded = {}
+    remaining = pending
+    # 按候选链接逐轮下载：首选格式不存在（404/410）的任务在下一轮改用后面的链接
+    for round_index in itertools.count():
+        batch = [(get_candidate_urls(items[index][0][0])[round_index], items[index][0][1]) for index in remaining]
+        downloaded.update(zip(remaining, download_images_with_curl_batch(batch)))
+        remaining = [index for index in remaining if downloaded[index]["status"] in PERMANENT_HTTP_STATUSES
+                     and round_index + 1 < len(get_candidate_urls(items[index][0][0]))]
+        if not remaining:
+            break
+        for index in remaining:
+            discard_temp_file(get_temp_path(items[index][0][1]))
+    for index in pending:
+        task, attempt = items[index]
+        attempt_result = downloaded[index]
+        metrics = attempt_result["metrics"]
+        _request_metrics.set(metrics)
+        latency = (metrics.get("total_ms") or 0.0) / 1000
+        if attempt_result["ok"] and postprocess_enabled():
+            # 下载成功的图片交给处理进程池，不等待处理完成
+            outcomes[index] = start_postprocess(task, latency, metrics)
+            continue
+        failure = None
+        if not attempt_result["ok"]:
+            failure = {"message": attempt_result["error"], "status": attempt_result["status"],
+                       "retry_after": attempt_result["retry_after"]}
+        outcomes[index] = _attempt_outcome(task, attempt, attempt_result["ok"], latency, metrics, failure=failure)
+    return outcomes
+
+def _task_max_retries(task):
+    """扩展模式下重试1次，其它模式下重试2次"""
+    return 1 if task[5] else 2
+
+def _attempt_outcome(task, attempt, success, latency, metrics, processed=None, failure=None):
+    """
+    根据一次下载尝试的结果决定后续处理：
+    成功或重试次数用尽时结束任务（生成/清理txt、更新清单），否则返回延迟重试的等待时间。
+    下载后处理发现图片损坏时（见 finish_postprocess）按失败处理，由调度器重新排队下载。
+    failure 为失败原因（默认取 pop_last_error()）；
+    任务结束时结果中附带尝试次数、HTTP状态码和最后一次尝试的计时指标。
+    """
+    metrics["total_ms"] = round(latency * 1000, 1)
+    body = pop_downloaded_body(task[1])
+    if success:
+        status = metrics.get("status", 200)
+        result = finish_task(task, True, processed=processed, sha256=body and body["sha256"])
+        result.update(attempts=attempt + 1, status=status, metrics=metrics)
+        return {"result": result, "latency": latency, "status": status}
+    failure = failure or pop_last_error()
+    status = failure["status"] or metrics.get("status")
+    outcome = {"latency": latency, "status": status, "retry_after": failure["retry_after"]}
+    max_retries = _task_max_retries(task)
+    if status in PERMANENT_HTTP_STATUSES:
+        # 图片不存在，重试没有意义
+        record_missing_url(task, status)
+        max_retries = attempt
+    if attempt < max_retries:
+        delay = failure["retry_after"] if failure["retry_after"] is not None else random.uniform(1.0, 3.0)
+        log(f"{delay:.1f}秒后重新调度下载 ({attempt + 1}/{max_retries}): {task[0]}")
+        outcome["retry"] = delay
+    else:
+        result = finish_task(task, False, failure["message"])
+        result.update(attempts=attempt + 1, status=status, metrics=metrics)
+        outcome["result"] = result
+    return outcome
+
+def download_attempt(task, attempt=0):
+    """
+    调度器使用的线程工作函数：只进行一次下载尝试，不在线程内睡眠重试。
+    首次尝试前检查是否已完成；返回包含 result（任务结束）或 retry（等待秒数）的字典，
+    启用下载后处理且下载成功时返回 start_postprocess 的结果（不等待处理完成）。
+    """
+    if attempt == 0:
+        existing = check_existing_task(task)
+        if existing is not None:
+            return {"result": existing}
+        if should_probe(task):
+            begin_request_metrics()
+            if task[6] == "curl":
+                status = probe_image_urls_with_curl([task[0]])[0]
+            else:
+                status = probe_image_url(task[0])
+            probed = probe_outcome(task, status)
+            if probed is not None:
+                return probed
+        start_task(task)
+    image_url, image_path, task_url, task_id, prompt_text, extended_mode, download_method, metadata = task
+    metrics = begin_request_metrics()
+    started = time.monotonic()
+    success = download_image_candidates(
+        task, lambda url: download_image(url, image_path, task_url, method=download_method))
+    latency = time.monotonic() - started
+    if success and postprocess_enabled():
+        return start_postprocess(task, latency, metrics)
+    return _attempt_outcome(task, attempt, success, latency, metrics)
+
+def download_attempts(items):
+    """依次执行 download_attempt，返回与 items 一一对应的结果（逐张下载时每批只有一个任务）"""
+    return [download_attempt(task, attempt) for task, attempt in items]
+
+async def async_download_attempt(task, attempt, session, warmed_hosts):
+    """协程版本的 download_attempt"""
+    if attempt == 0:
+        existing = check_existing_task(task)
+        if existing is not None:
+            return {"result": existing}
+        if should_probe(task):
+            begin_request_metrics()
+            probed = probe_outcome(task, await probe_image_url_async(session, task[0]))
+            if probed is not None:
+                return probed
+        start_task(task)
+    log(f"正在下载图片: {get_candidate_urls(task[0])[0]}")
+    metrics = begin_request_metrics()
+    started = time.monotonic()
+    success = await download_image_candidates_async(
+        task, lambda url: download_image_async(session, url, task[1], warmed_hosts))
+    latency = time.monotonic() - started
+    if success and postprocess_enabled():
+        return start_postprocess(task, latency, metrics)
+    return _attempt_outcome(task, attempt, success, latency, metrics)
+
+def run_async_downloads(tasks, concurrency=None, on_result=None, runtime=None):
+    """
+    在单个事件循环中执行一批下载任务：
+    启动 concurrency 个协程共同从调度器取任务，同时在途的请求数不超过并发控制器给出的上限，
+    重试与限速等待放回调度器的延迟队列，不占用并发名额。
+    传入 runtime 时使用其中保持的事件循环与aiohttp会话（各批任务复用连接），否则临时创建。
+    每完成一个任务调用一次 on_result(result)。返回成功数量。
+    """
+    import asyncio
+
+    aiohttp = _import_aiohttp()
+    if aiohttp is None:
+        return 0
+    concurrency = concurrency or ASYNC_CONCURRENCY
+    controller = create_concurrency_controller(concurrency)
+    scheduler = DownloadScheduler(tasks, controller, get_host_rate_limiter())
+    successful = 0
+
+    processing = set()
+
+    def _on_complete(result):
+        nonlocal successful
+        if result is not None:
+            if result["success"]:
+                successful += 1
+            if on_result is not None:
+                on_result(result)
+
+    async def _finish_postprocess(task, attempt, pending):
+        # 等待处理进程池时不占用下载协程
+        await asyncio.wait([asyncio.wrap_future(pending["postprocess"])])
+        _on_complete(scheduler.finish_processing(task, attempt, finish_postprocess(task, attempt, pending)))
+
+    async def _consume(session, warmed_hosts):
+        while not scheduler.finished():
+            item = scheduler.next_ready() if scheduler.has_capacity() else None
+            if item is None:
+                await asyncio.sleep(min(scheduler.wait_time() or 0.05, 0.5))
+                continue
+            task, attempt = item
+            outcome = await async_download_attempt(task, attempt, session, warmed_hosts)
+            if "postprocess" in outcome:
+                scheduler.start_processing()
+                finishing = asyncio.ensure_future(_finish_postprocess(task, attempt, outcome))
+                processing.add(finishing)
+                finishing.add_done_callback(processing.discard)
+                continue
+            _on_complete(scheduler.complete(task, attempt, outcome))
+
+    async def _run(session, warmed_hosts):
+        await asyncio.gather(*(_consume(session, warmed_hosts) for _ in range(concurrency)))
+
+    scope = contextlib.nullcontext(runtime) if runtime is not None else DownloadRuntime(method="async")
+    with scope as runtime:
+        loop, session = runtime.async_session(aiohttp, concurrency)
+        loop.run_until_complete(_run(session, runtime.warmed_hosts))
+    controller.report()
+    return successful
+
+
+def resolve_csv_fields(fieldnames, csv_path):
+    """
+    检查CSV表头是否包含必要字段，返回 (任务ID字段名, 任务链接字段名或None)；
+    缺少必要字段时打印错误并返回None
+    """
+    fieldnames = fieldnames or []
+    if 'Prompt' not in fieldnames:
+        print(f"错误: CSV文件 {csv_path} 缺少必要字段 'Prompt'")
+        return None
+    if '图片链接' not in fieldnames:
+        print(f"错误: CSV文件 {csv_path} 缺少必要字段 '图片链接'")
+        return None
+    task_id_field = '任务id' if '任务id' in fieldnames else '任务ID'
+    if task_id_field not in fieldnames:
+        print(f"错误: CSV文件 {csv_path} 缺少必要字段 '任务id' 或 '任务ID'")
+        return None
+    task_url_field = '任务链接' if '任务链接' in fieldnames else None
+    return task_id_field, task_url_field
+
+def clean_task_id(raw_task_id, row_index):
+    """去掉任务ID中不能用于文件名的字符，为空时按行号生成"""
+    return ''.join(c for c in raw_task_id if c.isalnum() or c in '._- ') or f"task_{row_index + 1}"
+
+def iter_row_tasks(reader, output_dir, task_id_field, task_url_field, extended_mode=False, method="curl",
+                   variants=None):
+    """
+    逐行解析CSV并按需生成下载任务元组，不在内存中保留整个文件；
+    扩展模式下 variants 指定只生成哪些变体（如 (0,) 或 (1, 2, 3)），None表示全部
+    """
+    for i, row in enumerate(reader):
+        task_id = clean_task_id(row[task_id_field], i)
+        if not in_partition(task_id):
+            continue
+        prompt_text = row['Prompt'].strip()
+        image_url = row['图片链接'].strip()
+        task_url = row[task_url_field].strip() if task_url_field and task_url_field in row else None
+        if not image_url:
+            continue
+        # CSV中的其它列（Prompt 参数、用户ID等）作为元数据随任务传递，分片输出时写入索引
+        metadata = {key: (value or "").strip() for key, value in row.items()
+                    if key and key not in ('Prompt', '图片链接', task_id_field, task_url_field)}
+        if extended_mode:
+            for idx in (range(4) if variants is None else variants):
+                new_task_id = f"{task_id}_{idx}"
+                extended_image_url = get_extended_url(image_url, idx)
+                image_path = get_image_save_path(output_dir, new_task_id)
+                yield (extended_image_url, image_path, task_url, new_task_id, prompt_text, True, method, metadata)
+        elif variants is None or 0 in variants:
+            new_task_id = f"{task_id}_0"
+            image_path = get_image_save_path(output_dir, new_task_id)
+            yield (image_url, image_path, task_url, new_task_id, prompt_text, False, method, metadata)
+
+def iter_batches(iterable, size):
+    """把迭代器按 size 个一组切分，按需读取；迭代器产生None（暂时没有新任务）时先交出已取到的部分"""
+    batch = []
+    for item in iterable:
+        if item is not None:
+            batch.append(item)
+        if batch and (item is None or len(batch) >= size):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def configure_distribution(partition=None, lease_db=None, worker_id=None, lease_seconds=LEASE_SECONDS):
+    """
+    设置分工方式：partition 为 "i/N"（i从0开始）时只处理属于第i份的任务；
+    lease_db 为共享SQLite队列的路径，worker_id 为本进程在队列中的名称（默认 主机名-进程号）
+    """
+    global PARTITION, LEASE_DB_PATH, WORKER_ID, LEASE_SECONDS
+    PARTITION = parse_partition(partition) if isinstance(partition, str) else partition
+    LEASE_DB_PATH = lease_db
+    WORKER_ID = worker_id or f"{platform.node()}-{os.getpid()}"
+    LEASE_SECONDS = max(10.0, float(lease_seconds))
+    update_manifest_commit_interval()
+
+def update_manifest_commit_interval():
+    """多个进程可能共用同一个输出目录的下载清单时（分片、共享队列、多进程），清单每次写入立即提交"""
+    global MANIFEST_COMMIT_INTERVAL
+    shared = PARTITION is not None or LEASE_DB_PATH is not None or PROCESS_COUNT > 1
+    MANIFEST_COMMIT_INTERVAL = 0.0 if shared else 1.0
+
+def parse_partition(value):
+    """解析 "i/N" 形式的分片参数，返回 (i, N)"""
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", value)
+    if not match or int(match.group(2)) < 1 or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"分片参数应为 i/N 且 0 <= i < N，例如 0/4: {value}")
+    return int(match.group(1)), int(match.group(2))
+
+def in_partition(task_id):
+    """按任务ID的稳定哈希判断任务是否属于本进程负责的分片（同一任务的各个变体总在同一分片）"""
+    if PARTITION is None:
+        return True
+    index, count = PARTITION
+    digest = hashlib.sha1(task_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count == index
+
+class LeaseQueue:
+    """
+    多个工作进程共享的SQLite任务队列：
+      - enqueue() 登记任务，多个进程重复登记同一任务时只保留一份
+      - 队列中只保存图片URL、任务ID与任务元数据（Prompt、任务链接、CSV其它列），
+        领取的进程按自己的输出目录与下载方式重建任务，各进程的输出目录可以不同
+      - claim() 在一个写事务中领取一批排队中或租约已过期的任务，租约有效期为 lease_seconds
+      - 后台线程定期为本进程持有的租约续期（心跳），进程崩溃后租约过期，任务由其它进程回收
+      - complete() 把任务标记为done；下载失败时放回队列重试，直到被领取 max_attempts 次
+        或图片不存在（404/410）才标记为failed，不再被领取
+    """
+
+    def __init__(self, path, owner, lease_seconds, max_attempts=LEASE_MAX_ATTEMPTS):
+        self.path = path
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, int(max_attempts))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " task_id TEXT NOT NULL,"
+            " url TEXT NOT NULL,"
+            " metadata TEXT NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'queued',"
+            " owner TEXT,"
+            " lease_until REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " updated_at REAL,"
+            " PRIMARY KEY (task_id, url))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, lease_until)")
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+
+    def _transaction(self, statements):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self.conn)
+                self.conn.execute("COMMIT")
+                return result
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, tasks):
+        """登记一批任务（不保存保存路径与下载方式）"""
+        now = time.time()
+        rows = [(task[3], task[0], json.dumps({"task_url": task[2], "prompt": task[4], "extended": task[5],
+                                               "fields": task[7]}, ensure_ascii=False), now)
+                for task in tasks]
+        self._transaction(lambda conn: conn.executemany(
+            "INSERT OR IGNORE INTO tasks (task_id, url, metadata, updated_at) VALUES (?, ?, ?, ?)", rows))
+
+    def claim(self, limit, output_dir, method="curl"):
+        """领取最多 limit 个任务，按 output_dir 与 method 重建任务元组并返回列表"""
+        def _claim(conn):
+            now = time.time()
+            rows = conn.execute(
+                "SELECT task_id, url, metadata FROM tasks"
+                " WHERE status = 'queued' OR (status = 'leased' AND lease_until < ?)"
+                " ORDER BY rowid LIMIT ?",
+                (now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1,"
+                " updated_at = ? WHERE task_id = ? AND url = ?",
+                [(self.owner, now + self.lease_seconds, now, task_id, url) for task_id, url, _ in rows])
+            tasks = []
+            for task_id, url, metadata in rows:
+                data = json.loads(metadata)
+                tasks.append((url, get_image_save_path(output_dir, task_id), data["task_url"], task_id,
+                              data["prompt"], data["extended"], method, data["fields"]))
+            return tasks
+        return self._transaction(_claim)
+
+    def next_expiry(self):
+        """
+        返回距离下一个任务可以领取的秒数：有排队中的任务（如放回队列重试的失败任务）时为0，
+        否则为其它进程持有的租约中最早的过期时间；没有未完成的任务时返回None
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MIN(CASE WHEN status = 'queued' THEN 0 ELSE lease_until END) FROM tasks"
+                " WHERE status = 'queued' OR (status = 'leased' AND owner != ?)",
+                (self.owner,)).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def complete(self, task_id, url, success, status=None):
+        """结束本进程持有的任务；可以重试的失败放回队列，返回任务是否重新排队"""
+        with self.lock:
+            if not success and status not in PERMANENT_HTTP_STATUSES:
+                requeued = self.conn.execute(
+                    "UPDATE tasks SET status = 'queued', owner = NULL, lease_until = NULL, updated_at = ?"
+                    " WHERE task_id = ? AND url = ? AND owner = ? AND attempts < ?",
+                    (time.time(), task_id, url, self.owner, self.max_attempts)).rowcount
+                if requeued:
+                    return True
+            self.conn.execute(
+                "UPDATE tasks SET status = ?, lease_until = NULL, updated_at = ?"
+                " WHERE task_id = ? AND url = ? AND owner = ?",
+                ("done" if success else "failed", time.time(), task_id, url, self.owner))
+            return False
+
+    def _heartbeat(self):
+        while not self.stop_event.wait(self.lease_seconds / 3):
+            try:
+                with self.lock:
+                    self.conn.execute(
+                        "UPDATE tasks SET lease_until = ? WHERE status = 'leased' AND owner = ?",
+                        (time.time() + self.lease_seconds, self.owner))
+            except sqlite3.Error as e:
+                print(f"任务租约续期失败: {str(e)}")
+
+    def close(self):
+        self.stop_event.set()
+        self.heartbeat_thread.join()
+        with self.lock:
+            self.conn.close()
+
+def get_lease_queue():
+    """返回共享任务队列（首次使用时打开）"""
+    global _lease_queue
+    if _lease_queue is None:
+        _lease_queue = LeaseQueue(LEASE_DB_PATH, WORKER_ID, LEASE_SECONDS)
+        print(f"使用共享任务队列: {LEASE_DB_PATH}（工作进程: {WORKER_ID}）")
+    return _lease_queue
+
+def close_lease_queue():
+    """停止心跳并关闭共享任务队列"""
+    global _lease_queue
+    if _lease_queue is not None:
+        _lease_queue.close()
+        _lease_queue = None
+
+def iter_leased_tasks(tasks, queue, output_dir, method="curl"):
+    """
+    共享队列模式下的任务来源：把CSV中的任务分批登记到队列，每登记一批就领取一批交给下载；
+    CSV读完后继续领取（包括放回队列重试的失败任务），直到队列中没有可领取的任务
+    """
+    for batch in iter_batches(tasks, LEASE_BATCH_SIZE * 4):
+        queue.enqueue(batch)
+        yield from queue.claim(LEASE_BATCH_SIZE, output_dir, method)
+    while True:
+        claimed = queue.claim(LEASE_BATCH_SIZE, output_dir, method)
+        if not claimed:
+            return
+        yield from claimed
+
+def run_leased_tasks(tasks, output_dir, num_threads=4, method="curl", progress_bar=None):
+    """
+    共享队列模式下执行下载：领取完可领取的任务后，若队列中还有其它进程持有的租约，
+    则等待它们完成；租约过期（持有的进程已崩溃）的任务由本进程回收并下载。返回 (成功数, 处理的任务数)
+    """
+    queue = get_lease_queue()
+    successful, processed = run_download_tasks(iter_leased_tasks(tasks, queue, output_dir, method), num_threads,
+                                               method, progress_bar)
+    while True:
+        wait = queue.next_expiry()
+        if wait is None:
+            return successful, processed
+        time.sleep(min(wait + 0.1, 5.0))
+        reclaimed = run_download_tasks(iter_leased_tasks((), queue, output_dir, method), num_threads, method,
+                                       progress_bar)
+        successful += reclaimed[0]
+        processed += reclaimed[1]
+
+def complete_task_lease(result):
+    """共享队列模式下把已结束的任务标记为完成，可以重试的失败放回队列"""
+    if _lease_queue is not None:
+        if _lease_queue.complete(result["task_id"], result["image_url"], result["success"], result.get("status")):
+            log(f"下载失败，已放回共享队列等待重试: {result['image_url']}")
+
+class HostRateLimiter:
+    """
+    按主机的令牌桶限速器（GCRA实现）：每个主机每秒最多 rate 个请求，允许 burst 个突发。
+    reserve() 预留一个令牌并返回需要等待的秒数，由调度器安排延迟提交而不是在线程中睡眠；
+    penalize() 在收到429/503时按 Retry-After 暂停该主机。
+    """
+
+    def __init__(self, rate=0.0, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.lock = threading.Lock()
+        self.next_time = {}
+        self.blocked_until = {}
+
+    def blocked_wait(self, host):
+        """返回主机仍处于暂停状态的剩余秒数"""
+        return max(0.0, self.blocked_until.get(host, 0.0) - time.monotonic())
+
+    def reserve(self, host):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.blocked_until.get(host, 0.0))
+            if self.rate > 0:
+                interval = 1.0 / self.rate
+                theoretical = max(self.next_time.get(host, start), start)
+                start = max(start, theoretical - (self.burst - 1) * interval)
+                self.next_time[host] = theoretical + interval
+            return start - now
+
+    def penalize(self, host, seconds):
+        with self.lock:
+            until = time.monotonic() + seconds
+            if until > self.blocked_until.get(host, 0.0):
+                self.blocked_until[host] = until
+                log(f"主机 {host} 触发限流，暂停 {seconds:.1f} 秒")
+
+class BandwidthLimiter:
+    """
+    全局带宽令牌桶（线程安全）：每秒补充 rate 字节，最多积累1秒的突发量。
+    reserve() 扣除已接收的字节并返回需要等待的秒数，允许透支，透支部分由之后的请求等待偿还
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.available = self.rate
+        self.updated = time.monotonic()
+
+    def reserve(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.rate, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            self.available -= nbytes
+            return max(0.0, -self.available / self.rate)
+
+class AdaptiveConcurrencyController:
+    """
+    自适应并发控制（AIMD）：
+      - 延迟接近基线时每完成 limit 个请求并发数加1
+      - 收到429/503、连接错误或延迟明显升高时并发数按比例下降（冷却期内只下降一次）
+    未启用自适应时并发数固定为上限。
+    """
+
+    COOLDOWN = 2.0
+    LATENCY_FACTOR = 3.0
+
+    def __init__(self, max_limit, adaptive=False, min_limit=1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = min(min_limit, self.max_limit)
+        self.adaptive = adaptive
+        self.limit = min(self.max_limit, 4) if adaptive else self.max_limit
+        self.baseline = None
+        self.successes = 0
+        self.last_decrease = 0.0
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        if now - self.last_decrease < self.COOLDOWN:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, int(self.limit * factor))
+        self.successes = 0
+
+    def record(self, latency, status, ok):
+        """记录一次请求的结果；跳过的任务（无延迟数据）不参与调整"""
+        if not self.adaptive or latency is None:
+            return
+        if status in (429, 503):
+            self._decrease(0.5)
+        elif not ok and (status is None or status >= 500):
+            self._decrease(0.8)
+        elif ok:
+            self.baseline = latency if self.baseline is None else min(latency, self.baseline * 0.95 + latency * 0.05)
+            if latency > self.baseline * self.LATENCY_FACTOR:
+                self._decrease(0.9)
+                return
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.successes = 0
+
+    def report(self):
+        if self.adaptive:
+            print(f"自适应并发: 结束时并发数 {self.limit} (上限 {self.max_limit})")
+
+class DownloadScheduler:
+    """
+    下载任务调度器（由单个线程或事件循环驱动）：
+      - 按需从任务迭代器取新任务，在途任务数不超过并发控制器的上限；迭代器产生None时表示暂时没有新任务，
+        稍后再取而不是结束
+      - 失败的尝试按 Retry-After 或随机退避放入延迟队列，到期后重新提交，等待期间不占用线程
+      - 提交前按主机限速，需要等待的任务同样放入延迟队列
+      - 下载完成后交给处理进程池的图片不占用下载并发名额，但同时处理中的图片数不超过 max_processing
+    """
+
+    def __init__(self, tasks, controller, limiter=None):
+        self.tasks = iter(tasks)
+        self.controller = controller
+        self.limiter = limiter
+        self.exhausted = False
+        self.idle = False
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.processing = 0
+        self.max_delayed = controller.max_limit * PENDING_FACTOR
+        self.max_processing = controller.max_limit
+
+    def _delay(self, due, task, attempt, reserved):
+        heapq.heappush(self.delayed, (due, next(self.sequence), task, attempt, reserved))
+
+    def has_capacity(self):
+        return self.in_flight < self.controller.limit and self.processing < self.max_processing
+
+    def next_ready(self):
+        """返回下一个可以立即执行的 (任务, 尝试次数)，暂时没有时返回None"""
+        while True:
+            now = time.monotonic()
+            if self.delayed and self.delayed[0][0] <= now:
+                _, _, task, attempt, reserved = heapq.heappop(self.delayed)
+            elif not self.exhausted and len(self.delayed) < self.max_delayed:
+                try:
+                    task = next(self.tasks)
+                except StopIteration:
+                    self.exhausted = True
+                    continue
+                self.idle = task is None
+                if self.idle:
+                    return None
+                attempt, reserved = 0, False
+            else:
+                return None
+            if self.limiter is not None:
+                host = urlparse(task[0]).netloc
+                wait = self.limiter.blocked_wait(host) if reserved else self.limiter.reserve(host)
+                if wait > 0:
+                    self._delay(now + wait, task, attempt, True)
+                    continue
+            self.in_flight += 1
+            return task, attempt
+
+    def next_batch(self, size):
+        """在并发上限内取出最多 size 个可以立即执行的 (任务, 尝试次数)"""
+        items = []
+        while len(items) < size and self.has_capacity():
+            item = self.next_ready()
+            if item is None:
+                break
+            items.append(item)
+        return items
+
+    def wait_time(self):
+        """距离延迟队列中最早任务到期的秒数，队列为空时返回None；任务迭代器暂时没有新任务时最多 IDLE_POLL_INTERVAL 秒"""
+        wait = max(0.0, self.delayed[0][0] - time.monotonic()) if self.delayed else None
+        if self.idle and not self.exhausted:
+            wait = IDLE_POLL_INTERVAL if wait is None else min(wait, IDLE_POLL_INTERVAL)
+        return wait
+
+    def complete(self, task, attempt, outcome):
+        """处理一次尝试的结果：反馈给并发控制器与限速器，需要重试时放回延迟队列；任务结束时返回结果"""
+        self.in_flight -= 1
+        status = outcome.get("status")
+        result = outcome.get("result")
+        self.controller.record(outcome.get("latency"), status, result is not None and result["success"])
+        if status in (429, 503) and self.limiter is not None:
+            retry_after = outcome.get("retry_after")
+            self.limiter.penalize(urlparse(task[0]).netloc, retry_after if retry_after is not None else THROTTLE_PAUSE)
+        if "retry" in outcome:
+            self._delay(time.monotonic() + outcome["retry"], task, attempt + 1, False)
+            return None
+        return result
+
+    def start_processing(self):
+        """一次尝试下载完成、图片已交给处理进程池：释放下载并发名额，等待 finish_processing"""
+        self.in_flight -= 1
+        self.processing += 1
+
+    def finish_processing(self, task, attempt, outcome):
+        """图片处理完成后按 complete() 处理这次尝试的结果（损坏的图片同样放回延迟队列）"""
+        self.processing -= 1
+        self.in_flight += 1
+        return self.complete(task, attempt, outcome)
+
+    def finished(self):
+        return self.exhausted and not self.delayed and self.in_flight == 0 and self.processing == 0
+
+def configure_rate_control(adaptive=False, host_rate=0.0):
+    """设置自适应并发开关与每个主机的请求速率上限"""
+    global ADAPTIVE_ENABLED, HOST_RATE_LIMIT, _host_rate_limiter
+    ADAPTIVE_ENABLED = bool(adaptive)
+    HOST_RATE_LIMIT = max(0.0, float(host_rate))
+    _host_rate_limiter = None
+
+def get_host_rate_limiter():
+    """返回进程内共享的按主机限速器"""
+    global _host_rate_limiter
+    if _host_rate_limiter is None:
+        _host_rate_limiter = HostRateLimiter(HOST_RATE_LIMIT, max(1, int(HOST_RATE_LIMIT)))
+    return _host_rate_limiter
+
+def parse_bandwidth(value):
+    """解析带宽参数，如 "10M"、"500K"、"2.5MB"（单位为字节/秒，不带单位时按MB/s）"""
+    text = str(value).strip().upper().rstrip("B").rstrip("/S")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    try:
+        if text and text[-1] in units:
+            return float(text[:-1]) * units[text[-1]]
+        return float(text) * units["M"]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无法识别的带宽: {value}")
+
+def configure_bandwidth(max_bandwidth=0.0):
+    """设置全局带宽上限（字节/秒或 "10M" 形式的字符串），0表示不限"""
+    global MAX_BANDWIDTH, _bandwidth_limiter
+    if isinstance(max_bandwidth, str):
+        max_bandwidth = parse_bandwidth(max_bandwidth)
+    MAX_BANDWIDTH = max(0.0, float(max_bandwidth or 0.0))
+    _bandwidth_limiter = None
+
+def get_bandwidth_limiter():
+    """返回进程内共享的带宽限制器，未设置带宽上限时返回None"""
+    global _bandwidth_limiter
+    if MAX_BANDWIDTH <= 0:
+        return None
+    if _bandwidth_limiter is None:
+        _bandwidth_limiter = BandwidthLimiter(MAX_BANDWIDTH)
+    return _bandwidth_limiter
+
+def throttle_bandwidth(nbytes):
+    """按全局带宽上限记录接收的字节数，超出时在当前线程中等待"""
+    limiter = get_bandwidth_limiter()
+    if limiter is not None and nbytes:
+        wait = limiter.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+async def throttle_bandwidth_async(nbytes):
+    """throttle_bandwidth 的协程版本，等待时不阻塞事件循环"""
+    import asyncio
+
+    limiter = get_bandwidth_limiter()
+    if limiter is not None and nbytes:
+        wait = limiter.reserve(nbytes)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+def configure_priority(priorities=None, interleave_variants=False):
+    """
+    设置任务优先级：priorities 为 "通配符=优先级" 形式的列表（按CSV文件名匹配，如 "MJ-top*=10"），
+    interleave_variants 为True时恢复按CSV行顺序下载每个任务的全部变体
+    """
+    global PRIMARY_FIRST, CSV_PRIORITIES
+    PRIMARY_FIRST = not interleave_variants
+    rules = []
+    for item in priorities or []:
+        pattern, sep, value = str(item).rpartition("=")
+        try:
+            if not sep or not pattern:
+                raise ValueError
+            rules.append((pattern.strip(), float(value)))
+        except ValueError:
+            print(f"警告: 忽略无法识别的优先级设置 '{item}'，格式应为 通配符=优先级")
+    CSV_PRIORITIES = tuple(rules)
+
+def get_csv_priority(csv_path):
+    """返回CSV文件的优先级：第一个匹配文件名（或完整路径）的规则，未匹配时为0"""
+    name = os.path.basename(csv_path)
+    for pattern, priority in CSV_PRIORITIES:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(csv_path, pattern):
+            return priority
+    return 0.0
+
+def group_csv_by_priority(csv_paths):
+    """按优先级从高到低把CSV文件分组，同一优先级内保持原有顺序"""
+    groups = {}
+    for csv_path in csv_paths:
+        groups.setdefault(get_csv_priority(csv_path), []).append(csv_path)
+    return [groups[priority] for priority in sorted(groups, reverse=True)]
+
+def create_concurrency_controller(max_limit):
+    """按当前配置创建并发控制器"""
+    return AdaptiveConcurrencyController(max_limit, ADAPTIVE_ENABLED)
+
+def use_curl_batch(method):
+    """是否使用批量curl模式（需要curl 7.67+）：调度器每次把最多 CURL_BATCH_SIZE 个就绪的任务交给一个curl进程"""
+    return method == "curl" and CURL_BATCH_SIZE > 0 and curl_supports_parallel()
+
+class RunMetrics:
+    """
+    汇总一次运行中每个任务的下载指标（线程安全）：
+      - 可选把每个任务的结果逐行写入JSON Lines日志
+      - 统计耗时分布、各主机平均耗时与常见失败原因，运行结束时打印汇总报告
+    """
+
+    LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    TIMING_FIELDS = ("dns_ms", "connect_ms", "tls_ms", "ttfb_ms", "transfer_ms", "total_ms", "process_ms")
+
+    def __init__(self, log_path=None):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._log_file = open(log_path, "a", encoding="utf-8") if log_path else None
+        self.total = 0
+        self.successful = 0
+        self.skipped = 0
+        self.retried = 0
+        self.bytes = 0
+        self.latency_buckets = [0] * (len(self.LATENCY_BUCKETS_MS) + 1)
+        self.timing_sums = collections.Counter()
+        self.timing_counts = collections.Counter()
+        self.hosts = {}
+        self.failures = collections.Counter()
+
+    def record(self, result):
+        """记录一个已结束任务的结果"""
+        metrics = result.get("metrics") or {}
+        host = urlparse(result["image_url"]).netloc
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "task_id": result["task_id"],
+            "url": result["image_url"],
+            "host": host,
+            "method": result.get("method"),
+            "success": result["success"],
+            "skipped": result.get("skipped", False),
+            "status": result.get("status"),
+            "attempts": result.get("attempts"),
+            "error": result.get("error"),
+        }
+        entry.update(metrics)
+        with self._lock:
+            self.total += 1
+            if result["success"]:
+                self.successful += 1
+            else:
+                # 去掉错误信息中的URL，使同类失败归为一组
+                reason = re.sub(r"\S+://\S+", "<url>", result.get("error") or "未知错误")
+                self.failures[reason[:120]] += 1
+            if entry["skipped"]:
+                self.skipped += 1
+            else:
+                self._record_download(host, entry, metrics)
+            if self._log_file is not None:
+                self._log_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _record_download(self, host, entry, metrics):
+        if (entry["attempts"] or 1) > 1:
+            self.retried += 1
+        if entry["success"]:
+            self.bytes += metrics.get("bytes", 0)
+        for field in self.TIMING_FIELDS:
+            if metrics.get(field) is not None:
+                self.timing_sums[field] += metrics[field]
+                self.timing_counts[field] += 1
+        total_ms = metrics.get("total_ms")
+        if total_ms is None:
+            return
+        index = sum(1 for bound in self.LATENCY_BUCKETS_MS if total_ms > bound)
+        self.latency_buckets[index] += 1
+        stats = self.hosts.setdefault(host, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += total_ms
+        stats[2] = max(stats[2], total_ms)
+
+    def summary(self):
+        """返回汇总数据字典"""
+        with self._lock:
+            elapsed = max(time.monotonic() - self._started, 1e-6)
+            labels = [f"<={bound}ms" for bound in self.LATENCY_BUCKETS_MS] + [f">{self.LATENCY_BUCKETS_MS[-1]}ms"]
+            slowest = sorted(self.hosts.items(), key=lambda item: item[1][1] / item[1][0], reverse=True)[:5]
+            return {
+                "tasks": self.total,
+                "successful": self.successful,
+                "failed": self.total - self.successful,
+                "skipped": self.skipped,
+                "retried": self.retried,
+                "bytes": self.bytes,
+                "elapsed_s": round(elapsed, 2),
+                "mb_per_s": round(self.bytes / elapsed / 1024 / 1024, 2),
+                "mean_ms": {field: round(self.timing_sums[field] / self.timing_counts[field], 1)
+                            for field in self.TIMING_FIELDS if self.timing_counts[field]},
+                "latency_histogram": dict(zip(labels, self.latency_buckets)),
+                "slowest_hosts": [{"host": host, "count": count, "mean_ms": round(total / count, 1),
+                                   "max_ms": round(longest, 1)}
+                                  for host, (count, total, longest) in slowest],
+                "top_failures": [{"error": error, "count": count} for error, count in self.failures.most_common(5)],
+            }
+
+    def print_report(self):
+        """打印汇总报告"""
+        summary = self.summary()
+        if not summary["tasks"]:
+            return
+        print("\n下载指标汇总:")
+        print(f"  任务: {summary['tasks']}，成功: {summary['successful']}，失败: {summary['failed']}，"
+              f"跳过: {summary['skipped']}，经过重试: {summary['retried']}")
+        print(f"  下载量: {summary['bytes'] / 1024 / 1024:.1f} MB，用时: {summary['elapsed_s']} 秒，"
+              f"吞吐: {summary['mb_per_s']} MB/s")
+        if summary["mean_ms"]:
+            print("  平均耗时: " + "，".join(f"{field[:-3]} {value}ms" for field, value in summary["mean_ms"].items()))
+        if any(summary["latency_histogram"].values()):
+            print("  耗时分布: " + "，".join(f"{label} {count}"
+                                         for label, count in summary["latency_histogram"].items() if count))
+        if summary["slowest_hosts"]:
+            print("  最慢的主机:")
+            for host in summary["slowest_hosts"]:
+                print(f"    {host['host']}: {host['count']} 次，平均 {host['mean_ms']}ms，最长 {host['max_ms']}ms")
+        if summary["top_failures"]:
+            print("  常见失败原因:")
+            for failure in summary["top_failures"]:
+                print(f"    {failure['count']} 次: {failure['error']}")
+
+    def close(self, report_path=None):
+        """关闭日志文件，指定 report_path 时把汇总数据写为JSON文件"""
+        with self._lock:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+        if report_path:
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+def configure_output(quiet=False, metrics_log=None, metrics_report=None):
+    """设置是否静默逐张图片的输出，以及指标日志（JSON Lines）和汇总报告（JSON）的路径"""
+    global QUIET, METRICS_LOG_PATH, METRICS_REPORT_PATH
+    QUIET = bool(quiet)
+    METRICS_LOG_PATH = metrics_log
+    METRICS_REPORT_PATH = metrics_report
+
+def start_run_metrics():
+    """开始本次运行的指标统计"""
+    global _run_metrics
+    _run_metrics = RunMetrics(METRICS_LOG_PATH)
+    return _run_metrics
+
+def record_task_metrics(result):
+    """把已结束任务的结果记入本次运行的指标"""
+    if _run_metrics is not None:
+        _run_metrics.record(result)
+
+def finish_run_metrics():
+    """打印本次运行的指标汇总，关闭日志并写出汇总报告"""
+    global _run_metrics
+    if _run_metrics is None:
+        return
+    _run_metrics.print_report()
+    _run_metrics.close(METRICS_REPORT_PATH)
+    if METRICS_LOG_PATH:
+        print(f"逐任务指标已写入: {METRICS_LOG_PATH}")
+    if METRICS_REPORT_PATH:
+        print(f"指标汇总已写入: {METRICS_REPORT_PATH}")
+    _run_metrics = None
+
+def configure_processes(processes):
+    """设置下载使用的进程数，1表示只在当前进程中下载"""
+    global PROCESS_COUNT
+    PROCESS_COUNT = max(1, int(processes))
+    update_manifest_commit_interval()
+
+def snapshot_config():
+    """收集由 configure_* 设置的模块级配置（大写的简单类型全局变量），传给子进程"""
+    simple_types = (bool, int, float, str, tuple, type(None))
+    return {name: value for name, value in globals().items()
+            if name.isupper() and isinstance(value, simple_types)}
+
+def _iter_queue_tasks(task_queue):
+    """子进程中从任务队列按批取出任务，收到None时结束"""
+    while True:
+        batch = task_queue.get()
+        if batch is None:
+            return
+        yield from batch
+
+def process_worker(index, config, task_queue, result_queue, resume, closing, num_threads, method):
+    """
+    子进程入口：恢复主进程的配置后，用本进程的线程池或事件循环下载队列中的任务，
+    每个任务的结果立即发回主进程；每批任务结束后回报并等待下一批，
+    线程池、事件循环与连接在各批之间保持；结束时发送连接复用与任务页面缓存统计
+    """
+    global SHARD_NAME_TAG, PROCESS_COUNT
+    globals().update(config)
+    configure_bandwidth(MAX_BANDWIDTH / max(1, PROCESS_COUNT))
+    configure_postprocess(POSTPROCESS_VERIFY, RESIZE_MAX_EDGE, THUMBNAIL_SIZE,
+                          DERIVED_FORMAT and (DERIVED_FORMAT, DERIVED_QUALITY),
+                          max(1, (POSTPROCESS_WORKERS or os.cpu_count() or 1) // max(1, PROCESS_COUNT)))
+    PROCESS_COUNT = 1
+    SHARD_NAME_TAG = f"p{index}-"
+    try:
+        with DownloadRuntime(num_threads, method) as runtime:
+            while True:
+                resume.wait()
+                resume.clear()
+                if closing.is_set():
+                    break
+                run_download_tasks(_iter_queue_tasks(task_queue), num_threads, method,
+                                   on_result=lambda result: result_queue.put(("result", result)), runtime=runtime)
+                result_queue.put(("idle", index))
+    finally:
+        close_postprocess_pool()
+        close_shard_writers()
+        close_manifests()
+        stats = get_connection_reuse_stats()
+        page_cache = _task_page_cache
+        result_queue.put(("done", index, {
+            "requests": stats["requests"],
+            "connections": stats["connections"],
+            "page_fetches": page_cache.fetches if page_cache else 0,
+            "page_hits": page_cache.hits if page_cache else 0,
+            **_postprocess_stats,
+        }))
+
+class DownloadProcessPool:
+    """
+    多进程下载使用的 PROCESS_COUNT 个子进程，在多批任务之间保持运行：
+    每批任务由后台线程按批放入有界队列，子进程各自下载，主进程接收每个任务的结果并调用 on_result
+    （更新进度条、指标与任务租约）；每个子进程收到None时结束本批并回报，等待下一批开始。
+    分片输出时子进程各自写元数据索引，关闭时由主进程合并
+    """
+
+    def __init__(self, num_threads, method):
+        context = multiprocessing.get_context("spawn")
+        self.task_queue = context.Queue(maxsize=PROCESS_COUNT * PENDING_FACTOR)
+        self.result_queue = context.Queue()
+        self.closing = context.Event()
+        self.resume = [context.Event() for _ in range(PROCESS_COUNT)]
+        config = snapshot_config()
+        self.workers = [context.Process(target=process_worker, daemon=True,
+                                        args=(index, config, self.task_queue, self.result_queue, self.resume[index],
+                                              self.closing, num_threads, method))
+                        for index in range(PROCESS_COUNT)]
+        for worker in self.workers:
+            worker.start()
+        self.alive = set(range(PROCESS_COUNT))
+        self.output_dirs = set()
+
+    def _wait_for(self, kind, on_result=None):
+        """接收子进程的消息，直到每个存活的子进程都发来 kind 消息（或已退出）"""
+        pending = set(self.alive)
+        while pending:
+            try:
+                message = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                for index in list(pending):
+                    worker = self.workers[index]
+                    if not worker.is_alive():
+                        print(f"下载子进程 {index} 异常退出 (退出码 {worker.exitcode})，其未完成的任务将在下次运行时重新下载")
+                        pending.discard(index)
+                        self.alive.discard(index)
+                continue
+            if message[0] == "result":
+                if on_result is not None:
+                    on_result(message[1])
+                continue
+            index = message[1]
+            if message[0] == "done":
+                self.alive.discard(index)
+                for key, value in message[2].items():
+                    _process_stats[key] += value
+            if message[0] in ("done", kind):
+                pending.discard(index)
+
+    def _put_end_markers(self, count):
+        for _ in range(count):
+            self.task_queue.put(None)
+
+    def run(self, tasks, on_result):
+        """下载一批任务，全部子进程结束本批后返回"""
+        if not self.alive:
+            print("下载子进程均已退出，无法继续下载")
+            return
+        workers = len(self.alive)
+
+        def _feed():
+            for batch in iter_batches(tasks, PROCESS_TASK_BATCH):
+                self.output_dirs.update(os.path.dirname(task[1]) for task in batch)
+                self.task_queue.put(batch)
+            self._put_end_markers(workers)
+
+        for index in self.alive:
+            self.resume[index].set()
+        threading.Thread(target=_feed, daemon=True).start()
+        self._wait_for("idle", on_result)
+
+    def close(self):
+        """结束子进程（正在进行的一批会先下载完队列中的任务），收集统计并合并元数据索引"""
+        self.closing.set()
+        self._put_end_markers(len(self.alive))
+        for index in self.alive:
+            self.resume[index].set()
+        self._wait_for("done")
+        for worker in self.workers:
+            worker.join(timeout=5)
+        if use_shard_output():
+            for output_dir in self.output_dirs:
+                merge_metadata_indexes(output_dir)
+
+class DownloadRuntime:
+    """
+    在多次 run_download_tasks 之间保持的下载资源：线程池、async方式的事件循环与aiohttp会话、
+    --processes 的子进程，各自在首次使用时创建。监视模式、接收服务与 Downloader 的各批任务共用一个实例，
+    连接与进程保持预热；不传入时 run_download_tasks 为单次运行临时创建
+    """
+
+    def __init__(self, num_threads=4, method="curl"):
+        self.num_threads = max(1, int(num_threads))
+        self.method = method
+        self.warmed_hosts = set()
+        self._executor = None
+        self._loop = None
+        self._session = None
+        self._process_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads)
+        return self._executor
+
+    def async_session(self, aiohttp, concurrency):
+        """返回 (事件循环, aiohttp会话)；会话的连接数上限由首次调用时的 concurrency 决定"""
+        import asyncio
+
+        if self._loop is None:
+            async def _open():
+                return _create_async_session(aiohttp, concurrency)
+
+            self._loop = asyncio.new_event_loop()
+            self._session = self._loop.run_until_complete(_open())
+        return self._loop, self._session
+
+    def process_pool(self):
+        if self._process_pool is None:
+            self._process_pool = DownloadProcessPool(self.num_threads, self.method)
+        return self._process_pool
+
+    def close(self):
+        if self._process_pool is not None:
+            self._process_pool.close()
+            self._process_pool = None
+        if self._loop is not None:
+            import asyncio
+
+            async def _shutdown():
+                # 被 Ctrl+C 中断时事件循环中可能还有未结束的协程
+                pending = asyncio.all_tasks() - {asyncio.current_task()}
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                await self._session.close()
+
+            self._loop.run_until_complete(_shutdown())
+            self._loop.close()
+            self._loop = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+def run_download_tasks(tasks, num_threads=4, method="curl", progress_bar=None, on_result=None, runtime=None):
+    """
+    执行下载任务：
+      - 任务迭代器按需取用，边解析边下载，内存占用与任务总数无关
+      - 由 DownloadScheduler 调度：在途任务数受并发控制器限制，重试与限速等待不占用线程
+      - async方式下由固定数量的协程共享同一个调度器
+      - 批量curl模式下每次把最多 CURL_BATCH_SIZE 个就绪的任务交给一个线程，并发控制器按传输计数，
+        同时进行的传输数与逐张下载时一样不超过线程数
+      - 传入 runtime 时复用其中的线程池、事件循环与子进程（监视模式下各批任务共用），否则临时创建
+    返回 (成功数, 处理的任务数)
+    """
+    if runtime is None:
+        with DownloadRuntime(num_threads, method) as runtime:
+            return run_download_tasks(tasks, num_threads, method, progress_bar, on_result, runtime)
+
+    successful = 0
+    processed = 0
+
+    def _on_result(result):
+        nonlocal successful, processed
+        processed += 1
+        if result["success"]:
+            successful += 1
+        if on_result is not None:
+            on_result(result)
+        record_task_metrics(result)
+        complete_task_lease(result)
+        if progress_bar is not None:
+            progress_bar.set_postfix_str(f"成功 {successful} 失败 {processed - successful}", refresh=False)
+            progress_bar.update(1)
+
+    if PROCESS_COUNT > 1:
+        runtime.process_pool().run(tasks, _on_result)
+        return successful, processed
+
+    if method == "async":
+        run_async_downloads(tasks, on_result=_on_result, runtime=runtime)
+        return successful, processed
+
+    # 批量curl模式下一个线程一次下载一批任务，重试与限速同样由调度器安排；
+    # 一批中的每个任务都是一个并行传输，在途任务数上限仍为线程数，批大小只减少curl进程的启动次数
+    batch_size = CURL_BATCH_SIZE if use_curl_batch(method) else 1
+    controller = create_concurrency_controller(max(1, num_threads))
+    scheduler = DownloadScheduler(tasks, controller, get_host_rate_limiter())
+    # 下载后处理与下载并行：下载线程把图片交给处理进程池后立即返回，处理完成后再由线程池结束任务
+    pool = runtime.executor()
+    running = {}
+    processing = {}
+    finishing = {}
+    while not scheduler.finished():
+        while True:
+            items = scheduler.next_batch(batch_size)
+            if not items:
+                break
+            running[pool.submit(download_batch_attempt if batch_size > 1 else download_attempts, items)] = items
+        if not (running or processing or finishing):
+            time.sleep(min(scheduler.wait_time() or 0.05, 0.5))
+            continue
+        done, _ = concurrent.futures.wait([*running, *processing, *finishing], timeout=scheduler.wait_time(),
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future in processing:
+                task, attempt, pending = processing.pop(future)
+                finishing[pool.submit(finish_postprocess, task, attempt, pending)] = (task, attempt)
+                continue
+            if future in finishing:
+                task, attempt = finishing.pop(future)
+                result = scheduler.finish_processing(task, attempt, future.result())
+                if result is not None:
+                    _on_result(result)
+                continue
+            for (task, attempt), outcome in zip(running.pop(future), future.result()):
+                if "postprocess" in outcome:
+                    scheduler.start_processing()
+                    processing[outcome["postprocess"]] = (task, attempt, outcome)
+                    continue
+                result = scheduler.complete(task, attempt, outcome)
+                if result is not None:
+                    _on_result(result)
+    controller.report()
+    return successful, processed
+
+def get_variant_passes(extended_mode):
+    """扩展模式且主图优先时分两轮生成任务：先生成所有 _0，再生成 _1～_3"""
+    return [(0,), (1, 2, 3)] if extended_mode and PRIMARY_FIRST else [None]
+
+def iter_prioritized_tasks(csv_paths, output_dir, extended_mode=False, method="curl", announce=False):
+    """
+    按优先级生成多个CSV的下载任务：优先级高的CSV先下载，同一优先级内扩展模式下
+    先生成所有任务的 _0 图片，再重新读取一遍生成变体，中途停止或被限速时每个任务至少已有主图
+    """
+    for group in group_csv_by_priority(csv_paths):
+        for variants in get_variant_passes(extended_mode):
+            for csv_path in group:
+                if announce:
+                    print(f"\n正在读取{'扩展变体' if variants and 0 not in variants else ''}: {csv_path}")
+                yield from iter_csv_file_tasks(csv_path, output_dir, extended_mode, method, variants)
+
+def iter_csv_file_tasks(csv_path, output_dir, extended_mode=False, method="curl", variants=None):
+    """打开CSV文件并逐行生成下载任务；表头缺少必要字段或读取出错时打印错误并结束该文件"""
+    try:
+        with open(csv_path, 'r', encoding='utf-8-sig') as csvfile:
+            reader = csv.DictReader(csvfile, quotechar='"', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+            fields = resolve_csv_fields(reader.fieldnames, csv_path)
+            if fields is None:
+                return
+            task_id_field, task_url_field = fields
+            yield from iter_row_tasks(reader, output_dir, task_id_field, task_url_field, extended_mode, method,
+                                      variants)
+    except Exception as e:
+        print(f"处理CSV文件时出错 ({csv_path}): {str(e)}")
+
+def count_csv_tasks(csv_paths, extended_mode=False):
+    """快速统计CSV中的下载任务数（不构造任务），用于进度条总数与剩余时间估计"""
+    total = 0
+    for csv_path in csv_paths:
+        try:
+            with open(csv_path, 'r', encoding='utf-8-sig') as csvfile:
+                reader = csv.reader(csvfile, quotechar='"', skipinitialspace=True)
+                header = next(reader, [])
+                if '图片链接' not in header:
+                    continue
+                link_index = header.index('图片链接')
+                id_index = header.index('任务id') if '任务id' in header else header.index('任务ID') if '任务ID' in header else None
+                for i, row in enumerate(reader):
+                    if len(row) > link_index and row[link_index].strip():
+                        if PARTITION is not None and id_index is not None and len(row) > id_index \
+                                and not in_partition(clean_task_id(row[id_index], i)):
+                            continue
+                        total += 4 if extended_mode else 1
+        except Exception:
+            continue
+    return total
+
+def run_with_progress(tasks, csv_paths, output_dir, num_threads=4, extended_mode=False, method="curl"):
+    """
+    用一个线程池/事件循环和一个进度条执行所有任务。
+    后台线程统计任务总数后再设置进度条总数，下载无需等待统计完成。
+    """
+    from tqdm import tqdm
+
+    with tqdm(desc="下载进度", unit="张") as progress_bar:
+        def _set_total():
+            progress_bar.total = count_csv_tasks(csv_paths, extended_mode)
+            progress_bar.refresh()
+        # 共享队列模式下每个工作进程领取的任务数事先未知，不设置总数
+        if LEASE_DB_PATH is None:
+            threading.Thread(target=_set_total, daemon=True).start()
+            successful_downloads, total_tasks = run_download_tasks(tasks, num_threads, method, progress_bar)
+        else:
+            successful_downloads, total_tasks = run_leased_tasks(tasks, output_dir, num_threads, method,
+                                                                 progress_bar)
+        progress_bar.total = progress_bar.n
+    if total_tasks > 0:
+        print(f"\n图片下载完成: 成功 {successful_downloads}/{total_tasks} 张")
+    else:
+        print("没有找到需要下载的图片链接")
+
+def process_csv_file(csv_path, output_dir, num_threads=4, extended_mode=False, method="curl"):
+    """
+    处理单个CSV文件：
+      - 逐行提取每行的任务ID、Prompt和图片链接，边读取边下载
+      - 构造下载任务，文件命名统一为 <任务ID>_N.xxx（普通模式下N固定为0）
+      - 下载成功后在对应图片同名位置生成txt文件；下载失败则不生成txt文件
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = dedup_tasks(iter_prioritized_tasks([csv_path], output_dir, extended_mode, method))
+    run_with_progress(tasks, [csv_path], output_dir, num_threads, extended_mode, method)
+
+def find_csv_files(input_dir, recursive=False):
+    """查找目录中的CSV文件（可递归子目录），按路径排序"""
+    csv_paths = []
+    if recursive:
+        for root, dirs, files in os.walk(input_dir):
+            dirs.sort()
+            csv_paths.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith('.csv'))
+    else:
+        csv_paths = [os.path.join(input_dir, name) for name in sorted(os.listdir(input_dir))
+                     if name.lower().endswith('.csv') and os.path.isfile(os.path.join(input_dir, name))]
+    return csv_paths
+
+def process_directory(input_dir, output_dir, num_threads=4, extended_mode=False, method="curl", recursive=False):
+    """
+    处理目录中的所有CSV文件：所有CSV的任务合并为一个任务流，
+    由同一个线程池（或事件循环）下载，并显示一个总进度条，避免逐个文件收尾时线程空闲
+    """
+    csv_paths = find_csv_files(input_dir, recursive)
+    if not csv_paths:
+        print(f"目录中没有找到CSV文件: {input_dir}")
+        return
+    print(f"\n找到 {len(csv_paths)} 个CSV文件，合并为一个下载队列处理")
+    os.makedirs(output_dir, exist_ok=True)
+
+    tasks = iter_prioritized_tasks(csv_paths, output_dir, extended_mode, method, announce=True)
+    run_with_progress(dedup_tasks(tasks), csv_paths, output_dir, num_threads, extended_mode, method)
+
+def process_input(input_path, output_dir, num_threads=4, extended_mode=False, method="curl", recursive=False):
+    """根据输入路径类型处理文件或目录"""
+    reset_task_dedup()
+    start_run_metrics()
+    if os.path.isfile(input_path) and input_path.lower().endswith('.csv'):
+        process_csv_file(input_path, output_dir, num_threads, extended_mode, method)
+    elif os.path.isdir(input_path):
+        process_directory(input_path, output_dir, num_threads, extended_mode, method, recursive)
+    else:
+        print("错误: 输入路径不是CSV文件也不是目录！")
+    if _duplicate_count:
+        print(f"跨CSV去重: 跳过重复任务 {_duplicate_count} 个")
+    close_postprocess_pool()
+    finish_run_metrics()
+    close_lease_queue()
+    close_shard_writers()
+    close_manifests()
+    print_connection_reuse_stats()
+    print_task_page_cache_stats()
+    print_postprocess_stats()
+        
+        
+WATCH_STATE_FILENAME = ".mj_watch_state.json"
+WATCH_HEAD_BYTES = 4096
+WATCH_RETRY_DELAY = 60.0
+WATCH_RETRY_MAX_DELAY = 3600.0
+WATCH_RETRY_LIMIT = 8
+
+class WatchState:
+    """
+    监视模式下每个CSV文件的处理进度，保存在输出目录的 .mj_watch_state.json 中：
+    已解析到的字节偏移，以及文件开头一段内容的校验和（文件被替换或截断时从头重新解析）。
+    尚未结束的任务（下载中或等待重试）按所在行的起始偏移记录，保存的偏移不超过其中最早的一行，
+    重启后从该行重新解析（已完成的任务由下载清单跳过）；失败的任务按指数退避在之后的轮询中重新下载
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, WATCH_STATE_FILENAME)
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.files = json.load(f)
+        except (OSError, ValueError):
+            self.files = {}
+        self.outstanding = {}
+        self._lock = threading.Lock()
+
+    def track(self, file_key, row_start, task):
+        """记录刚生成的任务及其所在行的起始偏移，任务结束前保存的偏移不会越过这一行"""
+        with self._lock:
+            self.outstanding.setdefault((task[3], task[0]), {
+                "file": file_key, "row": row_start, "task": task, "failures": 0, "due": None})
+
+    def settle(self, result):
+        """
+        任务结束时调用：成功、跳过或图片不存在时不再跟踪；
+        其它失败在 WATCH_RETRY_DELAY × 2^n 秒（最长 WATCH_RETRY_MAX_DELAY）后重新排队，最多 WATCH_RETRY_LIMIT 次
+        """
+        key = (result["task_id"], result["image_url"])
+        with self._lock:
+            entry = self.outstanding.get(key)
+            if entry is None:
+                return
+            if (result["success"] or result.get("status") in PERMANENT_HTTP_STATUSES
+                    or entry["failures"] >= WATCH_RETRY_LIMIT):
+                del self.outstanding[key]
+                return
+            delay = min(WATCH_RETRY_DELAY * 2 ** entry["failures"], WATCH_RETRY_MAX_DELAY)
+            entry["failures"] += 1
+            entry["due"] = time.monotonic() + delay
+        log(f"{delay:.0f}秒后重新下载失败的任务 ({entry['failures']}/{WATCH_RETRY_LIMIT}): {key[1]}")
+
+    def due_retries(self):
+        """取出已到重试时间的任务；重新下载的任务不经过去重"""
+        now = time.monotonic()
+        with self._lock:
+            due = [entry for entry in self.outstanding.values() if entry["due"] is not None and entry["due"] <= now]
+            for entry in due:
+                entry["due"] = None
+        return [entry["task"] for entry in due]
+
+    def forget(self, file_key):
+        """CSV文件被替换或截断时丢弃该文件中尚未结束的任务（将从头重新解析）"""
+        with self._lock:
+            for key in [key for key, entry in self.outstanding.items() if entry["file"] == file_key]:
+                del self.outstanding[key]
+
+    def save(self):
+        with self._lock:
+            files = {key: dict(entry) for key, entry in self.files.items()}
+            for entry in self.outstanding.values():
+                saved = files.get(entry["file"])
+                if saved is not None and entry["row"] < saved["offset"]:
+                    saved["offset"] = entry["row"]
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(files, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.path)
+
+def _head_checksum(f, length):
+    f.seek(0)
+    return hashlib.sha1(f.read(length)).hexdigest()
+
+def iter_complete_records(f):
+    """
+    从文件当前位置读取完整的CSV记录，返回 (记录文本, 记录结束后的偏移)；
+    引号内的换行不算记录结尾，文件末尾尚未写完的记录留到下次读取
+    """
+    pending = b""
+    for line in iter(f.readline, b""):
+        pending += line
+        if not line.endswith(b"\n"):
+            return
+        if pending.count(b'"') % 2 == 0:
+            yield pending.decode("utf-8", errors="replace"), f.tell()
+            pending = b""
+
+def iter_new_csv_tasks(csv_path, output_dir, state, extended_mode=False, method="curl"):
+    """
+    只解析CSV中上次处理之后新增的完整行并生成（去重后的）下载任务，同时在 state 中推进该文件的偏移，
+    并记录每个任务所在行的起始偏移
+    """
+    key = os.path.abspath(csv_path)
+    entry = state.files.get(key)
+    try:
+        size = os.path.getsize(csv_path)
+        with open(csv_path, "rb") as f:
+            if entry is not None:
+                if entry["offset"] == size and entry.get("size") == size:
+                    return
+                if size < entry["offset"] or _head_checksum(f, entry["head_len"]) != entry["head_sha1"]:
+                    print(f"CSV文件已被替换或截断，重新解析: {csv_path}")
+                    state.forget(key)
+                    entry = None
+            f.seek(0)
+            header_line = f.readline()
+            if not header_line.endswith(b"\n"):
+                return
+            fieldnames = next(csv.reader([header_line.decode("utf-8-sig")], skipinitialspace=True))
+            if entry is None:
+                entry = {"offset": len(header_line)}
+            entry["head_len"] = min(max(entry["offset"], len(header_line)), WATCH_HEAD_BYTES)
+            entry["head_sha1"] = _head_checksum(f, entry["head_len"])
+            entry["size"] = size
+            state.files[key] = entry
+            fields = resolve_csv_fields(fieldnames, csv_path)
+            if fields is None:
+                # 表头不符合要求：记录到文件末尾，避免每次轮询重复报错
+                entry["offset"] = size
+                return
+            task_id_field, task_url_field = fields
+            f.seek(entry["offset"])
+
+            def _iter_rows():
+                for text, end in iter_complete_records(f):
+                    for values in csv.reader(io.StringIO(text), quotechar='"', skipinitialspace=True):
+                        yield {name: values[i] if i < len(values) else "" for i, name in enumerate(fieldnames)}
+                    entry["offset"] = end
+                    if entry["head_len"] < WATCH_HEAD_BYTES:
+                        entry["head_len"] = min(end, WATCH_HEAD_BYTES)
+                        entry["head_sha1"] = _head_checksum(f, entry["head_len"])
+                        f.seek(end)
+
+            # 生成任务时 entry["offset"] 仍是当前行的起始偏移（该行的任务全部取出后才前进）
+            for task in dedup_tasks(iter_row_tasks(_iter_rows(), output_dir, task_id_field, task_url_field,
+                                                   extended_mode, method)):
+                state.track(key, entry["offset"], task)
+                yield task
+    except (OSError, csv.Error) as e:
+        print(f"读取CSV文件时出错 ({csv_path}): {str(e)}")
+
+def start_change_observer(input_path, recursive, wake_event):
+    """
+    用watchdog（Linux下基于inotify）监听CSV文件的新建与修改，有变化时设置 wake_event；
+    未安装watchdog时返回None，改为按固定间隔轮询
+    """
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+
+    class _CsvChangeHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            paths = (getattr(event, "src_path", ""), getattr(event, "dest_path", ""))
+            if any(str(path).lower().endswith(".csv") for path in paths):
+                wake_event.set()
+
+    watch_dir = input_path if os.path.isdir(input_path) else os.path.dirname(os.path.abspath(input_path))
+    observer = Observer()
+    observer.schedule(_CsvChangeHandler(), watch_dir, recursive=recursive)
+    observer.start()
+    return observer
+
+def run_incremental(iter_batch_tasks, wait_for_more, num_threads=4, method="curl", after_batch=None,
+                    on_result=None):
+    """
+    监视模式与接收服务共用的循环：反复取出一批新任务并下载，直到按 Ctrl+C 退出。
+    各批任务共用同一个 DownloadRuntime（线程池、async会话或子进程）、HTTP连接池和下载清单；iter_batch_tasks() 返回本批的任务迭代器（由调用方去重，
+    重新下载的失败任务不应被去重记录拦下），wait_for_more() 阻塞到可能有新任务为止；
+    wait_for_more 为None时 iter_batch_tasks() 返回的是持续产生任务的迭代器（接收服务），迭代器结束即退出，
+    after_batch() 在每批完成后调用（如保存处理进度），on_result(result) 在每个任务结束时调用
+    """
+    reset_task_dedup()
+    start_run_metrics()
+    total_successful = 0
+    total_processed = 0
+    try:
+        with DownloadRuntime(num_threads, method) as runtime:
+            while True:
+                successful, processed = run_download_tasks(iter_batch_tasks(), num_threads, method,
+                                                           on_result=on_result, runtime=runtime)
+                if after_batch is not None:
+                    after_batch()
+                if processed:
+                    total_successful += successful
+                    total_processed += processed
+                    print(f"[{time.strftime('%H:%M:%S')}] 新任务 {processed} 个，成功 {successful} 个"
+                          f"（累计 {total_successful}/{total_processed}）")
+                if wait_for_more is None:
+                    break
+                wait_for_more()
+    except KeyboardInterrupt:
+        print("\n已停止")
+    finally:
+        close_postprocess_pool()
+        finish_run_metrics()
+        close_lease_queue()
+        close_shard_writers()
+        close_manifests()
+        print_connection_reuse_stats()
+        print_postprocess_stats()
+
+def watch_input(input_path, output_dir, num_threads=4, extended_mode=False, method="curl",
+                recursive=False, interval=10.0):
+    """监视模式：持续检查CSV文件（目录中新建的或已有文件新增的行），只解析新增的行并下载"""
+    state = WatchState(output_dir)
+    wake_event = threading.Event()
+    observer = start_change_observer(input_path, recursive, wake_event)
+    mode = "文件系统事件" if observer is not None else f"每 {interval:g} 秒轮询"
+    print(f"监视模式（{mode}）: {input_path}，按 Ctrl+C 退出")
+
+    def _iter_new_tasks():
+        yield from state.due_retries()
+        csv_paths = find_csv_files(input_path, recursive) if os.path.isdir(input_path) else [input_path]
+        for csv_path in csv_paths:
+            yield from iter_new_csv_tasks(csv_path, output_dir, state, extended_mode, method)
+
+    def _wait_for_change():
+        wake_event.wait(interval)
+        if wake_event.is_set():
+            # 文件可能仍在写入，稍等片刻再读取
+            time.sleep(0.5)
+            wake_event.clear()
+
+    try:
+        run_incremental(_iter_new_tasks, _wait_for_change, num_threads, method, after_batch=state.save,
+                        on_result=state.settle)
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        state.save()
+
+INGEST_CSV_COLUMNS = ['Prompt', 'Prompt 参数', '任务ID', '任务链接', '图片链接', '用户名', '用户ID', '用户主页', '其他信息']
+INGEST_MAX_BODY = 32 * 1024 * 1024
+# 只有插件运行的页面可以跨域访问接收服务；没有Origin的请求（curl、脚本）不受限制
+INGEST_ALLOWED_ORIGINS = ("https://www.midjourney.com",)
+INGEST_TOKEN_HEADER = "X-MJ-Token"
+
+def parse_ingest_address(address):
+    """解析 --serve 的 [HOST:]PORT，默认只监听本机"""
+    host, _, port = str(address).rpartition(":")
+    try:
+        return host or "127.0.0.1", int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"监听地址格式应为 [HOST:]PORT，收到: {address}")
+
+def parse_content_length(value):
+    """解析请求头中的 Content-Length：缺少时返回None，不是非负整数时返回-1"""
+    if value is None:
+        return None
+    value = value.strip()
+    return int(value) if value.isascii() and value.isdigit() else -1
+
+def normalize_ingest_records(body, content_type):
+    """
+    把接收到的请求体转换为与CSV导出相同列名的记录列表：
+    支持JSON数组、{"records": [...]} 或带表头的CSV文本；缺少必要字段时抛出 ValueError
+    """
+    if "csv" in content_type:
+        reader = csv.DictReader(io.StringIO(body.decode("utf-8-sig")), skipinitialspace=True)
+        records = list(reader)
+    else:
+        records = json.loads(body.decode("utf-8-sig") or "[]")
+        if isinstance(records, dict):
+            records = records.get("records", [])
+    if not isinstance(records, list):
+        raise ValueError("请求体应为记录数组")
+    normalized = []
+    for record in records:
+        if not isinstance(record, dict):
+            raise ValueError("每条记录应为JSON对象")
+        row = {key: "" if value is None else str(value) for key, value in record.items()}
+        if '任务id' in row and '任务ID' not in row:
+            row['任务ID'] = row.pop('任务id')
+        for field in ('Prompt', '任务ID', '图片链接'):
+            if field not in row:
+                raise ValueError(f"记录缺少必要字段 '{field}'")
+        normalized.append(row)
+    return normalized
+
+class IngestServer:
+    """
+    本地接收服务：浏览器插件在抓取过程中把记录分批POST到 /records，
+    记录进入队列后由 iter_tasks() 在下载进行中随到随取，同时追加写入输出目录中的 ingest-日期.csv 留档。
+    跨域请求只接受 INGEST_ALLOWED_ORIGINS 中的来源；设置 token 时每个请求都需带上 X-MJ-Token 请求头
+    """
+
+    def __init__(self, host, port, output_dir, token=None):
+        import http.server
+
+        self.records = queue.Queue()
+        self.stopped = threading.Event()
+        self.output_dir = output_dir
+        self.token = token or None
+        self.received = 0
+        self._received_lock = threading.Lock()
+        self._csv_lock = threading.Lock()
+        server = self
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def _send_json(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self._send_cors_headers()
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_cors_headers(self):
+                # 插件的content script以页面来源发起请求，只对允许的来源开放跨域和本机地址访问
+                origin = self.headers.get("Origin")
+                if origin not in INGEST_ALLOWED_ORIGINS:
+                    return
+                self.send_header("Access-Control-Allow-Origin", origin)
+                self.send_header("Vary", "Origin")
+                self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+                self.send_header("Access-Control-Allow-Headers", f"Content-Type, {INGEST_TOKEN_HEADER}")
+                self.send_header("Access-Control-Allow-Private-Network", "true")
+
+            def _authorize(self):
+                """检查请求来源与令牌，不通过时返回错误响应并返回False"""
+                origin = self.headers.get("Origin")
+                if origin is not None and origin not in INGEST_ALLOWED_ORIGINS:
+                    self._send_json(403, {"error": "origin not allowed"})
+                    return False
+                if server.token is not None and not hmac.compare_digest(
+                        self.headers.get(INGEST_TOKEN_HEADER, "").encode("utf-8"), server.token.encode("utf-8")):
+                    self._send_json(401, {"error": "invalid token"})
+                    return False
+                return True
+
+            def do_OPTIONS(self):
+                if self.headers.get("Origin") not in INGEST_ALLOWED_ORIGINS:
+                    self._send_json(403, {"error": "origin not allowed"})
+                    return
+                self.send_response(204)
+                self._send_cors_headers()
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                if urlparse(self.path).path.rstrip("/") != "/status":
+                    self._send_json(404, {"error": "not found"})
+                    return
+                if not self._authorize():
+                    return
+                self._send_json(200, {"received": server.received, "queued": server.records.qsize()})
+
+            def do_POST(self):
+                if urlparse(self.path).path.rstrip("/") != "/records":
+                    self._send_json(404, {"error": "not found"})
+                    return
+                if not self._authorize():
+                    return
+                length = parse_content_length(self.headers.get("Content-Length"))
+                if length is None:
+                    self._send_json(411, {"error": "Content-Length required"})
+                    return
+                if length < 0:
+                    self._send_json(400, {"error": "invalid Content-Length"})
+                    return
+                if length > INGEST_MAX_BODY:
+                    self._send_json(413, {"error": "request body too large"})
+                    return
+                try:
+                    records = normalize_ingest_records(self.rfile.read(length),
+                                                       self.headers.get("Content-Type", "").lower())
+                except (ValueError, csv.Error) as e:
+                    self._send_json(400, {"error": str(e)})
+                    return
+                server.accept(records)
+                self._send_json(200, {"accepted": len(records), "queued": server.records.qsize()})
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mj-ingest", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def accept(self, records):
+        if not records:
+            return
+        self.append_to_csv(records)
+        for record in records:
+            self.records.put(record)
+        with self._received_lock:
+            self.received += len(records)
+            received = self.received
+        log(f"收到 {len(records)} 条记录（累计 {received} 条）")
+
+    def append_to_csv(self, records):
+        """把收到的记录按导出格式追加到当天的CSV，便于之后用普通模式重新处理"""
+        csv_path = os.path.join(self.output_dir, f"ingest-{time.strftime('%Y%m%d')}.csv")
+        columns = INGEST_CSV_COLUMNS + sorted({key for record in records for key in record} - set(INGEST_CSV_COLUMNS))
+        with self._csv_lock:
+            is_new = not os.path.exists(csv_path)
+            if not is_new:
+                with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+                    columns = next(csv.reader(f), columns)
+            with open(csv_path, "a", encoding="utf-8-sig" if is_new else "utf-8", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=columns, quoting=csv.QUOTE_ALL, extrasaction="ignore")
+                if is_new:
+                    writer.writeheader()
+                writer.writerows(records)
+
+    def drain(self, timeout):
+        """等待最多 timeout 秒，取出当前队列中的全部记录"""
+        try:
+            rows = [self.records.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                rows.append(self.records.get_nowait())
+            except queue.Empty:
+                return rows
+
+    def iter_tasks(self, extended_mode=False, method="curl"):
+        """
+        持续把收到的记录转换为去重后的下载任务，直到 close()：队列为空时等待最多 IDLE_POLL_INTERVAL 秒，
+        仍没有记录就产生None，让调度器先处理已完成的下载，新记录在其它图片下载期间也能立即开始
+        """
+        while not self.stopped.is_set():
+            rows = self.drain(timeout=IDLE_POLL_INTERVAL)
+            if not rows:
+                yield None
+                continue
+            for variants in get_variant_passes(extended_mode):
+                yield from dedup_tasks(iter_row_tasks(rows, self.output_dir, '任务ID', '任务链接', extended_mode,
+                                                      method, variants))
+
+    def close(self):
+        self.stopped.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def serve_ingest(address, output_dir, num_threads=4, extended_mode=False, method="curl", token=None):
+    """接收服务模式：插件抓取的记录一到达就开始下载，不必等待导出CSV；token 非空时要求请求带上相同的令牌"""
+    host, port = parse_ingest_address(address) if isinstance(address, str) else address
+    try:
+        server = IngestServer(host, port, output_dir, token)
+    except OSError as e:
+        print(f"错误: 无法在 {host}:{port} 启动接收服务: {str(e)}")
+        return
+    server.start()
+    print(f"接收服务已启动: http://{host}:{port}/records ，按 Ctrl+C 退出")
+    try:
+        # 整个服务期间只有一次下载运行，记录到达后在空闲的并发名额中立即开始，不必等待前面的图片下载完
+        run_incremental(lambda: server.iter_tasks(extended_mode, method), None, num_threads, method)
+    finally:
+        server.close()
+
+def configure(pool_size=HTTP_POOL_SIZE, task_page_ttl=TASK_PAGE_CACHE_TTL, concurrency=ASYNC_CONCURRENCY,
+              h2_connections=H2_MAX_CONNECTIONS, h2_streams=H2_MAX_STREAMS, curl_batch=CURL_BATCH_SIZE,
+              manifest=True, content_store=False, missing_ttl=MISSING_CACHE_TTL / 86400, probe=False,
+              prefer_format=PREFERRED_FORMAT, output_format="files", shard_size=1024, index_format="jsonl",
+              partition=None, lease_db=None, worker_id=None, lease_seconds=LEASE_SECONDS, processes=1,
+              adaptive=False, host_rate=0.0, priority=None, interleave_variants=False, max_bandwidth=0.0,
+              verify=False, resize=0, thumbnail=0, reencode=None, postprocess_workers=0,
+              quiet=False, metrics_log=None, metrics_report=None):
+    """按给定选项设置全部模块级配置（命令行与 Downloader 共用），参数与同名的命令行选项含义一致"""
+    configure_http_pool(pool_size)
+    configure_task_page_cache(task_page_ttl)
+    configure_async_engine(concurrency)
+    configure_h2(h2_connections, h2_streams)
+    configure_curl_batch(curl_batch)
+    configure_manifest(manifest)
+    configure_content_store(content_store)
+    configure_missing_cache(missing_ttl, probe)
+    configure_image_format(prefer_format)
+    configure_output_format(output_format, shard_size, index_format)
+    configure_distribution(partition, lease_db, worker_id, lease_seconds)
+    configure_processes(processes)
+    configure_rate_control(adaptive, host_rate)
+    configure_priority(priority, interleave_variants)
+    configure_bandwidth(max_bandwidth)
+    configure_postprocess(verify, resize, thumbnail, reencode, postprocess_workers)
+    configure_output(quiet, metrics_log, metrics_report)
+
+def test_download_image(url, output_dir=None, task_url=None, method="curl"):
+    """测试下载单个图片URL功能"""
+    if not output_dir:
+        output_dir = os.path.join(os.getcwd(), "test_images")
+    os.makedirs(output_dir, exist_ok=True)
+    parsed_url = urlparse(url)
+    file_name = os.path.basename(parsed_url.path)
+    if not file_name:
+        file_name = f"test_image_{int(time.time())}.png"
+    if not os.path.splitext(file_name)[1]:
+        file_name += ".png"
+    save_path = os.path.join(output_dir, file_name)
+    print(f"测试下载图片: {url}")
+    if task_url:
+        print(f"使用任务URL: {task_url}")
+    print(f"保存路径: {save_path}")
+    result = download_image(url, save_path, task_url, method=method)
+    if result:
+        print("✅ 测试成功: 图片已成功下载")
+    else:
+        print("❌ 测试失败: 无法下载图片")
+    return result
+
+def check_curl_installation():
+    """检查curl是否已安装"""
+    curl_path = get_curl_path()
+    if curl_path:
+        print(f"✅ curl已安装: {curl_path}")
+        return True
+    else:
+        print("❌ curl未安装。建议安装curl以提高下载成功率。")
+        if platform.system() == "Windows":
+            print("  Windows安装方法: 例如使用Chocolatey: choco install curl")
+        elif platform.system() == "Darwin":
+            print("  macOS安装方法: brew install curl")
+        elif platform.system() == "Linux":
+            print("  Linux安装方法: sudo apt-get install curl 或 sudo yum install curl")
+        return False
@@ -0,0 +1,156 @@
+"""可嵌入其它程序的下载引擎"""
+
+import os
+import csv
+import queue
+import threading
+
+from . import core
+
+
+class Downloader:
+    """
+    可长期复用的下载引擎：创建时设置一次配置，之后可多次提交CSV文件、CSV文本流或记录，
+    各次提交共用同一个线程池（async方式为事件循环与会话，多进程时为子进程）、HTTP连接池、下载清单与各类缓存，每个任务的结果在完成时通过回调或迭代器返回。
+    配置保存在进程级的模块变量中（见 core.configure），同一进程中同时只能有一个未关闭的 Downloader，
+    创建第二个时抛出 RuntimeError，避免后创建的实例悄悄改掉前一个实例的配置。
+
+    用法:
+        with Downloader("output", method="async", threads=32, prefer_format="webp") as downloader:
+            for result in downloader.iter_results(downloader.tasks_from_csv("MJ-top.csv")):
+                print(result["task_id"], result["success"])
+    """
+
+    _active = None
+    _active_lock = threading.Lock()
+
+    def __init__(self, output_dir, method="curl", threads=4, extended=False, **options):
+        """options 为 core.configure 的参数（与命令行选项同名，如 pool_size、prefer_format、quiet）"""
+        if method not in core.DOWNLOAD_METHODS:
+            raise ValueError(f"不支持的下载方式: {method}")
+        if method == "h2" and core._import_httpx() is None:
+            raise RuntimeError('h2下载方式需要安装httpx[http2]，请执行: pip install "httpx[http2]"')
+        with Downloader._active_lock:
+            if Downloader._active is not None:
+                raise RuntimeError("同一进程中已有未关闭的 Downloader（配置为进程级共享），请先调用其 close()")
+            Downloader._active = self
+        try:
+            core.configure(**options)
+            if core.postprocess_enabled() and core._import_pil() is None:
+                raise RuntimeError("下载后处理需要安装Pillow，请执行: pip install Pillow")
+            os.makedirs(output_dir, exist_ok=True)
+        except BaseException:
+            self._release()
+            raise
+        self.output_dir = output_dir
+        self.method = method
+        self.threads = max(1, int(threads))
+        self.extended = extended
+        self._runtime = core.DownloadRuntime(self.threads, method)
+        self._run_lock = threading.Lock()
+        self._closed = False
+        core.start_run_metrics()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def tasks_from_csv(self, source, recursive=False):
+        """
+        从CSV生成下载任务（按需读取）：source 可以是CSV文件路径、包含CSV的目录，
+        或已打开的文本流（如 io.StringIO、sys.stdin）
+        """
+        if isinstance(source, (str, os.PathLike)):
+            path = os.fspath(source)
+            csv_paths = core.find_csv_files(path, recursive) if os.path.isdir(path) else [path]
+            return core.iter_prioritized_tasks(csv_paths, self.output_dir, self.extended, self.method)
+        return self._iter_stream_tasks(source)
+
+    def _iter_stream_tasks(self, stream):
+        reader = csv.DictReader(stream, quotechar='"', skipinitialspace=True)
+        fields = core.resolve_csv_fields(reader.fieldnames, getattr(stream, "name", "<stream>"))
+        if fields is None:
+            return
+        task_id_field, task_url_field = fields
+        yield from core.iter_row_tasks(reader, self.output_dir, task_id_field, task_url_field,
+                                       self.extended, self.method)
+
+    def tasks_from_records(self, records):
+        """
+        从记录生成下载任务：每条记录是与CSV导出列名相同的字典（Prompt、任务ID、图片链接 等）；
+        传入列表时扩展模式下先生成所有 _0 任务，传入迭代器时按顺序生成
+        """
+        if isinstance(records, (list, tuple)):
+            passes = core.get_variant_passes(self.extended)
+        else:
+            passes = [None]
+        for variants in passes:
+            yield from core.iter_row_tasks(records, self.output_dir, '任务ID', '任务链接', self.extended,
+                                           self.method, variants)
+
+    def run(self, tasks, on_result=None):
+        """
+        下载一批任务，每个任务结束时以结果字典调用 on_result（在调度线程中调用），
+        返回 (成功数, 处理的任务数)；多次调用依次执行
+        """
+        if self._closed:
+            raise RuntimeError("Downloader 已关闭")
+        with self._run_lock:
+            core.reset_task_dedup()
+            return core.run_download_tasks(core.dedup_tasks(tasks), self.threads, self.method,
+                                           on_result=on_result, runtime=self._runtime)
+
+    def download_csv(self, source, on_result=None, recursive=False):
+        """下载CSV文件、目录或文本流中的全部图片，返回 (成功数, 处理的任务数)"""
+        return self.run(self.tasks_from_csv(source, recursive), on_result)
+
+    def download_records(self, records, on_result=None):
+        """下载一组记录（CSV导出列名的字典）中的图片，返回 (成功数, 处理的任务数)"""
+        return self.run(self.tasks_from_records(records), on_result)
+
+    def iter_results(self, tasks):
+        """在后台线程中下载任务，按完成顺序逐个产出结果字典；下载过程中的异常在迭代结束时抛出"""
+        results = queue.Queue()
+        finished = object()
+        errors = []
+
+        def _run():
+            try:
+                self.run(tasks, on_result=results.put)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                results.put(finished)
+
+        thread = threading.Thread(target=_run, name="mj-downloader", daemon=True)
+        thread.start()
+        while True:
+            result = results.get()
+            if result is finished:
+                break
+            yield result
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def _release(self):
+        with Downloader._active_lock:
+            if Downloader._active is self:
+                Downloader._active = None
+
+    def close(self):
+        """结束运行：打印指标汇总，关闭线程池与子进程、处理进程池、分片、下载清单与共享队列"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._runtime.close()
+            core.close_postprocess_pool()
+            core.finish_run_metrics()
+            core.close_lease_queue()
+            core.close_shard_writers()
+            core.close_manifests()
+        finally:
+            self._release()
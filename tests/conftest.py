@@ -0,0 +1,127 @@
+"""测试公共设置：每个测试结束后恢复 core 的模块级配置并关闭打开的清单、分片与共享队列"""
+
+import hashlib
+import http.server
+import importlib.util
+import os
+import re
+import sys
+import threading
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from mj_csv_dl import core  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def restore_core_config():
+    saved = core.snapshot_config()
+    core.QUIET = True
+    yield
+    core.close_lease_queue()
+    core.close_shard_writers()
+    core.close_manifests()
+    core.close_postprocess_pool()
+    core.reset_task_dedup()
+    for name, value in saved.items():
+        setattr(core, name, value)
+    core._host_rate_limiter = None
+    core._bandwidth_limiter = None
+
+
+def make_task(task_id="abc_0", url="https://cdn.midjourney.com/abc/0_0.png", output_dir="out",
+              extended=False, method="requests", metadata=None, ext=".png"):
+    """构造与 iter_row_tasks 相同结构的任务元组"""
+    image_path = os.path.join(str(output_dir), f"{task_id}{ext}")
+    return (url, image_path, None, task_id, "a prompt", extended, method, metadata or {})
+
+
+PNG_BYTES = (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00\x90wS\xde"
+             b"\x00\x00\x00\x0cIDATx\x9cc\xf8\xcf\xc0\x00\x00\x03\x01\x01\x00\xc9\xfe\x92\xef"
+             b"\x00\x00\x00\x00IEND\xaeB`\x82")
+
+
+class ImageServer:
+    """
+    本机图片服务器：files 中的路径返回对应内容（带强ETag，支持 Range 与 If-Range），其它路径返回404；
+    truncate 中的路径只发送前若干字节后断开连接，模拟下载中断。requests 记录每个请求的 (方法, 路径, 请求头)
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.truncate = {}
+        self.requests = []
+        server = self
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self._respond(send_body=False)
+
+            def do_GET(self):
+                self._respond(send_body=True)
+
+            def _respond(self, send_body):
+                server.requests.append((self.command, self.path, dict(self.headers)))
+                data = server.files.get(self.path)
+                if data is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                etag = server.etag(self.path)
+                match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+                if_range = self.headers.get("If-Range")
+                start = int(match.group(1)) if match and (if_range is None or if_range == etag) else 0
+                self.send_response(206 if start else 200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(data) - start))
+                if start:
+                    self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+                self.end_headers()
+                if not send_body:
+                    return
+                limit = server.truncate.pop(self.path, None)
+                if limit is not None:
+                    self.wfile.write(data[start:limit])
+                    self.close_connection = True
+                    return
+                self.wfile.write(data[start:])
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_port}{path}"
+
+    def etag(self, path):
+        return '"' + hashlib.sha1(self.files[path]).hexdigest()[:16] + '"'
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def image_server():
+    server = ImageServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture(scope="session")
+def benchmark_module():
+    """按路径导入基准测试脚本（文件名不是合法的模块名），其中的模拟CDN供测试使用"""
+    spec = importlib.util.spec_from_file_location("mj_csv_benchmark", os.path.join(ROOT_DIR, "MJ-CSV-基准测试.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
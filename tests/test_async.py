@@ -0,0 +1,27 @@
+import pytest
+
+from conftest import make_task, PNG_BYTES
+from mj_csv_dl import core
+
+pytest.importorskip("aiohttp")
+
+
+def test_async_downloads_many_tasks(tmp_path, image_server):
+    core.configure_async_engine(4)
+    tasks = []
+    for i in range(20):
+        image_server.files[f"/t{i}/0_0.png"] = PNG_BYTES
+        tasks.append(make_task(f"t{i}_0", image_server.url(f"/t{i}/0_0.png"), tmp_path, method="async"))
+    tasks.append(make_task("gone_1", image_server.url("/gone/0_1.png"), tmp_path, extended=True, method="async"))
+    results = []
+    assert core.run_download_tasks(tasks, num_threads=4, method="async", on_result=results.append) == (20, 21)
+    failed = [result for result in results if not result["success"]]
+    assert [(result["task_id"], result["status"], result["attempts"]) for result in failed] == [("gone_1", 404, 1)]
+    assert all((tmp_path / f"t{i}_0.txt").exists() for i in range(20))
+
+
+def test_download_image_with_async(tmp_path, image_server):
+    image_server.files["/a/0_0.png"] = PNG_BYTES
+    assert core.download_image_with_async(image_server.url("/a/0_0.png"), str(tmp_path / "a_0.png"))
+    assert (tmp_path / "a_0.png").read_bytes() == PNG_BYTES
+    assert not core.download_image_with_async(image_server.url("/b/0_0.png"), str(tmp_path / "b_0.png"))
@@ -0,0 +1,36 @@
+import io
+
+import pytest
+
+from mj_csv_dl import core
+
+
+@pytest.fixture
+def config(benchmark_module):
+    return benchmark_module.MockCDNConfig(latency_ms=0, jitter_ms=0, min_size=2000, max_size=4000, variants=2)
+
+
+def test_mock_images_are_decodable(benchmark_module):
+    Image = pytest.importorskip("PIL.Image")
+    data = benchmark_module.build_payload("/abc/0_0.png", "png", 2000, 4000)
+    assert core.detect_image_format(data[:16]) == "png"
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+    assert benchmark_module.build_payload("/abc/0_0.png", "png", 2000, 4000) == data
+
+
+def test_mock_cdn_missing_variants_and_ranges(benchmark_module, config):
+    status, body, headers, _, is_image = benchmark_module.build_mock_response(config, "/abc/0_0.png")
+    assert (status, is_image) == (200, True)
+    assert benchmark_module.build_mock_response(config, "/abc/0_2.png")[0] == 404
+    status, part, part_headers, _, _ = benchmark_module.build_mock_response(config, "/abc/0_0.png", "bytes=100-",
+                                                                            headers["ETag"])
+    assert (status, part, part_headers["Content-Range"]) == (206, body[100:], f"bytes 100-{len(body) - 1}/{len(body)}")
+    status, full, _, _, _ = benchmark_module.build_mock_response(config, "/abc/0_0.png", "bytes=100-", '"stale"')
+    assert (status, full) == (200, body)
+
+
+def test_count_output_skips_metadata_and_temp_files(benchmark_module, tmp_path):
+    for name in ("a_0.png", "a_0.txt", "b_0.png.tmp", "metadata.jsonl", ".mj_manifest.sqlite3"):
+        (tmp_path / name).write_bytes(b"12345")
+    assert benchmark_module.count_output(str(tmp_path)) == (1, 5)
@@ -0,0 +1,64 @@
+import concurrent.futures
+
+import pytest
+
+from conftest import PNG_BYTES
+from mj_csv_dl import core
+
+
+@pytest.fixture
+def fresh_pool(monkeypatch):
+    """每个测试使用新的共享会话、预热记录与连接统计"""
+    monkeypatch.setattr(core, "_http_session", None)
+    monkeypatch.setattr(core, "_warmed_hosts", set())
+    monkeypatch.setattr(core, "_stdlib_stats", {"requests": 0, "connections": 0})
+    monkeypatch.setattr(core, "_h2_stats", dict(core._h2_stats, requests=0, connections=0))
+    monkeypatch.setattr(core, "_process_stats", dict(core._process_stats, requests=0, connections=0))
+    yield
+    if core._http_session is not None:
+        core._http_session.close()
+
+
+def serve_images(image_server, count):
+    for i in range(count):
+        image_server.files[f"/img/{i}_0.png"] = PNG_BYTES
+    return [image_server.url(f"/img/{i}_0.png") for i in range(count)]
+
+
+def test_shared_session_uses_configured_pool_size(fresh_pool):
+    core.configure_http_pool(3)
+    session = core.get_shared_session()
+    assert core.get_shared_session() is session
+    assert session.get_adapter("http://").poolmanager.connection_pool_kw["maxsize"] == 3
+    core.configure_http_pool(5)
+    rebuilt = core.get_shared_session()
+    assert rebuilt is not session
+    assert rebuilt.get_adapter("https://").poolmanager.connection_pool_kw["maxsize"] == core.HTTP_POOL_SIZE == 5
+
+
+def test_requests_downloads_reuse_one_connection(fresh_pool, image_server, tmp_path):
+    urls = serve_images(image_server, 5)
+    for i, url in enumerate(urls):
+        assert core.download_image_with_requests(url, str(tmp_path / f"{i}_0.png"))
+    # 预热请求与5次下载共用同一个长连接
+    assert core.get_connection_reuse_stats() == {"requests": 6, "connections": 1, "reused": 5}
+
+
+def test_urllib_downloads_reuse_the_thread_connection(fresh_pool, image_server, tmp_path):
+    urls = serve_images(image_server, 3)
+    for i, url in enumerate(urls):
+        assert core.download_image_with_urllib(url, str(tmp_path / f"{i}_0.png"))
+    assert core.get_connection_reuse_stats() == {"requests": 3, "connections": 1, "reused": 2}
+
+
+def test_each_host_is_warmed_up_once(fresh_pool, image_server, tmp_path):
+    urls = serve_images(image_server, 8)
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda i: core.download_image_with_requests(urls[i], str(tmp_path / f"{i}_0.png")),
+                                range(len(urls))))
+    assert all(results)
+    assert [path for method, path, _ in image_server.requests if path == "/"] == ["/"]
+    # 以其它主机名访问时单独预热，已预热的主机不再请求首页
+    core.warm_up_host(urls[0].replace("127.0.0.1", "localhost"), {})
+    core.warm_up_host(urls[1], {})
+    assert [path for method, path, _ in image_server.requests].count("/") == 2
@@ -0,0 +1,92 @@
+import threading
+import time
+
+from conftest import PNG_BYTES, make_task
+from mj_csv_dl import core
+
+
+def test_parse_curl_timings_converts_to_milliseconds():
+    metrics = core.parse_curl_timings(["0.010", "0.030", "0.080", "0.200", "0.500", "2048", "0"])
+    assert metrics == {"dns_ms": 10.0, "connect_ms": 20.0, "tls_ms": 50.0, "ttfb_ms": 200.0,
+                       "transfer_ms": 300.0, "total_ms": 500.0, "bytes": 2048, "reused": True}
+
+
+def test_parse_curl_timings_plain_http_and_bad_fields():
+    metrics = core.parse_curl_timings(["0", "0.001", "0", "0.002", "0.003", "10", "1"])
+    assert metrics["tls_ms"] is None
+    assert metrics["reused"] is False
+    assert core.parse_curl_timings(["0.1", "oops"]) == {}
+
+
+def test_curl_config_quote_escapes_backslashes_and_quotes():
+    assert core._curl_config_quote('C:\\out\\"a".png') == '"C:\\\\out\\\\\\"a\\".png"'
+
+
+def test_build_curl_batch_config_separates_transfers(tmp_path):
+    first = core.TempDownload(str(tmp_path / "a.png"))
+    second = core.TempDownload(str(tmp_path / "b.png"))
+    items = [("https://cdn.example/a.png", first, str(tmp_path / "a.hdr")),
+             ("https://cdn.example/b.png", second, str(tmp_path / "b.hdr"))]
+    blocks = core._build_curl_batch_config(items, rate=4096).split("\nnext\n")
+    assert len(blocks) == 2
+    assert 'url = "https://cdn.example/a.png"' in blocks[0]
+    assert f'output = "{first.temp_file}"' in blocks[0]
+    assert "MJDL 1 %{http_code}" in blocks[1]
+    assert all("limit-rate = 4096" in block for block in blocks)
+    assert "Range" not in blocks[0]
+
+
+def test_read_curl_headers_returns_last_response(tmp_path):
+    header_file = tmp_path / "a.hdr"
+    header_file.write_bytes(b"HTTP/1.1 302 Found\r\nLocation: /b\r\n\r\n"
+                            b"HTTP/1.1 429 Too Many Requests\r\nRetry-After: 7\r\n\r\n")
+    headers = core.read_curl_headers(str(header_file))
+    assert headers.get("Retry-After") == "7"
+    assert headers.get("Location") is None
+    assert not header_file.exists()
+
+
+def test_curl_batch_transfers_are_capped_by_threads(tmp_path, monkeypatch):
+    lock = threading.Lock()
+    in_flight = peak = 0
+    batches = []
+
+    def fake_batch(items):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += len(items)
+            peak = max(peak, in_flight)
+            batches.append(len(items))
+        time.sleep(0.02)
+        for _, save_path in items:
+            with open(save_path, "wb") as f:
+                f.write(PNG_BYTES)
+        with lock:
+            in_flight -= len(items)
+        return [{"ok": True, "status": 200, "error": None, "retry_after": None, "metrics": {}} for _ in items]
+
+    monkeypatch.setattr(core, "_curl_parallel_supported", True)
+    monkeypatch.setattr(core, "download_images_with_curl_batch", fake_batch)
+    core.CURL_BATCH_SIZE = 32
+    tasks = [make_task(f"t{i}_0", output_dir=tmp_path, method="curl") for i in range(20)]
+    assert core.run_download_tasks(tasks, num_threads=3, method="curl") == (20, 20)
+    assert peak == 3
+    assert max(batches) == 3
+
+
+def test_curl_batch_parallel_max_follows_batch_size(tmp_path, image_server, monkeypatch):
+    commands = []
+    run_curl = core.run_curl
+
+    def recording_run_curl(cmd, **kwargs):
+        commands.append(cmd)
+        return run_curl(cmd, **kwargs)
+
+    monkeypatch.setattr(core, "run_curl", recording_run_curl)
+    items = []
+    for i in range(3):
+        image_server.files[f"/p{i}.png"] = PNG_BYTES
+        items.append((image_server.url(f"/p{i}.png"), str(tmp_path / f"p{i}.png")))
+    results = core.download_images_with_curl_batch(items)
+    assert [result["ok"] for result in results] == [True, True, True]
+    assert commands[0][commands[0].index("--parallel-max") + 1] == "3"
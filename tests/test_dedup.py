@@ -0,0 +1,50 @@
+import os
+
+from conftest import make_task, PNG_BYTES
+from mj_csv_dl import core
+
+
+def test_normalize_image_url_ignores_case_query_and_fragment():
+    assert (core.normalize_image_url(" HTTPS://CDN.Midjourney.com/Abc/0_0.png?x=1#top ")
+            == "https://cdn.midjourney.com/Abc/0_0.png")
+
+
+def test_dedup_tasks_keeps_first_occurrence():
+    tasks = [make_task("a_0", "https://cdn.example/a/0_0.png"),
+             make_task("a_0", "https://CDN.example/a/0_0.png?v=2"),
+             make_task("b_0", "https://cdn.example/a/0_0.png")]
+    assert [task[3] for task in core.dedup_tasks(tasks)] == ["a_0", "b_0"]
+    assert core._duplicate_count == 1
+    # 同一次运行中后面的CSV再次出现时同样跳过
+    assert list(core.dedup_tasks(tasks[:1])) == []
+    core.reset_task_dedup()
+    assert len(list(core.dedup_tasks(tasks[:1]))) == 1
+
+
+def test_dedup_window_evicts_least_recently_seen():
+    core.DEDUP_WINDOW = 2
+    a, b, c = (make_task(f"{name}_0", f"https://cdn.example/{name}/0_0.png") for name in "abc")
+    assert len(list(core.dedup_tasks([a, b]))) == 2
+    # 再次出现的 a 变为最近使用，加入 c 后被淘汰的是 b
+    assert list(core.dedup_tasks([a, c])) == [c]
+    assert len(core._seen_tasks) == 2
+    assert list(core.dedup_tasks([a])) == []
+    assert list(core.dedup_tasks([b])) == [b]
+
+
+def test_content_store_links_duplicate_urls(tmp_path):
+    core.configure_content_store(True)
+    first = make_task("a_0", output_dir=tmp_path)
+    with open(first[1], "wb") as f:
+        f.write(PNG_BYTES)
+    result = core.finish_task(first, True)
+    sha256 = core.get_manifest(str(tmp_path)).get("a_0", first[0])["sha256"]
+    blob_path = core.get_blob_path(str(tmp_path), sha256, ".png")
+    assert result["success"] and os.path.exists(blob_path)
+
+    second = make_task("b_0", url=first[0], output_dir=tmp_path)
+    linked = core.check_existing_task(second)
+    assert linked["skipped"] and linked["success"]
+    with open(second[1], "rb") as f:
+        assert f.read() == PNG_BYTES
+    assert os.path.exists(os.path.join(str(tmp_path), "b_0.txt"))
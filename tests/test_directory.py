@@ -0,0 +1,39 @@
+from conftest import PNG_BYTES
+from mj_csv_dl import core
+
+
+def write_csv(path, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("Prompt,任务ID,图片链接\n" + "".join(f"p,{task_id},{url}\n" for task_id, url in rows),
+                    encoding="utf-8")
+
+
+def test_find_csv_files(tmp_path):
+    for name in ("b.csv", "a.CSV", "notes.txt", "sub/c.csv"):
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("", encoding="utf-8")
+    assert core.find_csv_files(str(tmp_path)) == [str(tmp_path / "a.CSV"), str(tmp_path / "b.csv")]
+    assert core.find_csv_files(str(tmp_path), recursive=True)[-1] == str(tmp_path / "sub" / "c.csv")
+
+
+def test_count_csv_tasks(tmp_path):
+    write_csv(tmp_path / "a.csv", [("a", "https://cdn.example/a/0_0.png"), ("b", "")])
+    (tmp_path / "bad.csv").write_text("Prompt\np\n", encoding="utf-8")
+    paths = [str(tmp_path / "a.csv"), str(tmp_path / "bad.csv"), str(tmp_path / "missing.csv")]
+    assert core.count_csv_tasks(paths) == 1
+    assert core.count_csv_tasks(paths, extended_mode=True) == 4
+
+
+def test_directory_is_downloaded_as_one_queue(tmp_path, image_server, capsys):
+    image_server.files["/a/0_0.png"] = PNG_BYTES
+    image_server.files["/b/0_0.png"] = PNG_BYTES
+    write_csv(tmp_path / "in" / "top.csv", [("a", image_server.url("/a/0_0.png"))])
+    write_csv(tmp_path / "in" / "likes.csv", [("a", image_server.url("/a/0_0.png")),
+                                              ("b", image_server.url("/b/0_0.png"))])
+    core.process_input(str(tmp_path / "in"), str(tmp_path / "out"), num_threads=2, method="urllib")
+    out = capsys.readouterr().out
+    assert "找到 2 个CSV文件" in out
+    assert "跳过重复任务 1 个" in out
+    assert sorted(path.name for path in (tmp_path / "out").glob("*_0.*")) == ["a_0.png", "a_0.txt", "b_0.png",
+                                                                            "b_0.txt"]
+    assert len(image_server.requests) == 2
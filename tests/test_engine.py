@@ -0,0 +1,40 @@
+import io
+
+import pytest
+
+from conftest import PNG_BYTES
+from mj_csv_dl import Downloader, core
+
+
+def test_second_open_downloader_is_refused(tmp_path):
+    first = Downloader(str(tmp_path), method="urllib", quiet=True)
+    with pytest.raises(RuntimeError):
+        Downloader(str(tmp_path), method="urllib", prefer_format="webp")
+    assert core.PREFERRED_FORMAT == "png"
+    first.close()
+    with Downloader(str(tmp_path), method="urllib", quiet=True):
+        pass
+
+
+def test_failed_init_releases_guard(tmp_path):
+    with pytest.raises(ValueError):
+        Downloader(str(tmp_path), method="carrier-pigeon")
+    with pytest.raises(TypeError):
+        Downloader(str(tmp_path), method="urllib", no_such_option=1)
+    Downloader(str(tmp_path), method="urllib", quiet=True).close()
+
+
+def test_downloader_runs_several_batches(tmp_path, image_server):
+    for name in ("a", "b"):
+        image_server.files[f"/{name}/0_0.png"] = PNG_BYTES
+    records = [{"Prompt": "p", "任务ID": "a", "图片链接": image_server.url("/a/0_0.png")}]
+    stream = io.StringIO(f"Prompt,任务ID,图片链接\np,b,{image_server.url('/b/0_0.png')}\n")
+    with Downloader(str(tmp_path), method="urllib", threads=2, quiet=True) as downloader:
+        assert downloader.download_records(records) == (1, 1)
+        results = list(downloader.iter_results(downloader.tasks_from_csv(stream)))
+        assert [(result["task_id"], result["success"]) for result in results] == [("b_0", True)]
+        # 已完成的任务由下载清单跳过
+        assert downloader.download_records(records) == (1, 1)
+    assert len([request for request in image_server.requests if request[0] == "GET"]) == 2
+    with pytest.raises(RuntimeError):
+        downloader.run([])
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from conftest import make_task, PNG_BYTES
+from mj_csv_dl import core
+
+WEBP_BYTES = b"RIFF\x24\x00\x00\x00WEBPVP8L" + b"\x00" * 24
+
+
+@pytest.mark.parametrize("head, name", [
+    (PNG_BYTES[:16], "png"),
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF", "jpeg"),
+    (b"GIF89a\x01\x00", "gif"),
+    (WEBP_BYTES[:16], "webp"),
+    (b"\x00\x00\x00\x1cftypavif", "avif"),
+    (b"<!DOCTYPE html>", None),
+])
+def test_detect_image_format(head, name):
+    assert core.detect_image_format(head) == name
+
+
+def test_get_format_url_only_rewrites_image_extensions():
+    assert core.get_format_url("https://cdn.example/a/0_0.png?x=1", "webp") == "https://cdn.example/a/0_0.webp?x=1"
+    assert core.get_format_url("https://cdn.example/a/grid", "webp") == "https://cdn.example/a/grid"
+
+
+def test_candidate_urls_fall_back_to_png():
+    assert core.get_candidate_urls("https://cdn.example/a/0_0.png") == ["https://cdn.example/a/0_0.png"]
+    core.configure_image_format("webp")
+    assert core.get_candidate_urls("https://cdn.example/a/0_0.png") == ["https://cdn.example/a/0_0.webp",
+                                                                         "https://cdn.example/a/0_0.png"]
+    assert core.get_image_save_path("out", "a_0") == os.path.join("out", "a_0.webp")
+    core.configure_image_format("bmp")
+    assert core.PREFERRED_FORMAT == "png"
+
+
+def test_apply_detected_extension_renames_by_content(tmp_path):
+    path = tmp_path / "a_0.webp"
+    path.write_bytes(PNG_BYTES)
+    assert core.apply_detected_extension(str(path)) == str(tmp_path / "a_0.png")
+    assert (tmp_path / "a_0.png").exists() and not path.exists()
+
+
+def test_find_existing_image_with_other_extension(tmp_path):
+    core.configure_image_format("webp")
+    (tmp_path / "a_0.png").write_bytes(PNG_BYTES)
+    assert core.find_existing_image(str(tmp_path / "a_0.webp")) == str(tmp_path / "a_0.png")
+    assert core.find_existing_image(str(tmp_path / "b_0.webp")) is None
+
+
+@pytest.mark.parametrize("ext", [".webp", ".jpg"])
+def test_default_rerun_finds_images_from_webp_run(tmp_path, ext):
+    core.configure_manifest(False)
+    # 之前的 --prefer-format webp 运行按实际内容保存为 .webp 或 .jpg，默认设置重新运行时不应再下载
+    (tmp_path / f"a_0{ext}").write_bytes(PNG_BYTES)
+    task = make_task("a_0", output_dir=tmp_path)
+    assert task[1].endswith(".png")
+    result = core.check_existing_task(task)
+    assert result["success"] and result["skipped"]
+    assert result["image_path"] == str(tmp_path / f"a_0{ext}")
+
+
+def test_preferred_format_falls_back_to_png_when_missing(tmp_path, image_server):
+    core.configure_image_format("webp")
+    image_server.files["/a/0_0.png"] = PNG_BYTES
+    task = make_task("a_0", image_server.url("/a/0_0.png"), tmp_path, method="urllib", ext=".webp")
+    results = []
+    assert core.run_download_tasks([task], num_threads=1, method="urllib", on_result=results.append) == (1, 1)
+    assert [request[1] for request in image_server.requests] == ["/a/0_0.webp", "/a/0_0.png"]
+    # 退回的png按实际内容保存，清单中记录的也是实际的路径
+    assert results[0]["image_path"] == str(tmp_path / "a_0.png")
+    assert core.get_manifest(str(tmp_path)).find_stored_by_url(task[0])[1] == str(tmp_path / "a_0.png")
+
+
+def test_content_store_reuses_blob_with_stored_extension(tmp_path):
+    core.configure_image_format("webp")
+    core.configure_content_store(True)
+    first = make_task("a_0", output_dir=tmp_path, ext=".webp")
+    with open(first[1], "wb") as f:
+        f.write(PNG_BYTES)
+    assert core.finish_task(first, True)["image_path"] == str(tmp_path / "a_0.png")
+
+    second = make_task("b_0", url=first[0], output_dir=tmp_path, ext=".webp")
+    linked = core.check_existing_task(second)
+    assert linked["image_path"] == str(tmp_path / "b_0.png")
+    assert (tmp_path / "b_0.png").read_bytes() == PNG_BYTES
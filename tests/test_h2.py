@@ -0,0 +1,33 @@
+import pytest
+
+from conftest import make_task
+from mj_csv_dl import core
+
+pytest.importorskip("h2")
+pytest.importorskip("httpx")
+
+
+@pytest.fixture
+def h2_server(benchmark_module):
+    config = benchmark_module.MockCDNConfig(latency_ms=0, jitter_ms=0, min_size=2000, max_size=4000, variants=1)
+    server = benchmark_module.start_mock_cdn(config, http2=True)
+    yield server
+    server.shutdown()
+    core.configure_h2()
+
+
+def test_h2_is_a_download_method():
+    assert "h2" in core.DOWNLOAD_METHODS
+    assert len(core.DOWNLOAD_METHODS) == 6
+
+
+def test_h2_downloads_share_one_connection(tmp_path, h2_server):
+    tasks = [make_task(f"t{i}_{v}", f"{h2_server.base_url}/t{i}/0_{v}.png", tmp_path, extended=True, method="h2")
+             for i in range(4) for v in range(2)]
+    results = []
+    connections = core._h2_stats["connections"]
+    assert core.run_download_tasks(tasks, num_threads=4, method="h2", on_result=results.append) == (4, 8)
+    downloaded = [result for result in results if result["success"]]
+    assert all(result["metrics"]["http_version"] == "HTTP/2" for result in downloaded)
+    assert {result["status"] for result in results if not result["success"]} == {404}
+    assert core._h2_stats["connections"] - connections == 1
@@ -0,0 +1,131 @@
+import argparse
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+from mj_csv_dl import core
+
+RECORD = {"Prompt": "a cat", "任务id": "abc", "图片链接": "https://cdn.midjourney.com/abc/0_0.png", "用户ID": None}
+
+
+def test_parse_ingest_address():
+    assert core.parse_ingest_address("8765") == ("127.0.0.1", 8765)
+    assert core.parse_ingest_address("0.0.0.0:8765") == ("0.0.0.0", 8765)
+    with pytest.raises(argparse.ArgumentTypeError):
+        core.parse_ingest_address("localhost:http")
+
+
+def test_parse_content_length():
+    assert core.parse_content_length(None) is None
+    assert core.parse_content_length(" 42 ") == 42
+    for value in ("-1", "abc", "", "١٢"):
+        assert core.parse_content_length(value) == -1
+
+
+def test_normalize_ingest_records_json_and_csv():
+    rows = core.normalize_ingest_records(json.dumps({"records": [RECORD]}).encode("utf-8"), "application/json")
+    assert rows == [{"Prompt": "a cat", "任务ID": "abc", "图片链接": RECORD["图片链接"], "用户ID": ""}]
+    body = "\ufeffPrompt,任务ID,图片链接\n\"a cat\",abc,https://cdn.midjourney.com/abc/0_0.png\n".encode("utf-8")
+    assert core.normalize_ingest_records(body, "text/csv")[0]["任务ID"] == "abc"
+    assert core.normalize_ingest_records(b"", "application/json") == []
+
+
+@pytest.mark.parametrize("body", [b'{"records": 1}', b'["x"]', b'[{"Prompt": "a"}]'])
+def test_normalize_ingest_records_rejects_bad_bodies(body):
+    with pytest.raises(ValueError):
+        core.normalize_ingest_records(body, "application/json")
+
+
+@pytest.fixture
+def ingest_server(tmp_path):
+    server = core.IngestServer("127.0.0.1", 0, str(tmp_path), token="secret")
+    server.start()
+    yield server
+    server.close()
+
+
+def request(server, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", server.httpd.server_port, timeout=5)
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response
+
+
+def test_ingest_server_checks_origin_and_token(ingest_server):
+    body = json.dumps([RECORD]).encode("utf-8")
+    token = {"X-MJ-Token": "secret", "Content-Type": "application/json"}
+    assert request(ingest_server, "OPTIONS", "/records", headers={"Origin": "https://evil.example"}).status == 403
+    preflight = request(ingest_server, "OPTIONS", "/records", headers={"Origin": "https://www.midjourney.com"})
+    assert preflight.status == 204
+    assert preflight.getheader("Access-Control-Allow-Origin") == "https://www.midjourney.com"
+    assert request(ingest_server, "POST", "/records", body, {"Origin": "https://evil.example", **token}).status == 403
+    assert request(ingest_server, "POST", "/records", body, {"X-MJ-Token": "wrong"}).status == 401
+    assert request(ingest_server, "GET", "/status").status == 401
+    accepted = request(ingest_server, "POST", "/records", body, {"Origin": "https://www.midjourney.com", **token})
+    assert accepted.status == 200
+    assert ingest_server.drain(timeout=1)[0]["任务ID"] == "abc"
+    assert ingest_server.received == 1
+
+
+def test_ingest_server_validates_content_length(ingest_server):
+    token = {"X-MJ-Token": "secret"}
+    conn = http.client.HTTPConnection("127.0.0.1", ingest_server.httpd.server_port, timeout=5)
+    conn.putrequest("POST", "/records")
+    conn.putheader("X-MJ-Token", "secret")
+    conn.endheaders()
+    assert conn.getresponse().status == 411
+    conn.close()
+    assert request(ingest_server, "POST", "/records", b"[]", {"Content-Length": "abc", **token}).status == 400
+    core.INGEST_MAX_BODY = 10
+    assert request(ingest_server, "POST", "/records", b"[" + b" " * 20 + b"]", token).status == 413
+    assert request(ingest_server, "POST", "/records", b"[{}]", token).status == 400
+    assert ingest_server.received == 0
+
+
+def test_ingest_server_archives_records_as_csv(tmp_path, ingest_server):
+    ingest_server.accept(core.normalize_ingest_records(json.dumps([RECORD]).encode("utf-8"), "application/json"))
+    csv_files = [path for path in tmp_path.iterdir() if path.name.startswith("ingest-")]
+    assert len(csv_files) == 1
+    lines = csv_files[0].read_text(encoding="utf-8-sig").splitlines()
+    assert lines[0].startswith('"Prompt","Prompt 参数","任务ID"')
+    assert '"abc"' in lines[1]
+
+
+def test_ingest_record_starts_while_earlier_download_runs(ingest_server, monkeypatch):
+    fast_started = threading.Event()
+    slow_started = threading.Event()
+    events = []
+
+    def fake_attempt(task, attempt):
+        if "slow" in task[0]:
+            slow_started.set()
+            fast_started.wait(5)
+            events.append("slow finished")
+        else:
+            events.append("fast started")
+            fast_started.set()
+        return {"result": {"success": True, "task_id": task[3], "image_url": task[0]}}
+
+    monkeypatch.setattr(core, "download_attempt", fake_attempt)
+    results = []
+    runner = threading.Thread(target=lambda: results.append(
+        core.run_download_tasks(ingest_server.iter_tasks(method="requests"), 2, "requests")))
+    runner.start()
+    headers = {"X-MJ-Token": "secret", "Content-Type": "application/json"}
+    slow = dict(RECORD, 任务id="slow", 图片链接="https://cdn.midjourney.com/slow/0_0.png")
+    fast = dict(RECORD, 任务id="fast", 图片链接="https://cdn.midjourney.com/fast/0_0.png")
+    assert request(ingest_server, "POST", "/records", json.dumps([slow]).encode("utf-8"), headers).status == 200
+    assert slow_started.wait(5)
+    assert request(ingest_server, "POST", "/records", json.dumps([fast]).encode("utf-8"), headers).status == 200
+    deadline = time.monotonic() + 5
+    while len(events) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    ingest_server.close()
+    runner.join(5)
+    assert events == ["fast started", "slow finished"]
+    assert results == [(2, 2)]
@@ -0,0 +1,90 @@
+import argparse
+import time
+
+import pytest
+
+from conftest import make_task
+from mj_csv_dl import core
+
+
+def test_parse_partition():
+    assert core.parse_partition("1/4") == (1, 4)
+    assert core.parse_partition(" 0 / 1 ") == (0, 1)
+    for value in ("4/4", "1/0", "a/b", "1"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            core.parse_partition(value)
+
+
+def test_partitions_split_tasks_disjointly():
+    task_ids = [f"task{i}" for i in range(200)]
+    owners = []
+    for index in range(3):
+        core.configure_distribution(partition=f"{index}/3")
+        owners.append({task_id for task_id in task_ids if core.in_partition(task_id)})
+    assert set().union(*owners) == set(task_ids)
+    assert sum(len(owned) for owned in owners) == len(task_ids)
+    assert all(owned for owned in owners)
+    # 多个进程共用下载清单时每次写入立即提交，取消分片后恢复
+    assert core.MANIFEST_COMMIT_INTERVAL == 0.0
+    core.configure_distribution()
+    assert core.MANIFEST_COMMIT_INTERVAL == 1.0
+
+
+def test_lease_queue_claims_each_task_once(tmp_path):
+    path = str(tmp_path / "queue.sqlite3")
+    first = core.LeaseQueue(path, "w1", lease_seconds=60)
+    second = core.LeaseQueue(path, "w2", lease_seconds=60)
+    tasks = [make_task(f"t{i}_0", f"https://cdn.example/t{i}/0_0.png") for i in range(5)]
+    first.enqueue(tasks)
+    second.enqueue(tasks)
+    claimed = first.claim(3, "out", "requests") + second.claim(10, "out", "requests")
+    assert sorted(task[3] for task in claimed) == [task[3] for task in tasks]
+    assert claimed[0] == tasks[0]
+    assert first.claim(10, "out", "requests") == []
+    assert second.next_expiry() > 50
+    for task in claimed[:3]:
+        first.complete(task[3], task[0], True)
+    assert second.next_expiry() is None
+    first.close()
+    second.close()
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    path = str(tmp_path / "queue.sqlite3")
+    crashed = core.LeaseQueue(path, "w1", lease_seconds=0.05)
+    task = make_task()
+    crashed.enqueue([task])
+    assert crashed.claim(1, "out", "requests") == [task]
+    # 模拟进程崩溃：停止心跳后租约过期
+    crashed.close()
+    time.sleep(0.1)
+    survivor = core.LeaseQueue(path, "w2", lease_seconds=60)
+    assert survivor.claim(1, "out", "requests") == [task]
+    survivor.complete(task[3], task[0], False, 404)
+    assert survivor.claim(1, "out", "requests") == []
+    survivor.close()
+
+
+def test_lease_queue_rebuilds_paths_for_the_claiming_worker(tmp_path):
+    queue = core.LeaseQueue(str(tmp_path / "queue.sqlite3"), "w1", lease_seconds=60)
+    task = make_task(output_dir="/elsewhere", method="curl", metadata={"用户ID": "u1"})
+    queue.enqueue([task])
+    stored = queue.conn.execute("SELECT metadata FROM tasks").fetchone()[0]
+    assert "elsewhere" not in stored
+    assert queue.claim(1, "mine", "requests") == [make_task(output_dir="mine", metadata={"用户ID": "u1"})]
+    queue.close()
+
+
+def test_lease_queue_requeues_retryable_failures_up_to_max_attempts(tmp_path):
+    queue = core.LeaseQueue(str(tmp_path / "queue.sqlite3"), "w1", lease_seconds=60, max_attempts=2)
+    task, missing = make_task("a_0"), make_task("b_0", "https://cdn.midjourney.com/b/0_0.png")
+    queue.enqueue([task, missing])
+    assert queue.claim(2, "out", "requests") == [task, missing]
+    assert queue.complete(missing[3], missing[0], False, 404) is False
+    assert queue.complete(task[3], task[0], False, 503) is True
+    assert queue.next_expiry() == 0.0
+    assert queue.claim(2, "out", "requests") == [task]
+    assert queue.complete(task[3], task[0], False, 503) is False
+    assert queue.claim(2, "out", "requests") == []
+    assert queue.next_expiry() is None
+    queue.close()
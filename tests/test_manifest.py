@@ -0,0 +1,104 @@
+import os
+
+from conftest import make_task, PNG_BYTES
+from mj_csv_dl import core
+
+
+def test_manifest_records_status_transitions(tmp_path):
+    manifest = core.DownloadManifest(str(tmp_path))
+    manifest.mark_pending("t_0", "https://cdn.example/t/0_0.png", "t_0.png")
+    manifest.mark_pending("t_0", "https://cdn.example/t/0_0.png", "t_0.png")
+    record = manifest.get("t_0", "https://cdn.example/t/0_0.png")
+    assert (record["status"], record["attempts"]) == ("pending", 2)
+    manifest.mark_failed("t_0", "https://cdn.example/t/0_0.png", "t_0.png", "HTTP 500")
+    assert manifest.get("t_0", "https://cdn.example/t/0_0.png")["last_error"] == "HTTP 500"
+    manifest.mark_done("t_0", "https://cdn.example/t/0_0.png", "t_0.png", 10, "ff")
+    record = manifest.get("t_0", "https://cdn.example/t/0_0.png")
+    assert (record["status"], record["size"], record["sha256"], record["last_error"]) == ("done", 10, "ff", None)
+    assert manifest.get("t_0", "https://cdn.example/t/0_1.png") is None
+    manifest.close()
+
+
+def test_manifest_persists_across_reopen(tmp_path):
+    manifest = core.DownloadManifest(str(tmp_path))
+    manifest.mark_done("t_0", "u", "t_0.png", 1, "aa")
+    manifest.close()
+    reopened = core.DownloadManifest(str(tmp_path))
+    assert reopened.get("t_0", "u")["status"] == "done"
+    reopened.close()
+
+
+def test_manifest_commit_interval_is_per_instance(tmp_path):
+    shared_dir = tmp_path / "shared"
+    shared_dir.mkdir()
+    core.configure_processes(2)
+    shared = core.get_manifest(str(shared_dir))
+    private = core.DownloadManifest(str(tmp_path), commit_interval=3600)
+    assert shared.commit_interval == 0.0
+    assert private.commit_interval == 3600
+    # 立即提交的清单对其它连接立即可见，按间隔提交的清单在间隔内不可见
+    shared.mark_pending("t_0", "u", "t_0.png")
+    private.mark_pending("t_0", "u", "t_0.png")
+    readers = [core.DownloadManifest(str(shared_dir)), core.DownloadManifest(str(tmp_path))]
+    assert [reader.get("t_0", "u") and reader.get("t_0", "u")["status"] for reader in readers] == ["pending", None]
+    for manifest in readers + [private]:
+        manifest.close()
+
+
+def test_check_existing_task_skips_done_without_touching_files(tmp_path):
+    task = make_task(output_dir=tmp_path)
+    core.get_manifest(str(tmp_path)).mark_done(task[3], task[0], task[1], 10, "aa")
+    result = core.check_existing_task(task)
+    assert result["success"] and result["skipped"]
+    assert not os.path.exists(task[1])
+
+
+def test_check_existing_task_retries_pending_and_failed(tmp_path):
+    task = make_task(output_dir=tmp_path)
+    # 被中断的下载可能留下不完整的文件，清单中为pending时仍需重新下载
+    with open(task[1], "wb") as f:
+        f.write(PNG_BYTES[:10])
+    manifest = core.get_manifest(str(tmp_path))
+    manifest.mark_pending(task[3], task[0], task[1])
+    assert core.check_existing_task(task) is None
+    manifest.mark_failed(task[3], task[0], task[1], "HTTP 500")
+    assert core.check_existing_task(task) is None
+
+
+def test_check_existing_task_adopts_files_without_record(tmp_path):
+    task = make_task(output_dir=tmp_path)
+    with open(task[1], "wb") as f:
+        f.write(PNG_BYTES)
+    result = core.check_existing_task(task)
+    assert result["skipped"] and result["success"]
+    with open(os.path.splitext(task[1])[0] + ".txt", encoding="utf-8") as f:
+        assert f.read() == task[4]
+    assert core.get_manifest(str(tmp_path)).get(task[3], task[0])["status"] == "done"
+
+
+def test_check_existing_task_without_manifest(tmp_path):
+    core.configure_manifest(False)
+    task = make_task(output_dir=tmp_path)
+    assert core.get_manifest(str(tmp_path)) is None
+    assert core.check_existing_task(task) is None
+
+
+def test_finish_task_failure_removes_prompt_and_marks_failed(tmp_path):
+    task = make_task(output_dir=tmp_path)
+    txt_path = os.path.splitext(task[1])[0] + ".txt"
+    with open(txt_path, "w", encoding="utf-8") as f:
+        f.write("stale")
+    result = core.finish_task(task, False, "HTTP 500")
+    assert (result["success"], result["error"]) == (False, "HTTP 500")
+    assert not os.path.exists(txt_path)
+    assert core.get_manifest(str(tmp_path)).get(task[3], task[0])["status"] == "failed"
+
+
+def test_finish_task_success_uses_streamed_hash(tmp_path):
+    task = make_task(output_dir=tmp_path)
+    with open(task[1], "wb") as f:
+        f.write(PNG_BYTES)
+    result = core.finish_task(task, True, sha256="streamed")
+    assert result["success"]
+    record = core.get_manifest(str(tmp_path)).get(task[3], task[0])
+    assert (record["status"], record["size"], record["sha256"]) == ("done", len(PNG_BYTES), "streamed")
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from conftest import PNG_BYTES
+from mj_csv_dl import core
+
+
+def make_result(task_id, success=True, **extra):
+    result = {"task_id": task_id, "image_url": f"https://cdn.example/{task_id}/0_0.png", "method": "requests",
+              "success": success}
+    result.update(extra)
+    return result
+
+
+def test_run_metrics_summary(tmp_path):
+    log_path = tmp_path / "metrics.jsonl"
+    metrics = core.RunMetrics(str(log_path))
+    metrics.record(make_result("a", attempts=1, metrics={"total_ms": 80.0, "ttfb_ms": 30.0, "bytes": 1024}))
+    metrics.record(make_result("b", attempts=2, metrics={"total_ms": 400.0, "ttfb_ms": 50.0, "bytes": 2048}))
+    metrics.record(make_result("c", success=False, attempts=3, error="HTTP 500 https://cdn.example/c/0_0.png",
+                               metrics={"total_ms": 20000.0}))
+    metrics.record(make_result("d", skipped=True))
+    summary = metrics.summary()
+    assert (summary["tasks"], summary["successful"], summary["failed"]) == (4, 3, 1)
+    assert (summary["skipped"], summary["retried"], summary["bytes"]) == (1, 2, 3072)
+    assert summary["mean_ms"]["ttfb_ms"] == 40.0
+    assert summary["latency_histogram"]["<=100ms"] == 1
+    assert summary["latency_histogram"][">10000ms"] == 1
+    assert summary["top_failures"] == [{"error": "HTTP 500 <url>", "count": 1}]
+    report_path = tmp_path / "report.json"
+    metrics.close(str(report_path))
+    lines = log_path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["task_id"] for line in lines] == ["a", "b", "c", "d"]
+    assert json.loads(report_path.read_text(encoding="utf-8"))["tasks"] == 4
+
+
+def test_request_metrics_are_per_context():
+    metrics = core.begin_request_metrics()
+    core.record_request_metrics(ttfb_ms=12.5, status=None)
+    assert metrics == {"ttfb_ms": 12.5}
+
+
+@pytest.mark.parametrize("method", ["requests", "urllib"])
+def test_new_connections_record_dns_and_connect_time(method, image_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(core, "_http_session", None)
+    monkeypatch.setattr(core, "_warmed_hosts", set())
+    image_server.files["/a/0_0.png"] = PNG_BYTES
+    image_server.files["/b/0_0.png"] = PNG_BYTES
+    # localhost 可能先解析为 ::1，服务器只监听 127.0.0.1 时依次尝试下一个地址
+    url = image_server.url("/a/0_0.png").replace("127.0.0.1", "localhost")
+    download = core.download_image_with_requests if method == "requests" else core.download_image_with_urllib
+    first = core.begin_request_metrics()
+    assert download(url, str(tmp_path / "a_0.png"))
+    second = core.begin_request_metrics()
+    assert download(url.replace("/a/", "/b/"), str(tmp_path / "b_0.png"))
+    if core._http_session is not None:
+        core._http_session.close()
+    assert first["dns_ms"] >= 0 and first["connect_ms"] >= 0
+    assert "tls_ms" not in first
+    # 复用的连接不再记录建连耗时
+    assert "dns_ms" not in second and "connect_ms" not in second
@@ -0,0 +1,42 @@
+import shutil
+
+import pytest
+
+from conftest import make_task, PNG_BYTES
+from mj_csv_dl import core
+
+
+def test_missing_url_is_skipped_on_next_run(tmp_path):
+    task = make_task(extended=True, output_dir=tmp_path)
+    core.record_missing_url(task, 404)
+    result = core.check_existing_task(task)
+    assert (result["success"], result["skipped"], result["status"]) == (False, True, 404)
+    core.configure_missing_cache(0)
+    assert core.check_existing_task(task) is None
+
+
+def test_probe_skips_missing_variants(tmp_path, image_server):
+    image_server.files["/abc/0_0.png"] = PNG_BYTES
+    core.configure_missing_cache(7, probe=True)
+    present = make_task("abc_0", image_server.url("/abc/0_0.png"), tmp_path, extended=True, method="urllib")
+    missing = make_task("abc_1", image_server.url("/abc/0_1.png"), tmp_path, extended=True, method="urllib")
+    outcome = core.download_attempt(missing)
+    assert outcome["result"]["status"] == 404 and outcome["result"]["attempts"] == 0
+    assert [request[0] for request in image_server.requests] == ["HEAD"]
+    assert core.download_attempt(present)["result"]["success"]
+    assert core.find_missing_url(core.get_manifest(str(tmp_path)), missing[0]) == 404
+
+
+@pytest.mark.skipif(not shutil.which("curl"), reason="需要curl")
+def test_curl_probe_checks_urls_in_one_process(image_server):
+    image_server.files["/abc/0_0.png"] = PNG_BYTES
+    statuses = core.probe_image_urls_with_curl([image_server.url("/abc/0_0.png"), image_server.url("/abc/0_1.png")])
+    assert statuses == [200, 404]
+
+
+def test_missing_image_is_not_retried(tmp_path, image_server):
+    task = make_task("abc_3", image_server.url("/abc/0_3.png"), tmp_path, extended=True, method="urllib")
+    results = []
+    assert core.run_download_tasks([task], num_threads=1, method="urllib", on_result=results.append) == (0, 1)
+    assert results[0]["status"] == 404 and results[0]["attempts"] == 1
+    assert len(image_server.requests) == 1
@@ -0,0 +1,69 @@
+import concurrent.futures
+import io
+import os
+
+import pytest
+
+from conftest import make_task
+from mj_csv_dl import core
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def png_bytes(size=(64, 32), color="red"):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def options(**values):
+    return dict(core._postprocess_options(), **values)
+
+
+def test_describe_decode_error_drops_object_reprs():
+    exc = Image.UnidentifiedImageError("cannot identify image file <_io.BytesIO object at 0x7f3a2b1c>")
+    assert core.describe_decode_error(exc) == "图片解码失败: UnidentifiedImageError (cannot identify image file)"
+    assert core.describe_decode_error(OSError()) == "图片解码失败: OSError"
+
+
+def test_process_image_bytes_rejects_truncated_image(tmp_path):
+    data = png_bytes()
+    outcome = core.process_image_bytes(data[:len(data) // 2], str(tmp_path / "a_0.png"), options())
+    assert not outcome["ok"] and outcome["error"].startswith("图片解码失败")
+
+
+def test_process_image_bytes_writes_derived_images(tmp_path):
+    data = png_bytes()
+    for index in range(4):
+        outcome = core.process_image_bytes(data, str(tmp_path / f"a_{index}.png"),
+                                           options(resize=16, thumbnail=8, format="webp", quality=80))
+    assert outcome["ok"] and outcome["sha256"] == core.hashlib.sha256(data).hexdigest()
+    # 第4张缩略图生成后同时拼出2x2总览图
+    assert outcome["derived"] == 3
+    with Image.open(tmp_path / "derived" / "a_3.webp") as derived:
+        assert derived.size == (16, 8)
+    with Image.open(tmp_path / "thumbnails" / "a_grid.webp") as grid:
+        assert grid.size == (16, 16)
+
+
+def test_corrupt_image_is_deleted_and_rescheduled(tmp_path):
+    task = make_task(output_dir=tmp_path)
+    corrupt = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+    with open(task[1], "wb") as f:
+        f.write(corrupt)
+    future = concurrent.futures.Future()
+    future.set_result(core.process_image_bytes(corrupt, task[1], options()))
+    outcome = core.finish_postprocess(task, 0, {"postprocess": future, "latency": 0.1, "metrics": {}})
+    assert "retry" in outcome and outcome["status"] is None
+    assert not os.path.exists(task[1])
+
+
+def test_verified_downloads_go_through_the_pool(tmp_path, image_server):
+    core.configure_postprocess(verify=True, thumbnail=8, workers=1)
+    image_server.files["/a/0_0.png"] = png_bytes()
+    task = make_task("a_0", image_server.url("/a/0_0.png"), tmp_path, method="urllib")
+    results = []
+    assert core.run_download_tasks([task], num_threads=1, method="urllib", on_result=results.append) == (1, 1)
+    assert results[0]["metrics"]["process_ms"] is not None
+    assert os.path.exists(tmp_path / "thumbnails" / "a_0.jpg")
+    assert core._postprocess_stats["verified"] >= 1
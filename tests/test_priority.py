@@ -0,0 +1,49 @@
+import argparse
+
+import pytest
+
+from mj_csv_dl import core
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("10M", 10 * 1024 ** 2), ("500K", 500 * 1024), ("2.5MB", 2.5 * 1024 ** 2), ("1G/s", 1024 ** 3), ("3", 3 * 1024 ** 2),
+])
+def test_parse_bandwidth(value, expected):
+    assert core.parse_bandwidth(value) == expected
+
+
+def test_parse_bandwidth_rejects_garbage():
+    with pytest.raises(argparse.ArgumentTypeError):
+        core.parse_bandwidth("fast")
+
+
+def test_bandwidth_limiter_allows_one_second_burst():
+    limiter = core.BandwidthLimiter(1000)
+    assert limiter.reserve(1000) == 0
+    assert limiter.reserve(500) == pytest.approx(0.5, abs=0.05)
+    core.configure_bandwidth(0)
+    assert core.get_bandwidth_limiter() is None
+    core.configure_bandwidth("1K")
+    assert core.get_bandwidth_limiter().rate == 1024
+
+
+def test_csv_priority_rules(capsys):
+    core.configure_priority(["MJ-top*=10", "*/likes/*=5", "broken"])
+    assert "broken" in capsys.readouterr().out
+    assert core.get_csv_priority("exports/MJ-top-2024.csv") == 10
+    assert core.get_csv_priority("exports/likes/a.csv") == 5
+    assert core.get_csv_priority("exports/user.csv") == 0
+    groups = core.group_csv_by_priority(["user.csv", "exports/likes/a.csv", "MJ-top.csv", "other.csv"])
+    assert groups == [["MJ-top.csv"], ["exports/likes/a.csv"], ["user.csv", "other.csv"]]
+
+
+def test_primary_images_come_before_variants(tmp_path):
+    csv_path = tmp_path / "a.csv"
+    csv_path.write_text("Prompt,任务ID,图片链接\n"
+                        "p,a,https://cdn.example/a/0_0.png\n"
+                        "p,b,https://cdn.example/b/0_0.png\n", encoding="utf-8")
+    tasks = list(core.iter_prioritized_tasks([str(csv_path)], str(tmp_path), extended_mode=True))
+    assert [task[3] for task in tasks] == ["a_0", "b_0", "a_1", "a_2", "a_3", "b_1", "b_2", "b_3"]
+    core.configure_priority(interleave_variants=True)
+    tasks = list(core.iter_prioritized_tasks([str(csv_path)], str(tmp_path), extended_mode=True))
+    assert [task[3] for task in tasks[:5]] == ["a_0", "a_1", "a_2", "a_3", "b_0"]
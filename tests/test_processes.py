@@ -0,0 +1,42 @@
+import json
+import os
+
+from conftest import make_task, PNG_BYTES
+from mj_csv_dl import core
+
+
+def test_child_processes_write_their_own_index(tmp_path):
+    core.SHARD_NAME_TAG = "p1-"
+    assert core.get_metadata_index_path(str(tmp_path)) == os.path.join(str(tmp_path), "metadata-p1.jsonl")
+    core.SHARD_NAME_TAG = ""
+    assert core.get_metadata_index_path(str(tmp_path)) == os.path.join(str(tmp_path), "metadata.jsonl")
+
+
+def test_merge_metadata_indexes(tmp_path):
+    (tmp_path / "metadata.jsonl").write_text('{"key": "a"}\n', encoding="utf-8")
+    (tmp_path / "metadata-p0.jsonl").write_text('{"key": "b"}\n', encoding="utf-8")
+    (tmp_path / "metadata-p1.jsonl").write_text('{"key": "c"}\n', encoding="utf-8")
+    core.merge_metadata_indexes(str(tmp_path))
+    lines = (tmp_path / "metadata.jsonl").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["key"] for line in lines] == ["a", "b", "c"]
+    assert sorted(os.listdir(tmp_path)) == ["metadata.jsonl"]
+
+
+def test_process_pool_downloads_batches_with_warm_workers(tmp_path, image_server):
+    core.configure_processes(2)
+    core.configure_output_format("shards")
+    for i in range(6):
+        image_server.files[f"/t{i}/0_0.png"] = PNG_BYTES
+    tasks = [make_task(f"t{i}_0", image_server.url(f"/t{i}/0_0.png"), tmp_path, method="urllib") for i in range(6)]
+    results = []
+    with core.DownloadRuntime(2, "urllib") as runtime:
+        assert core.run_download_tasks(tasks[:3], 2, "urllib", on_result=results.append, runtime=runtime) == (3, 3)
+        pids = [worker.pid for worker in runtime.process_pool().workers]
+        assert core.run_download_tasks(tasks[3:], 2, "urllib", on_result=results.append, runtime=runtime) == (3, 3)
+        assert [worker.pid for worker in runtime.process_pool().workers] == pids
+        assert all(worker.is_alive() for worker in runtime.process_pool().workers)
+    assert sorted(result["task_id"] for result in results) == [task[3] for task in tasks]
+    # 子进程各自写入的元数据索引在关闭时合并
+    lines = (tmp_path / "metadata.jsonl").read_text(encoding="utf-8").splitlines()
+    assert sorted(json.loads(line)["task_id"] for line in lines) == [task[3] for task in tasks]
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("metadata-p")]
@@ -0,0 +1,107 @@
+import os
+import shutil
+
+import pytest
+
+from conftest import PNG_BYTES
+from mj_csv_dl import core
+
+IMAGE = PNG_BYTES + b"\x00" * 200_000
+
+
+def test_add_range_header():
+    headers = {"Accept": "image/*"}
+    assert core.add_range_header(headers, 0, '"v1"') is headers
+    assert core.add_range_header(headers, 10) == {"Accept": "image/*", "Range": "bytes=10-"}
+    assert core.add_range_header(headers, 10, '"v1"')["If-Range"] == '"v1"'
+    assert "Range" not in headers
+
+
+def test_resume_validator_prefers_strong_etag(tmp_path):
+    temp_file = str(tmp_path / "a.png.tmp")
+    core.save_resume_validator(temp_file, {"ETag": '"abc"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+    assert core.read_resume_validator(temp_file) == '"abc"'
+    core.save_resume_validator(temp_file, {"ETag": 'W/"abc"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+    assert core.read_resume_validator(temp_file) == "Mon, 01 Jan 2024 00:00:00 GMT"
+    core.save_resume_validator(temp_file, {"ETag": 'W/"abc"'})
+    assert core.read_resume_validator(temp_file) is None
+
+
+def test_get_expected_size(tmp_path):
+    temp_file = tmp_path / "a.png.tmp"
+    assert core.get_expected_size(str(temp_file), 0, 200, {"Content-Length": "120"}) == 120
+    assert core.get_expected_size(str(temp_file), 0, 200, {"Content-Length": "120", "Content-Encoding": "gzip"}) is None
+    assert core.get_expected_size(str(temp_file), 100, 206, {"Content-Range": "bytes 100-119/120"}) == 120
+    temp_file.write_bytes(b"x" * 100)
+    with pytest.raises(IOError):
+        core.get_expected_size(str(temp_file), 100, 206, {"Content-Range": "bytes 50-119/120"})
+    assert not temp_file.exists()
+
+
+def test_finalize_temp_file(tmp_path):
+    save_path = str(tmp_path / "a.png")
+    temp_file = core.get_temp_path(save_path)
+    with open(temp_file, "wb") as f:
+        f.write(IMAGE[:100])
+    # 不完整时保留临时文件供下次续传
+    with pytest.raises(IOError):
+        core.finalize_temp_file(temp_file, save_path, len(IMAGE))
+    assert os.path.exists(temp_file)
+    with open(temp_file, "ab") as f:
+        f.write(IMAGE[100:])
+    assert core.finalize_temp_file(temp_file, save_path, len(IMAGE)) == len(IMAGE)
+    assert not os.path.exists(temp_file) and os.path.exists(save_path)
+    with open(temp_file, "wb") as f:
+        f.write(b"<html>not an image</html>")
+    with pytest.raises(IOError):
+        core.finalize_temp_file(temp_file, save_path)
+    assert not os.path.exists(temp_file)
+
+
+def test_temp_download_without_validator_restarts(tmp_path):
+    save_path = str(tmp_path / "a.png")
+    with open(core.get_temp_path(save_path), "wb") as f:
+        f.write(IMAGE[:100])
+    download = core.TempDownload(save_path)
+    assert download.offset == 0
+    assert not os.path.exists(download.temp_file)
+
+
+def interrupt_then_resume(tmp_path, image_server, download, change_image=False):
+    image_server.files["/a/0_0.png"] = IMAGE
+    image_server.truncate["/a/0_0.png"] = 100_000
+    url = image_server.url("/a/0_0.png")
+    save_path = str(tmp_path / "a_0.png")
+    assert not download(url, save_path)
+    # 按块写入时断开前收到的最后一块可能不完整而被丢弃，续传的偏移以临时文件的大小为准
+    offset = core.get_resume_offset(core.get_temp_path(save_path))
+    assert 0 < offset <= 100_000
+    if change_image:
+        image_server.files["/a/0_0.png"] = PNG_BYTES + b"\x01" * 150_000
+    assert download(url, save_path)
+    with open(save_path, "rb") as f:
+        assert f.read() == image_server.files["/a/0_0.png"]
+    assert not os.path.exists(core.get_temp_path(save_path))
+    return offset, image_server.requests[-1][2]
+
+
+@pytest.mark.parametrize("download", [core.download_image_with_urllib, core.download_image_with_requests])
+def test_interrupted_download_resumes_with_if_range(tmp_path, image_server, download):
+    offset, headers = interrupt_then_resume(tmp_path, image_server, download)
+    assert headers["Range"] == f"bytes={offset}-"
+    assert headers["If-Range"] == image_server.etag("/a/0_0.png")
+    assert image_server.requests[-1][0] == "GET"
+
+
+@pytest.mark.parametrize("download", [core.download_image_with_urllib, core.download_image_with_requests])
+def test_changed_image_is_downloaded_again(tmp_path, image_server, download):
+    offset, headers = interrupt_then_resume(tmp_path, image_server, download, change_image=True)
+    # If-Range 不匹配时服务器返回完整的新图片，不会拼接新旧内容
+    assert headers["Range"] == f"bytes={offset}-"
+
+
+@pytest.mark.skipif(not shutil.which("curl"), reason="需要curl")
+def test_curl_resumes_with_if_range(tmp_path, image_server):
+    offset, headers = interrupt_then_resume(tmp_path, image_server, core.download_image_with_curl)
+    assert headers["Range"] == f"bytes={offset}-"
+    assert headers["If-Range"] == image_server.etag("/a/0_0.png")
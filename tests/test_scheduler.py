@@ -0,0 +1,120 @@
+import email.utils
+import time
+
+import pytest
+
+from conftest import make_task
+from mj_csv_dl import core
+
+
+def make_scheduler(tasks, limit=2, limiter=None):
+    return core.DownloadScheduler(tasks, core.AdaptiveConcurrencyController(limit), limiter)
+
+
+def test_parse_retry_after_seconds_and_http_date():
+    assert core.parse_retry_after("5") == 5.0
+    assert core.parse_retry_after("-3") == 0.0
+    assert core.parse_retry_after(None) is None
+    assert core.parse_retry_after("soon") is None
+    later = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 <= core.parse_retry_after(later) <= 60
+
+
+def test_parse_curl_http_status():
+    assert core.parse_curl_http_status("curl: (22) The requested URL returned error: 503") == 503
+    assert core.parse_curl_http_status("curl: (6) Could not resolve host") is None
+
+
+def test_scheduler_respects_concurrency_limit():
+    tasks = [make_task(f"t{i}_0") for i in range(5)]
+    scheduler = make_scheduler(tasks, limit=2)
+    assert [task[3] for task, _ in scheduler.next_batch(10)] == ["t0_0", "t1_0"]
+    assert scheduler.next_batch(10) == []
+    assert scheduler.complete(tasks[0], 0, {"result": {"success": True}, "latency": 0.1}) == {"success": True}
+    assert [task[3] for task, _ in scheduler.next_batch(10)] == ["t2_0"]
+
+
+def test_scheduler_delays_retries_without_blocking():
+    task = make_task()
+    scheduler = make_scheduler([task])
+    assert scheduler.next_ready() == (task, 0)
+    assert scheduler.complete(task, 0, {"retry": 0.05, "latency": 0.1, "status": 500}) is None
+    assert scheduler.next_ready() is None
+    assert 0 < scheduler.wait_time() <= 0.05
+    assert not scheduler.finished()
+    time.sleep(0.06)
+    assert scheduler.next_ready() == (task, 1)
+    scheduler.complete(task, 1, {"result": {"success": False}, "latency": 0.1})
+    assert scheduler.finished()
+
+
+def test_scheduler_penalizes_throttled_host():
+    limiter = core.HostRateLimiter()
+    tasks = [make_task("a_0"), make_task("b_0")]
+    scheduler = make_scheduler(tasks, limiter=limiter)
+    task, attempt = scheduler.next_ready()
+    scheduler.complete(task, attempt, {"retry": 0.0, "latency": 0.1, "status": 429, "retry_after": 30.0})
+    assert limiter.blocked_wait("cdn.midjourney.com") > 29
+    # 同一主机的任务在暂停结束前不会提交
+    assert scheduler.next_ready() is None
+    assert scheduler.wait_time() > 29
+
+
+def test_scheduler_processing_slots():
+    tasks = [make_task(f"t{i}_0") for i in range(3)]
+    scheduler = make_scheduler(tasks, limit=1)
+    task, attempt = scheduler.next_ready()
+    scheduler.start_processing()
+    # 图片处理中不占用下载名额，但处理中的图片数同样受上限限制
+    assert scheduler.in_flight == 0 and not scheduler.has_capacity()
+    assert scheduler.finish_processing(task, attempt, {"result": {"success": True}, "latency": 0.1})["success"]
+    assert scheduler.processing == 0 and scheduler.has_capacity()
+
+
+def test_host_rate_limiter_spaces_requests():
+    limiter = core.HostRateLimiter(rate=10.0, burst=1)
+    assert limiter.reserve("a") == 0
+    assert limiter.reserve("a") == pytest.approx(0.1, abs=0.01)
+    assert limiter.reserve("b") == 0
+
+
+def test_adaptive_controller_backs_off_and_grows():
+    controller = core.AdaptiveConcurrencyController(8, adaptive=True)
+    assert controller.limit == 4
+    for _ in range(4):
+        controller.record(0.1, 200, True)
+    assert controller.limit == 5
+    controller.record(0.1, 429, False)
+    assert controller.limit == 2
+    fixed = core.AdaptiveConcurrencyController(8)
+    fixed.record(0.1, 429, False)
+    assert fixed.limit == 8
+
+
+def test_attempt_outcome_retries_then_fails(tmp_path):
+    task = make_task(output_dir=tmp_path)
+    failure = {"message": "HTTP 500", "status": 500, "retry_after": 2.0}
+    outcome = core._attempt_outcome(task, 0, False, 0.2, {}, failure=failure)
+    assert outcome["retry"] == 2.0 and "result" not in outcome
+    outcome = core._attempt_outcome(task, 2, False, 0.2, {}, failure=failure)
+    assert "retry" not in outcome
+    assert (outcome["result"]["success"], outcome["result"]["attempts"]) == (False, 3)
+
+
+def test_attempt_outcome_does_not_retry_missing_images(tmp_path):
+    task = make_task(output_dir=tmp_path)
+    outcome = core._attempt_outcome(task, 0, False, 0.2, {}, failure={"message": "HTTP 404", "status": 404,
+                                                                      "retry_after": None})
+    assert "retry" not in outcome
+    assert outcome["result"]["status"] == 404
+    assert core.get_manifest(str(tmp_path)).find_missing(task[0], 60) == 404
+
+
+def test_scheduler_waits_when_task_source_is_idle():
+    task = make_task()
+    scheduler = make_scheduler(iter([None, task]))
+    assert scheduler.next_ready() is None
+    assert not scheduler.finished()
+    assert scheduler.wait_time() == core.IDLE_POLL_INTERVAL
+    assert scheduler.next_ready() == (task, 0)
+    assert scheduler.wait_time() is None
@@ -0,0 +1,56 @@
+import json
+import os
+import tarfile
+
+from conftest import make_task, PNG_BYTES
+from mj_csv_dl import core
+
+
+def write_image(path):
+    with open(path, "wb") as f:
+        f.write(PNG_BYTES)
+    return str(path)
+
+
+def read_index(output_dir):
+    with open(os.path.join(str(output_dir), core.METADATA_INDEX_FILENAME), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_shard_writer_writes_webdataset_samples(tmp_path):
+    writer = core.ShardWriter(str(tmp_path), max_bytes=1024 ** 3)
+    location = writer.add("a_0", write_image(tmp_path / "a_0.png"), "a cat", {"task_id": "a_0"})
+    writer.close()
+    assert location == "shards/shard-000000.tar/a_0.png"
+    with tarfile.open(tmp_path / "shards" / "shard-000000.tar") as tar:
+        assert tar.getnames() == ["a_0.png", "a_0.txt", "a_0.json"]
+        assert tar.extractfile("a_0.txt").read().decode("utf-8") == "a cat"
+        assert tar.extractfile("a_0.png").read() == PNG_BYTES
+    assert read_index(tmp_path) == [{"task_id": "a_0", "key": "a_0", "shard": "shard-000000.tar",
+                                     "image": "a_0.png", "size": len(PNG_BYTES)}]
+
+
+def test_shard_writer_rolls_over_and_continues_numbering(tmp_path):
+    writer = core.ShardWriter(str(tmp_path), max_bytes=len(PNG_BYTES) * 2)
+    shards = [writer.add(f"t{i}_0", write_image(tmp_path / f"t{i}.png"), "p", {}).split("/")[1] for i in range(3)]
+    writer.close()
+    assert shards == ["shard-000000.tar", "shard-000001.tar", "shard-000002.tar"]
+    writer = core.ShardWriter(str(tmp_path), max_bytes=1024 ** 3)
+    assert writer.add("t3_0", write_image(tmp_path / "t3.png"), "p", {}).startswith("shards/shard-000003.tar/")
+    writer.close()
+    assert len(read_index(tmp_path)) == 4
+
+
+def test_finish_task_writes_to_shard(tmp_path):
+    core.configure_output_format("shards")
+    task = make_task("a.b_0", output_dir=tmp_path, metadata={"用户名": "u1"})
+    write_image(task[1])
+    result = core.finish_task(task, True)
+    core.close_shard_writers()
+    assert result["image_path"] == "shards/shard-000000.tar/a_b_0.png"
+    assert not os.path.exists(task[1])
+    assert not os.path.exists(os.path.join(str(tmp_path), "a.b_0.txt"))
+    record = read_index(tmp_path)[0]
+    assert (record["task_id"], record["用户名"], record["prompt"]) == ("a.b_0", "u1", "a prompt")
+    # 分片输出依靠下载清单判断已完成的任务
+    assert core.check_existing_task(task)["skipped"]
@@ -0,0 +1,51 @@
+import threading
+import time
+
+from mj_csv_dl import core
+
+
+def test_task_page_cache_hits_until_expiry():
+    cache = core.TaskPageCache(ttl=0.05)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {"session": str(len(calls))}
+
+    assert cache.get("job", fetch) == ({"session": "1"}, False)
+    assert cache.get("job", fetch) == ({"session": "1"}, True)
+    time.sleep(0.06)
+    assert cache.get("job", fetch) == ({"session": "2"}, False)
+    cache.invalidate("job")
+    assert cache.get("job", fetch) == ({"session": "3"}, False)
+    assert (cache.fetches, cache.hits) == (3, 1)
+
+
+def test_task_page_cache_fetches_once_for_concurrent_callers():
+    cache = core.TaskPageCache(ttl=60)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.05)
+        return {"session": "x"}
+
+    threads = [threading.Thread(target=cache.get, args=("job", fetch)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert cache.hits == 7
+
+
+def test_task_page_cache_evicts_oldest_entries():
+    cache = core.TaskPageCache(ttl=60, max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.get(key, lambda: {})
+    assert list(cache._entries) == ["b", "c"]
+
+
+def test_task_page_cache_disabled_with_zero_ttl():
+    core.configure_task_page_cache(0)
+    assert core.get_task_page_cache() is None
@@ -0,0 +1,77 @@
+import csv
+import io
+import os
+
+from mj_csv_dl import core
+
+CSV_TEXT = (
+    '"Prompt","Prompt 参数","任务ID","任务链接","图片链接","用户名"\n'
+    '"a cat","--ar 1:1","abc/123","https://www.midjourney.com/jobs/abc","https://cdn.midjourney.com/abc/0_0.png","u1"\n'
+    '"no image","","def","","",""\n'
+    '"a dog","","","","https://cdn.midjourney.com/ghi/0_0.png",""\n'
+)
+
+
+def read_rows(text=CSV_TEXT):
+    reader = csv.DictReader(io.StringIO(text), skipinitialspace=True)
+    return reader, core.resolve_csv_fields(reader.fieldnames, "test.csv")
+
+
+def test_get_extended_url_replaces_last_index():
+    assert core.get_extended_url("https://cdn.midjourney.com/abc/0_0.png", 3) == "https://cdn.midjourney.com/abc/0_3.png"
+    assert core.get_extended_url("https://cdn.midjourney.com/abc/grid.png", 1) == "https://cdn.midjourney.com/abc/grid_1.png"
+
+
+def test_clean_task_id_strips_path_characters():
+    assert core.clean_task_id("abc/12:3", 0) == "abc123"
+    assert core.clean_task_id("///", 4) == "task_5"
+
+
+def test_resolve_csv_fields(capsys):
+    assert core.resolve_csv_fields(["Prompt", "图片链接", "任务id"], "a.csv") == ("任务id", None)
+    assert core.resolve_csv_fields(["Prompt", "图片链接", "任务ID", "任务链接"], "a.csv") == ("任务ID", "任务链接")
+    assert core.resolve_csv_fields(["Prompt", "任务ID"], "a.csv") is None
+    assert "图片链接" in capsys.readouterr().out
+
+
+def test_iter_row_tasks_skips_rows_without_image(tmp_path):
+    reader, (task_id_field, task_url_field) = read_rows()
+    tasks = list(core.iter_row_tasks(reader, str(tmp_path), task_id_field, task_url_field, method="requests"))
+    assert [task[3] for task in tasks] == ["abc123_0", "task_3_0"]
+    image_url, image_path, task_url, task_id, prompt_text, extended, method, metadata = tasks[0]
+    assert image_path == os.path.join(str(tmp_path), "abc123_0.png")
+    assert task_url == "https://www.midjourney.com/jobs/abc"
+    assert (prompt_text, extended, method) == ("a cat", False, "requests")
+    assert metadata == {"Prompt 参数": "--ar 1:1", "用户名": "u1"}
+
+
+def test_iter_row_tasks_extended_variants(tmp_path):
+    reader, (task_id_field, task_url_field) = read_rows()
+    tasks = list(core.iter_row_tasks(reader, str(tmp_path), task_id_field, task_url_field, extended_mode=True,
+                                     variants=(1, 2, 3)))
+    assert [task[3] for task in tasks[:3]] == ["abc123_1", "abc123_2", "abc123_3"]
+    assert tasks[0][0].endswith("/abc/0_1.png")
+    assert all(task[5] for task in tasks)
+
+
+def test_iter_row_tasks_is_lazy(tmp_path):
+    consumed = []
+
+    def rows():
+        for i in range(1000):
+            consumed.append(i)
+            yield {"Prompt": "p", "任务ID": f"t{i}", "图片链接": f"https://cdn.example/t{i}/0_0.png"}
+
+    tasks = core.iter_row_tasks(rows(), str(tmp_path), "任务ID", None)
+    first = next(iter(core.iter_batches(tasks, 10)))
+    assert len(first) == 10
+    assert len(consumed) == 10
+
+
+def test_iter_batches_keeps_remainder():
+    assert list(core.iter_batches(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(core.iter_batches([], 3)) == []
+
+
+def test_iter_batches_flushes_when_no_task_is_ready():
+    assert list(core.iter_batches([0, 1, None, None, 2], 3)) == [[0, 1], [2]]
@@ -0,0 +1,119 @@
+import io
+import json
+import os
+import time
+
+from conftest import make_task, PNG_BYTES
+from mj_csv_dl import core
+
+HEADER = "Prompt,任务ID,任务链接,图片链接\n"
+
+
+def row(i):
+    return f'"p{i}","t{i}","",https://cdn.example/t{i}/0_0.png\n'
+
+
+def new_tasks(csv_path, output_dir, state):
+    return [task[3] for task in core.iter_new_csv_tasks(str(csv_path), str(output_dir), state, False, "requests")]
+
+
+def result(task_id, success, status=None):
+    return {"task_id": task_id, "image_url": f"https://cdn.example/{task_id[:-2]}/0_0.png", "success": success,
+            "status": status}
+
+
+def test_iter_complete_records_waits_for_complete_rows():
+    first, second = b'"a","multi\nline"\n', b'"b","c"\n'
+    records = list(core.iter_complete_records(io.BytesIO(first + second + b'"partial')))
+    assert records == [(first.decode(), len(first)), (second.decode(), len(first + second))]
+
+
+def test_new_rows_are_parsed_incrementally(tmp_path):
+    csv_path = tmp_path / "in.csv"
+    csv_path.write_text(HEADER + row(0) + row(1), encoding="utf-8")
+    state = core.WatchState(str(tmp_path))
+    assert new_tasks(csv_path, tmp_path, state) == ["t0_0", "t1_0"]
+    assert new_tasks(csv_path, tmp_path, state) == []
+    with open(csv_path, "a", encoding="utf-8") as f:
+        f.write(row(2)[:10])
+    assert new_tasks(csv_path, tmp_path, state) == []
+    with open(csv_path, "a", encoding="utf-8") as f:
+        f.write(row(2)[10:])
+    assert new_tasks(csv_path, tmp_path, state) == ["t2_0"]
+    assert state.files[str(csv_path)]["offset"] == csv_path.stat().st_size
+
+
+def test_replaced_file_is_parsed_from_start(tmp_path, capsys):
+    csv_path = tmp_path / "in.csv"
+    csv_path.write_text(HEADER + row(0) + row(1), encoding="utf-8")
+    state = core.WatchState(str(tmp_path))
+    new_tasks(csv_path, tmp_path, state)
+    csv_path.write_text(HEADER + row(5), encoding="utf-8")
+    core.reset_task_dedup()
+    assert new_tasks(csv_path, tmp_path, state) == ["t5_0"]
+    assert "重新解析" in capsys.readouterr().out
+
+
+def test_saved_offset_stays_at_earliest_unfinished_row(tmp_path):
+    csv_path = tmp_path / "in.csv"
+    csv_path.write_text(HEADER + row(0) + row(1) + row(2), encoding="utf-8")
+    state = core.WatchState(str(tmp_path))
+    assert new_tasks(csv_path, tmp_path, state) == ["t0_0", "t1_0", "t2_0"]
+    state.settle(result("t0_0", True))
+    state.settle(result("t1_0", False, 500))
+    state.settle(result("t2_0", True))
+    state.save()
+    with open(tmp_path / core.WATCH_STATE_FILENAME, encoding="utf-8") as f:
+        assert json.load(f)[str(csv_path)]["offset"] == len((HEADER + row(0)).encode("utf-8"))
+
+    # 重启后从最早未完成的一行重新解析
+    core.reset_task_dedup()
+    assert new_tasks(csv_path, tmp_path, core.WatchState(str(tmp_path))) == ["t1_0", "t2_0"]
+
+    state.settle(result("t1_0", True))
+    state.save()
+    with open(tmp_path / core.WATCH_STATE_FILENAME, encoding="utf-8") as f:
+        assert json.load(f)[str(csv_path)]["offset"] == csv_path.stat().st_size
+
+
+def test_failed_tasks_are_retried_with_backoff(tmp_path):
+    core.WATCH_RETRY_DELAY = 0.05
+    core.WATCH_RETRY_LIMIT = 2
+    csv_path = tmp_path / "in.csv"
+    csv_path.write_text(HEADER + row(0) + row(1), encoding="utf-8")
+    state = core.WatchState(str(tmp_path))
+    new_tasks(csv_path, tmp_path, state)
+    state.settle(result("t0_0", False, 503))
+    state.settle(result("t1_0", False, 404))
+    assert list(state.outstanding) == [("t0_0", "https://cdn.example/t0/0_0.png")]
+    assert state.due_retries() == []
+    time.sleep(0.06)
+    assert [task[3] for task in state.due_retries()] == ["t0_0"]
+    assert state.due_retries() == []
+    state.settle(result("t0_0", False, 503))
+    assert state.outstanding[("t0_0", "https://cdn.example/t0/0_0.png")]["failures"] == 2
+    # 达到重试上限后不再跟踪，偏移可以越过该行
+    state.settle(result("t0_0", False, 503))
+    assert state.outstanding == {}
+
+
+def test_forget_drops_outstanding_tasks_of_file(tmp_path):
+    csv_path = tmp_path / "in.csv"
+    csv_path.write_text(HEADER + row(0), encoding="utf-8")
+    state = core.WatchState(str(tmp_path))
+    new_tasks(csv_path, tmp_path, state)
+    state.forget(os.path.abspath(str(csv_path)))
+    assert state.outstanding == {}
+
+
+def test_async_session_stays_open_across_batches(tmp_path, image_server):
+    image_server.files["/a/0_0.png"] = PNG_BYTES
+    image_server.files["/b/0_0.png"] = PNG_BYTES
+    with core.DownloadRuntime(2, "async") as runtime:
+        first = make_task("a_0", image_server.url("/a/0_0.png"), tmp_path, method="async")
+        assert core.run_download_tasks([first], 2, "async", runtime=runtime) == (1, 1)
+        loop, session = runtime._loop, runtime._session
+        second = make_task("b_0", image_server.url("/b/0_0.png"), tmp_path, method="async")
+        assert core.run_download_tasks([second], 2, "async", runtime=runtime) == (1, 1)
+        assert (runtime._loop, runtime._session) == (loop, session) and not session.closed
+    assert session.closed